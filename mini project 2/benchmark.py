@@ -0,0 +1,406 @@
+### Benchmarks for the normalization pipeline
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import mini_project2
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module; peak_rss_mb() falls back to tracemalloc
+    resource = None
+
+
+# Order line counts run by the benchmark suite by default; 10M can be requested explicitly.
+SUITE_SCALES = [10000, 100000, 1000000]
+
+STEP_FUNCTIONS = [
+    mini_project2.step1_create_region_table,
+    mini_project2.step2_create_region_to_regionid_dictionary,
+    mini_project2.step3_create_country_table,
+    mini_project2.step4_create_country_to_countryid_dictionary,
+    mini_project2.step5_create_customer_table,
+    mini_project2.step6_create_customer_to_customerid_dictionary,
+    mini_project2.step7_create_productcategory_table,
+    mini_project2.step8_create_productcategory_to_productcategoryid_dictionary,
+    mini_project2.step9_create_product_table,
+    mini_project2.step10_create_product_to_productid_dictionary,
+    mini_project2.step11_create_orderdetail_table,
+]
+
+DATA_HEADER = ['Name', 'Address', 'City', 'Country', 'Region', 'ProductName', 'ProductCategory',
+               'ProductCategoryDescription', 'ProductUnitPrice', 'QuantityOrdered', 'OrderDate']
+
+
+def load_catalog():
+    # Inputs: None
+    # Output: (customers, products) read from the step fixtures next to this file, as
+    #         (Name, Address, City, Country, Region) and
+    #         (ProductName, ProductUnitPrice, ProductCategory, ProductCategoryDescription) tuples
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def read(filename):
+        with open(os.path.join(here, filename), newline='') as f:
+            return list(csv.DictReader(f))
+
+    regions = {r['RegionID']: r['Region'] for r in read('step1.csv')}
+    countries = {c['CountryID']: (c['Country'], regions[c['RegionID']]) for c in read('step3.csv')}
+    categories = {c['ProductCategoryID']: (c['ProductCategory'], c['ProductCategoryDescription'])
+                  for c in read('step7.csv')}
+    customers = [(c['FirstName'] + ' ' + c['LastName'], c['Address'], c['City']) + countries[c['CountryID']]
+                 for c in read('step5.csv')]
+    products = [(p['ProductName'], p['ProductUnitPrice']) + categories[p['ProductCategoryID']]
+                for p in read('step9.csv')]
+    return customers, products
+
+
+def generate_data_file(data_filename, n_rows, seed=0, orders_per_line=100):
+    # Inputs: Name of the data file to write; number of order lines (OrderDetail rows); random seed;
+    #         order lines packed into each input line
+    # Output: Name of the customer on the first input line
+    # Writes a tab-separated file in the exact data.csv layout: one customer per input line with
+    # the ProductName, ProductCategory, ProductCategoryDescription, ProductUnitPrice,
+    # QuantityOrdered and OrderDate columns semicolon-packed. Customers, products and categories
+    # come from the step fixtures, so names carry the same spaces, commas and apostrophes as the
+    # real data. Customers are assigned round-robin, so each appears once there are enough lines.
+
+    customers, products = load_catalog()
+    rng = random.Random(seed)
+    first_day = datetime.date(2012, 7, 1).toordinal()
+    last_day = datetime.date(2015, 12, 31).toordinal()
+
+    with open(data_filename, 'w') as f:
+        f.write('\t'.join(DATA_HEADER) + '\n')
+        written = 0
+        line_number = 0
+        while written < n_rows:
+            n = min(orders_per_line, n_rows - written)
+            customer = customers[line_number % len(customers)]
+            items = [rng.choice(products) for _ in range(n)]
+            days = sorted(rng.randint(first_day, last_day) for _ in range(n))
+            f.write('\t'.join(list(customer) + [
+                ';'.join(i[0] for i in items),
+                ';'.join(i[2] for i in items),
+                ';'.join(i[3] for i in items),
+                ';'.join(i[1] for i in items),
+                ';'.join(str(rng.randint(1, 60)) for _ in items),
+                ';'.join(datetime.date.fromordinal(d).strftime('%Y%m%d') for d in days),
+            ]) + '\n')
+            written += n
+            line_number += 1
+
+    return customers[0][0]
+
+
+def peak_rss_mb():
+    # Inputs: None
+    # Output: Peak resident set size of the current process in MB. Without the resource module it
+    #         is the peak of the Python allocations traced since the first call, which leaves out
+    #         SQLite's own memory.
+
+    if resource is None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _load_orderdetail(data_filename, normalized_database_filename, batch_size):
+    # Runs in a fresh worker process so ru_maxrss reflects this load only.
+    with mini_project2.NormalizationSession(normalized_database_filename) as session:
+        mini_project2.step1_create_region_table(data_filename, normalized_database_filename, session=session)
+        mini_project2.step3_create_country_table(data_filename, normalized_database_filename, session=session)
+        mini_project2.step5_create_customer_table(data_filename, normalized_database_filename, session=session)
+        mini_project2.step7_create_productcategory_table(data_filename, normalized_database_filename, session=session)
+        mini_project2.step9_create_product_table(data_filename, normalized_database_filename, session=session)
+
+        baseline_rss = peak_rss_mb()
+        start = time.perf_counter()
+        mini_project2.step11_create_orderdetail_table(data_filename, normalized_database_filename, batch_size,
+                                                      session=session)
+        seconds = time.perf_counter() - start
+
+        rows = session.connection.execute("select count(*) from OrderDetail").fetchone()[0]
+    return rows, seconds, baseline_rss, peak_rss_mb()
+
+
+def benchmark_orderdetail_load(data_filename, batch_size=mini_project2.ORDERDETAIL_BATCH_SIZE):
+    # Inputs: Name of the data file; number of rows per executemany call
+    # Output: Dictionary with rows loaded, seconds, rows/sec and peak RSS (MB) of step 11
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        normalized_database_filename = os.path.join(tmpdir, 'normalized.db')
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            rows, seconds, baseline_rss, peak_rss = executor.submit(
+                _load_orderdetail, data_filename, normalized_database_filename, batch_size).result()
+
+    return {
+        'step': 'step11_create_orderdetail_table',
+        'batch_size': batch_size,
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(rows / seconds) if seconds else None,
+        'rss_before_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(peak_rss, 1),
+        'memory_source': 'ru_maxrss' if resource is not None else 'tracemalloc',
+    }
+
+
+def benchmark_date_conversion(n_dates=1000000, n_distinct=1500, seed=0):
+    # Inputs: Number of OrderDate tokens to convert; number of distinct dates among them; random seed
+    # Output: Dictionary with seconds taken by strptime/strftime and by OrderDateConverter
+
+    rng = random.Random(seed)
+    distinct = ['%d%02d%02d' % (rng.randint(2012, 2015), rng.randint(1, 12), rng.randint(1, 28))
+                for _ in range(n_distinct)]
+    tokens = [rng.choice(distinct) for _ in range(n_dates)]
+
+    start = time.perf_counter()
+    expected = [datetime.datetime.strptime(i, '%Y%m%d').strftime('%Y-%m-%d') for i in tokens]
+    strptime_seconds = time.perf_counter() - start
+
+    format_date = mini_project2.OrderDateConverter()
+    start = time.perf_counter()
+    converted = [format_date(i) for i in tokens]
+    converter_seconds = time.perf_counter() - start
+
+    assert converted == expected
+    return {
+        'dates': n_dates,
+        'strptime_seconds': round(strptime_seconds, 3),
+        'converter_seconds': round(converter_seconds, 3),
+        'speedup': round(strptime_seconds / converter_seconds, 1),
+    }
+
+
+def benchmark_dimension_scaling(sizes=SUITE_SCALES, repeats=3, seed=0):
+    # Inputs: Input line counts to try; number of times each parse is repeated; random seed
+    # Output: Dictionary with the best microseconds per line of parse_data_file() without the order
+    #         details at each size, and the ratio of the largest size's cost to the smallest's
+    # The dimension keys are accumulated in sets and sorted once, so the cost per line stays flat;
+    # a per-line re-sort of everything seen so far grows ~10x per line for each 10x in input size.
+
+    results = {'us_per_line': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            data_filename = os.path.join(tmpdir, 'data_%d.csv' % n)
+            generate_data_file(data_filename, n, seed, orders_per_line=1)
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                mini_project2.parse_data_file(data_filename, include_order_details=False)
+                timings.append(time.perf_counter() - start)
+            results['us_per_line'][n] = round(min(timings) / n * 1e6, 2)
+    per_line = list(results['us_per_line'].values())
+    results['ratio'] = round(per_line[-1] / per_line[0], 2)
+    return results
+
+
+def benchmark_parallel_parse(data_filename, workers=(1, 2, 4, 8)):
+    # Inputs: Name of the data file; worker counts to try
+    # Output: Dictionary of worker count -> parse_data_file() seconds
+
+    results = {}
+    for n in workers:
+        start = time.perf_counter()
+        mini_project2.parse_data_file(data_filename, workers=n)
+        results[n] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def benchmark_partitioned_writers(data_filename, writers=(1, 2, 4, 8)):
+    # Inputs: Name of the data file; writer counts to try
+    # Output: Dictionary of writer count -> normalize() seconds (1 = the single-writer insert)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in writers:
+            db_filename = os.path.join(tmpdir, 'writers%d.db' % n)
+            start = time.perf_counter()
+            mini_project2.normalize(data_filename, db_filename, writers=n)
+            results[n] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def benchmark_column_scan(data_filename, columns=(4,)):
+    # Inputs: Name of the data file; columns to extract
+    # Output: Dictionary with seconds for a text-mode strip/split scan and for iter_columns()
+
+    start = time.perf_counter()
+    with open(data_filename) as f:
+        next(f)
+        split_rows = [tuple(line.strip().split('\t')[c] for c in columns) for line in f if line.strip()]
+    split_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mmap_rows = list(mini_project2.iter_columns(data_filename, columns))
+    mmap_seconds = time.perf_counter() - start
+
+    assert mmap_rows == split_rows
+    return {
+        'columns': list(columns),
+        'split_seconds': round(split_seconds, 3),
+        'mmap_seconds': round(mmap_seconds, 3),
+        'speedup': round(split_seconds / mmap_seconds, 1),
+    }
+
+
+def benchmark_bulk_load(data_filename):
+    # Inputs: Name of the data file
+    # Output: Dictionary with normalize() seconds in the default and bulk_load=True modes
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for bulk_load in (False, True):
+            normalized_database_filename = os.path.join(tmpdir, 'normalized_%s.db' % bulk_load)
+            start = time.perf_counter()
+            mini_project2.normalize(data_filename, normalized_database_filename, bulk_load=bulk_load)
+            results['bulk_load' if bulk_load else 'default'] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def benchmark_columnar_scan(data_filename, repeats=3):
+    # Inputs: Name of the data file; number of times each scan is repeated
+    # Output: Dictionary with the seconds per full read of the sales fact view with
+    #         pd.read_sql_query and, per .col codec ('zlib' and 'raw'), the export time, the file
+    #         size and the seconds per full read with read_columnar
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        normalized_database_filename = os.path.join(tmpdir, 'normalized.db')
+        mini_project2.normalize(data_filename, normalized_database_filename, bulk_load=True)
+
+        conn = mini_project2.create_connection(normalized_database_filename)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            sql_rows = len(pd.read_sql_query(mini_project2.SALES_FACT_SQL, conn))
+        results['sqlite_seconds'] = round((time.perf_counter() - start) / repeats, 3)
+        conn.close()
+
+        for compression in ('zlib', None):
+            codec_results = results[compression or 'raw'] = {}
+            output_directory = os.path.join(tmpdir, compression or 'raw')
+            start = time.perf_counter()
+            columnar_filename = mini_project2.export_columnar(normalized_database_filename, output_directory, tables=[],
+                                                              include_sales_fact=True, compression=compression)['SalesFact']
+            codec_results['export_seconds'] = round(time.perf_counter() - start, 3)
+            codec_results['columnar_mb'] = round(os.path.getsize(columnar_filename) / (1024 * 1024), 1)
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                columnar_rows = len(mini_project2.read_columnar(columnar_filename))
+            codec_results['columnar_seconds'] = round((time.perf_counter() - start) / repeats, 3)
+            codec_results['speedup'] = round(results['sqlite_seconds'] / codec_results['columnar_seconds'], 1)
+            assert sql_rows == columnar_rows
+
+    return results
+
+
+def benchmark_suite(n_rows, seed=0):
+    # Inputs: Number of order lines to generate; random seed
+    # Output: Dictionary with the seconds taken by every stepN function and every ex query
+    # The steps run in order against a fresh database; each ex query is timed the way the tests
+    # use it, i.e. building the statement and reading it once with pd.read_sql_query, and again as a
+    # repeated report() call answered from QUERY_CACHE.
+
+    results = {'rows': n_rows, 'seed': seed, 'steps': {}, 'queries': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_filename = os.path.join(tmpdir, 'data.csv')
+        normalized_database_filename = os.path.join(tmpdir, 'normalized.db')
+        customer_name = generate_data_file(data_filename, n_rows, seed)
+        results['file_mb'] = round(os.path.getsize(data_filename) / (1024 * 1024), 1)
+
+        for number, step in enumerate(STEP_FUNCTIONS, 1):
+            args = (normalized_database_filename,) if number % 2 == 0 else (data_filename, normalized_database_filename)
+            start = time.perf_counter()
+            step(*args)
+            results['steps'][step.__name__] = round(time.perf_counter() - start, 4)
+
+        conn = mini_project2.create_connection(normalized_database_filename)
+        for number in range(1, 12):
+            ex = getattr(mini_project2, 'ex%d' % number)
+            args = (conn, customer_name) if number <= 2 else (conn,)
+            try:
+                start = time.perf_counter()
+                rows = len(pd.read_sql_query(ex(*args), conn))
+                seconds = time.perf_counter() - start
+                mini_project2.report(conn, ex.__name__, *args[1:])
+                start = time.perf_counter()
+                mini_project2.report(conn, ex.__name__, *args[1:])
+                results['queries'][ex.__name__] = {'seconds': round(seconds, 4), 'rows': rows,
+                                                   'cached_seconds': round(time.perf_counter() - start, 4)}
+            except Exception as e:
+                results['queries'][ex.__name__] = {'error': str(e)}
+        conn.close()
+
+    return results
+
+
+def run_benchmark_suite(scales=SUITE_SCALES, output_filename='benchmark_results.json', seed=0):
+    # Inputs: Order line counts to run; JSON file to write; random seed
+    # Output: The results written to output_filename
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': mini_project2.sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'runs': [benchmark_suite(n_rows, seed) for n_rows in scales],
+    }
+    with open(output_filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    # Usage: python benchmark.py orderdetail data.csv [batch_size]
+    #        python benchmark.py bulk_load [n_rows]
+    #        python benchmark.py dates [n_dates]
+    #        python benchmark.py scaling [n_lines ...]
+    #        python benchmark.py parse data.csv
+    #        python benchmark.py writers data.csv
+    #        python benchmark.py scan data.csv [column ...]
+    #        python benchmark.py columnar data.csv
+    #        python benchmark.py suite [n_rows ...]       (writes benchmark_results.json)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'orderdetail'
+    if command == 'suite':
+        scales = [int(n) for n in sys.argv[2:]] or SUITE_SCALES
+        print(json.dumps(run_benchmark_suite(scales), indent=2))
+    elif command == 'dates':
+        print(benchmark_date_conversion(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000))
+    elif command == 'scaling':
+        print(benchmark_dimension_scaling([int(n) for n in sys.argv[2:]] or SUITE_SCALES))
+    elif command == 'parse':
+        print(benchmark_parallel_parse(sys.argv[2] if len(sys.argv) > 2 else 'data.csv',
+                                       sorted({1, 2, 4, os.cpu_count() or 1})))
+    elif command == 'writers':
+        print(benchmark_partitioned_writers(sys.argv[2] if len(sys.argv) > 2 else 'data.csv',
+                                            sorted({1, 2, 4, os.cpu_count() or 1})))
+    elif command == 'scan':
+        columns = tuple(int(c) for c in sys.argv[3:]) or (4,)
+        print(benchmark_column_scan(sys.argv[2] if len(sys.argv) > 2 else 'data.csv', columns))
+    elif command == 'columnar':
+        print(benchmark_columnar_scan(sys.argv[2] if len(sys.argv) > 2 else 'data.csv'))
+    elif command == 'bulk_load':
+        n_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            data_filename = os.path.join(tmpdir, 'data.csv')
+            generate_data_file(data_filename, n_rows)
+            print(benchmark_bulk_load(data_filename))
+    else:
+        data_filename = sys.argv[2] if len(sys.argv) > 2 else 'data.csv'
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else mini_project2.ORDERDETAIL_BATCH_SIZE
+        print(benchmark_orderdetail_load(data_filename, batch_size))
@@ -0,0 +1,208 @@
+### Ingestion service: loads data files into the normalized database as they arrive
+import asyncio
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mini_project2
+
+
+# Seconds between two scans of the spool directory
+POLL_INTERVAL = 1.0
+
+# Parsed files waiting for the writer; the reader runs at most this many files ahead of it.
+QUEUE_SIZE = 4
+
+
+class IngestionService:
+    # Watches spool_directory and appends every data file that lands there to the normalized
+    # database with load_incremental, so existing rows keep their IDs and a file that was already
+    # loaded is skipped.
+    # Usage:
+    #     service = IngestionService('spool', 'normalized.db')
+    #     asyncio.run(service.run())       # returns after service.stop()
+    # A file is picked up once its size and mtime are unchanged between two polls, i.e. the upstream
+    # has finished writing it; names starting with '.' are ignored. A reader task parses files in a
+    # worker thread and hands them to the writer through a bounded queue, so parsing the next file
+    # overlaps writing the previous one and a slow database holds the reader back. Every write runs
+    # in one writer thread owning the only connection. Loaded files are moved to done_directory and
+    # files that fail to parse or load to failed_directory (by default done/ and failed/ under the
+    # spool directory). stop() lets the writer finish everything already parsed before run() returns.
+    # If the writer task itself dies, the reader is cancelled and run() raises the writer's error.
+
+    def __init__(self, spool_directory, normalized_database_filename, poll_interval=POLL_INTERVAL,
+                 queue_size=QUEUE_SIZE, done_directory=None, failed_directory=None, workers=None):
+        self.spool_directory = spool_directory
+        self.normalized_database_filename = normalized_database_filename
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.done_directory = done_directory or os.path.join(spool_directory, 'done')
+        self.failed_directory = failed_directory or os.path.join(spool_directory, 'failed')
+        self.workers = workers
+        self.files_loaded = 0
+        self.files_failed = 0
+        self.rows_loaded = 0
+        self.write_seconds = 0.0
+        self.last_lag_seconds = None
+        self.max_lag_seconds = 0.0
+        self._pending = {}
+        self._in_flight = set()
+        self._queue = None
+        self._session = None
+        self._started = None
+        self._stopping = asyncio.Event()
+
+    def metrics(self):
+        # Output: Dictionary with the files and rows loaded so far, the writer's throughput in rows
+        #         per second of write time, and the lag between a file's mtime and the commit of its rows
+        return {
+            'files_loaded': self.files_loaded,
+            'files_failed': self.files_failed,
+            'rows_loaded': self.rows_loaded,
+            'rows_per_second': self.rows_loaded / self.write_seconds if self.write_seconds else 0.0,
+            'write_seconds': self.write_seconds,
+            'uptime_seconds': time.monotonic() - self._started if self._started is not None else 0.0,
+            'last_lag_seconds': self.last_lag_seconds,
+            'max_lag_seconds': self.max_lag_seconds,
+            'queued_files': self._queue.qsize() if self._queue is not None else 0,
+            'pending_files': len(self._pending),
+        }
+
+    def stop(self):
+        # Must be called from the event loop thread (e.g. a signal handler added with loop.add_signal_handler)
+        self._stopping.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._started = time.monotonic()
+        self._queue = asyncio.Queue(self.queue_size)
+        with ThreadPoolExecutor(1) as reader, ThreadPoolExecutor(1) as writer:
+            writer_task = loop.create_task(self._write_files(writer))
+            reader_task = loop.create_task(self._read_files(reader))
+            # Nothing drains the queue once the writer is gone, so the reader must not wait on it
+            writer_task.add_done_callback(lambda task: reader_task.cancel())
+            try:
+                await reader_task
+            except asyncio.CancelledError:
+                if not writer_task.done():
+                    raise
+            finally:
+                if not writer_task.done():
+                    await self._queue.put(None)
+                await writer_task
+
+    def scan(self):
+        # Output: Files in the spool directory that did not change since the previous scan, oldest first
+        ready = []
+        pending = {}
+        for entry in os.scandir(self.spool_directory):
+            if entry.name.startswith('.') or not entry.is_file() or entry.path in self._in_flight:
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._pending.get(entry.path) == signature:
+                ready.append((stat.st_mtime, entry.name, entry.path))
+            else:
+                pending[entry.path] = signature
+        self._pending = pending
+        return [(path, mtime) for mtime, _, path in sorted(ready)]
+
+    async def _read_files(self, executor):
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            for path, mtime in self.scan():
+                if self._stopping.is_set():
+                    break
+                self._in_flight.add(path)
+                try:
+                    parsed = await loop.run_in_executor(executor, self._parse, path)
+                except Exception as e:
+                    print("Failed to parse %s: %s" % (path, e))
+                    self._finish(path, self.failed_directory)
+                    self.files_failed += 1
+                    continue
+                await self._queue.put((path, mtime, parsed))
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write_files(self, executor):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                path, mtime, parsed = item
+
+                start = time.monotonic()
+                try:
+                    rows = await loop.run_in_executor(executor, self._load, path, parsed)
+                except Exception as e:
+                    print("Failed to load %s: %s" % (path, e))
+                    self._finish(path, self.failed_directory)
+                    self.files_failed += 1
+                    continue
+                self.write_seconds += time.monotonic() - start
+                self.last_lag_seconds = max(time.time() - mtime, 0.0)
+                self.max_lag_seconds = max(self.max_lag_seconds, self.last_lag_seconds)
+                self.files_loaded += 1
+                self.rows_loaded += rows
+                self._finish(path, self.done_directory)
+        finally:
+            await loop.run_in_executor(executor, self._close_session)
+
+    def _parse(self, data_filename):
+        # Runs in the reader thread
+        exploder = mini_project2.OrderLineExploder()
+        parsed = mini_project2.parse_data_file(data_filename, workers=self.workers, exploder=exploder)
+        exploder.format_date.report()
+        exploder.report()
+        return parsed
+
+    def _load(self, data_filename, parsed):
+        # Runs in the writer thread, which owns the session (sqlite3 connections stay in their thread)
+        if self._session is None:
+            self._session = mini_project2.NormalizationSession(self.normalized_database_filename)
+        return mini_project2.load_incremental(data_filename, self.normalized_database_filename, self._session, parsed)
+
+    def _close_session(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _finish(self, path, directory):
+        # Moves a processed file out of the spool directory without overwriting an earlier one. A
+        # file that cannot be moved is reported and stays in _in_flight, so later scans skip it.
+        try:
+            os.makedirs(directory, exist_ok=True)
+            target = os.path.join(directory, os.path.basename(path))
+            n = 1
+            while os.path.exists(target):
+                target = os.path.join(directory, '%s.%d' % (os.path.basename(path), n))
+                n += 1
+            os.replace(path, target)
+        except OSError as e:
+            print("Failed to move %s to %s: %s" % (path, directory, e))
+            return
+        self._in_flight.discard(path)
+
+
+async def serve(spool_directory, normalized_database_filename, poll_interval=POLL_INTERVAL):
+    # Runs an IngestionService until SIGINT or SIGTERM
+    # Output: The service's final metrics
+    service = IngestionService(spool_directory, normalized_database_filename, poll_interval)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, service.stop)
+    await service.run()
+    return service.metrics()
+
+
+if __name__ == '__main__':
+    # Usage: python ingest.py spool_directory normalized.db [poll_interval]
+    print(asyncio.run(serve(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else POLL_INTERVAL)))
@@ -1,40 +1,193 @@
 ### Utility Functions
 import pandas as pd
+import numpy as np
 import sqlite3
 from sqlite3 import Error
+import contextvars
 import datetime
-
-
-def create_connection(db_file, delete_db=False):
+import hashlib
+import json
+import locale
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice, repeat
+from types import MappingProxyType
+import time
+import tracemalloc
+import weakref
+
+
+# Settings applied for the duration of a bulk load: no rollback journal, no fsyncs, a 256 MB page
+# cache and in-memory temp tables. Foreign keys are not enforced per row; they are checked once
+# with PRAGMA foreign_key_check when the load ends.
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = 0",
+]
+
+# Restored by end_bulk_load on a connection start_bulk_load did not record
+SAFE_PRAGMAS = [
+    "PRAGMA journal_mode = DELETE",
+    "PRAGMA synchronous = FULL",
+    "PRAGMA cache_size = -2000",
+    "PRAGMA temp_store = DEFAULT",
+    "PRAGMA foreign_keys = 1",
+]
+
+# Connection -> PRAGMA statements restoring the values start_bulk_load replaced. Weakly keyed, so
+# a connection closed without end_bulk_load does not keep its entry (or the connection) alive.
+_PRAGMAS_BEFORE_BULK_LOAD = weakref.WeakKeyDictionary()
+
+
+class SQLiteConnection(sqlite3.Connection):
+    # The connection class of create_connection(). Unlike sqlite3.Connection it can be weakly
+    # referenced, so per-connection state is kept in WeakKeyDictionaries that forget a connection
+    # once it is garbage collected.
+    pass
+
+
+def create_connection(db_file, delete_db=False, bulk_load=False):
     import os
     if delete_db and os.path.exists(db_file):
         os.remove(db_file)
 
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, factory=SQLiteConnection)
         conn.execute("PRAGMA foreign_keys = 1")
+        if bulk_load:
+            start_bulk_load(conn)
     except Error as e:
         print(e)
 
     return conn
 
 
-def create_table(conn, create_table_sql, drop_table_name=None):
-    
-    if drop_table_name: # You can optionally pass drop_table_name to drop the table. 
-        try:
-            c = conn.cursor()
-            c.execute("""DROP TABLE IF EXISTS %s""" % (drop_table_name))
-        except Error as e:
-            print(e)
-    
+def start_bulk_load(conn):
+    # Inputs: Connection from create_connection() (TypeError for a plain sqlite3.Connection, which
+    #         cannot be weakly referenced and so cannot have its PRAGMAs recorded)
+    # Output: None
+    # The current values of the BULK_LOAD_PRAGMAS are recorded first, for end_bulk_load to put back.
+    # A load that fails in this mode can leave the database inconsistent; rebuild it with delete_db=True.
+
+    names = [pragma.split()[1] for pragma in BULK_LOAD_PRAGMAS]
+    previous = ["PRAGMA %s = %s" % (name, conn.execute("PRAGMA %s" % name).fetchone()[0]) for name in names]
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
-    except Error as e:
-        print(e)
-        
+        _PRAGMAS_BEFORE_BULK_LOAD.setdefault(conn, previous)
+    except TypeError:
+        raise TypeError("start_bulk_load needs a connection opened by create_connection(), not %s"
+                        % type(conn).__name__) from None
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+
+
+def end_bulk_load(conn, check_foreign_keys=True):
+    # Inputs: Connection used with start_bulk_load; whether to check the foreign keys
+    # Output: None; raises sqlite3.IntegrityError if the load left dangling foreign keys
+    # Restores the PRAGMAs in effect before start_bulk_load, so e.g. a WAL database stays in WAL mode.
+
+    conn.commit()
+    try:
+        previous = _PRAGMAS_BEFORE_BULK_LOAD.pop(conn)
+    except (KeyError, TypeError):
+        previous = SAFE_PRAGMAS  # not started by start_bulk_load
+    for pragma in previous:
+        conn.execute(pragma)
+
+    violations = conn.execute("PRAGMA foreign_key_check").fetchall() if check_foreign_keys else None
+    if violations:
+        raise sqlite3.IntegrityError(
+            "%d foreign key violations after bulk load, first: %s" % (len(violations), violations[0]))
+
+
+class NormalizationSession:
+    # Owns a single connection to the normalized database for a whole chain of steps, so the
+    # connection (and its PRAGMAs) is opened once and closed deterministically.
+    # Usage:
+    #     with NormalizationSession('normalized.db') as session:
+    #         step1_create_region_table('data.csv', 'normalized.db', session=session)
+    # With bulk_load=True the connection runs with BULK_LOAD_PRAGMAS until the session closes.
+    # Key -> ID lookups go through id_cache, the shared ID_CACHE unless one is passed.
+    # The tables are stored by backend, SQLITE_BACKEND unless one is passed; for another backend
+    # normalized_database_filename is whatever it connects to (e.g. a PostgreSQL DSN).
+
+    def __init__(self, normalized_database_filename, delete_db=False, bulk_load=False, id_cache=None, backend=None):
+        self.normalized_database_filename = normalized_database_filename
+        self.delete_db = delete_db
+        self.bulk_load = bulk_load
+        self.id_cache = id_cache if id_cache is not None else ID_CACHE
+        self.backend = backend if backend is not None else SQLITE_BACKEND
+        self.connections_opened = 0
+        self._conn = None
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn = self.backend.connect(self.normalized_database_filename, self.delete_db, self.bulk_load)
+            self.delete_db = False
+            self.connections_opened += 1
+        return self._conn
+
+    def close(self, check_bulk_load=True):
+        if self._conn is not None:
+            try:
+                self.backend.close(self._conn, self.bulk_load and check_bulk_load)
+            finally:
+                self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Skip the foreign key check when unwinding from an error so it does not mask the cause
+        self.close(check_bulk_load=exc_type is None)
+
+
+@contextmanager
+def session_scope(normalized_database_filename, session=None, bulk_load=False):
+    # Inputs: Normalized database filename; optional session shared by the caller; bulk load mode
+    #         for a new session
+    # Output: The caller's session, or a new one that is closed on exit
+
+    profiler = _ACTIVE_PROFILER.get()
+    if session is not None:
+        if profiler is not None:
+            profiler.trace(session.connection)
+        yield session
+    else:
+        with NormalizationSession(normalized_database_filename, bulk_load=bulk_load) as session:
+            if profiler is not None:
+                profiler.trace(session.connection)
+            yield session
+
+
+def create_table(conn, create_table_sql, drop_table_name=None):
+    # create_table_sql is written for SQLite; other backends translate it
+    backend_for(conn).create_table(conn, create_table_sql, drop_table_name)
+
+
+def transaction(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Context manager committing the statements run inside it, or rolling them back on error
+    return backend_for(conn).transaction(conn)
+
+
+def insert_rows(conn, table, columns, rows):
+    # Inputs: Connection to the normalized database; table name; column names; iterable of row tuples
+    # Output: Number of rows inserted
+    return backend_for(conn).insert_rows(conn, table, columns, rows)
+
 def execute_sql_statement(sql_statement, conn):
     cur = conn.cursor()
     cur.execute(sql_statement)
@@ -43,413 +196,2190 @@ def execute_sql_statement(sql_statement, conn):
 
     return rows
 
-def step1_create_region_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+
+### Storage Backends
+
+# Characters of COPY text collected before they are sent to the server
+COPY_BUFFER_SIZE = 1 << 20
+
+# Dropped by PostgresBackend.connect(delete_db=True), dependents first
+NORMALIZED_TABLES = ['OrderDetail', 'Date', 'LoadHistory', 'Product', 'ProductCategory', 'Customer', 'Country', 'Region']
+
+# SQLite DDL -> PostgreSQL DDL. An identity column numbers rows in insertion order like SQLite's
+# rowid, and "generated by default" still accepts the explicit DateIDs of the Date table.
+POSTGRES_DDL_REPLACEMENTS = [
+    ('integer primary key not null', 'integer generated by default as identity primary key'),
+    ('inetger', 'integer'),
+    (' real ', ' double precision '),
+]
+
+
+class SQLiteBackend:
+    # Stores the normalized tables in a SQLite database file and inserts with executemany. This is
+    # the default backend of every session.
+
+    def connect(self, database, delete_db=False, bulk_load=False):
+        conn = create_connection(database, delete_db, bulk_load)
+        if conn is not None:
+            _CONNECTION_BACKENDS[conn] = self
+        return conn
+
+    def close(self, conn, check_bulk_load=False):
+        try:
+            if check_bulk_load:
+                end_bulk_load(conn)
+            elif conn in _PRAGMAS_BEFORE_BULK_LOAD:
+                # Unwinding from a failed load: drop its open transaction but still restore the journal mode
+                conn.rollback()
+                end_bulk_load(conn, check_foreign_keys=False)
+        finally:
+            conn.close()
+
+    def create_table(self, conn, create_table_sql, drop_table_name=None):
+        if drop_table_name: # You can optionally pass drop_table_name to drop the table. 
+            try:
+                c = conn.cursor()
+                c.execute("""DROP TABLE IF EXISTS %s""" % (drop_table_name))
+            except Error as e:
+                print(e)
+
+        try:
+            c = conn.cursor()
+            c.execute(create_table_sql)
+        except Error as e:
+            print(e)
+
+    def transaction(self, conn):
+        return conn
+
+    def insert_rows(self, conn, table, columns, rows):
+        sql_statement = "insert into %s(%s) values(%s);" % (table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        return conn.executemany(sql_statement, rows).rowcount
+
+    def database_name(self, conn):
+        return conn.execute("PRAGMA database_list").fetchone()[2] or id(conn)
+
+    def table_version(self, conn, table):
+        return table_version(conn, table)
+
+
+def copy_text(value):
+    # Inputs: Column value
+    # Output: The value in PostgreSQL's COPY text format
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class PostgresBackend:
+    # Stores the normalized tables in PostgreSQL through psycopg 3, which is only imported when a
+    # connection is opened and is not needed otherwise.
+    # Usage:
+    #     with NormalizationSession('dbname=sales', backend=PostgresBackend()) as session:
+    #         normalize('data.csv', 'dbname=sales', session=session)
+    # Rows are streamed with COPY ... FROM STDIN in text format and sent to the server every
+    # copy_buffer_size characters, so a table is never held in memory on either side; the
+    # batch_size of insert_orderdetail_table() becomes one COPY per batch. The connection runs in
+    # autocommit mode, so each insert_* helper commits on its own as with SQLite. IDs match the
+    # SQLite backend's. Steps 1-11 and normalize() run on this backend; load_incremental(), the
+    # sales summary tables and the ex reports use SQLite syntax and stay SQLite-only.
+    # connection_factory replaces psycopg.connect, e.g. to pass extra connection options.
+
+    def __init__(self, copy_buffer_size=COPY_BUFFER_SIZE, connection_factory=None):
+        self.copy_buffer_size = copy_buffer_size
+        self.connection_factory = connection_factory
+
+    def connect(self, dsn, delete_db=False, bulk_load=False):
+        # With bulk_load=True commits do not wait for the WAL flush; a crash can lose the last
+        # transactions but not corrupt the database.
+        connection_factory = self.connection_factory
+        if connection_factory is None:
+            import psycopg
+            connection_factory = psycopg.connect
+
+        conn = connection_factory(dsn, autocommit=True)
+        if delete_db:
+            conn.execute("drop table if exists %s cascade;" % ', '.join(NORMALIZED_TABLES))
+        if bulk_load:
+            conn.execute("set synchronous_commit = off;")
+        _CONNECTION_BACKENDS[conn] = self
+        return conn
+
+    def close(self, conn, check_bulk_load=False):
+        # Foreign keys are enforced per row, so there is nothing left to check
+        conn.close()
+
+    def translate_ddl(self, create_table_sql):
+        for sqlite_text, postgres_text in POSTGRES_DDL_REPLACEMENTS:
+            create_table_sql = create_table_sql.replace(sqlite_text, postgres_text)
+        return create_table_sql
+
+    def create_table(self, conn, create_table_sql, drop_table_name=None):
+        if drop_table_name:
+            conn.execute("drop table if exists %s cascade;" % drop_table_name)
+        conn.execute(self.translate_ddl(create_table_sql))
+
+    def transaction(self, conn):
+        return conn.transaction()
+
+    def insert_rows(self, conn, table, columns, rows):
+        sql_statement = "copy %s (%s) from stdin" % (table, ', '.join(columns))
+        count = 0
+        with conn.cursor() as cur, cur.copy(sql_statement) as copy:
+            buffer = []
+            buffered = 0
+            for row in rows:
+                line = '\t'.join([copy_text(v) for v in row]) + '\n'
+                buffer.append(line)
+                buffered += len(line)
+                count += 1
+                if buffered >= self.copy_buffer_size:
+                    copy.write(''.join(buffer))
+                    buffer = []
+                    buffered = 0
+            if buffer:
+                copy.write(''.join(buffer))
+        return count
+
+    def database_name(self, conn):
+        return conn.info.dsn
+
+    def table_version(self, conn, table):
+        # IDs only grow, so the row count and largest ID change whenever rows are added
+        return tuple(conn.execute("select count(*), max(%sID) from %s;" % (table, table)).fetchone())
+
+
+SQLITE_BACKEND = SQLiteBackend()
+
+# Connection -> backend that opened it, filled in by the backends' connect(). Keyed by instance, so
+# two sessions whose backends differ only in their settings each keep their own.
+_CONNECTION_BACKENDS = weakref.WeakKeyDictionary()
+
+# Connection type -> backend handling connections no backend opened (e.g. from sqlite3.connect)
+_BACKENDS = {sqlite3.Connection: SQLITE_BACKEND}
+
+
+def register_backend(connection_type, backend):
+    # Inputs: Connection class; backend for connections of that class
     # Output: None
-    
-    ### BEGIN SOLUTION
+    _BACKENDS[connection_type] = backend
 
-    conn_norm = create_connection(normalized_database_filename)
 
-    regions = set()
+def backend_for(conn):
+    # Inputs: Connection to the normalized database
+    # Output: The backend that opened the connection, else the one registered for its type (or one
+    #         of its base classes)
+
+    try:
+        return _CONNECTION_BACKENDS[conn]
+    except (KeyError, TypeError):
+        pass  # not opened by a backend, or not weakly referenceable like sqlite3.Connection
+    for connection_type in type(conn).__mro__:
+        if connection_type in _BACKENDS:
+            return _BACKENDS[connection_type]
+    if type(conn).__module__.split('.')[0] == 'psycopg':
+        register_backend(type(conn), PostgresBackend())
+        return _BACKENDS[type(conn)]
+    raise TypeError("No storage backend registered for %s" % type(conn).__name__)
+
+
+### Instrumentation
+
+# The PipelineProfiler currently recording in this thread (or asyncio task), if any. The profile_*
+# helpers below are no-ops without one, so the steps pay nothing for the hooks unless a profile is
+# being taken. Being a context variable, a profiler never sees the steps of another thread, such as
+# the reader and writer threads of ingest.IngestionService.
+_ACTIVE_PROFILER = contextvars.ContextVar('active_profiler', default=None)
+
+PROFILE_PHASES = ('parse', 'lookup', 'insert')
+
+PROFILE_COLUMNS = ['step', 'parent', 'rows_parsed', 'distinct_keys', 'rows_inserted', 'parse_seconds', 'lookup_seconds',
+                   'insert_seconds', 'total_seconds', 'statements', 'peak_memory_mb']
+
+
+class PipelineProfiler:
+    # Records, for every step run while it is active, the rows parsed, distinct keys found, rows
+    # inserted, time spent parsing / looking up IDs / inserting, SQLite statements executed and
+    # (with trace_memory=True) peak traced memory.
+    # Usage:
+    #     with PipelineProfiler(callback=log.info) as profiler:
+    #         normalize('data.csv', 'normalized.db')
+    #     print(profiler.summary())
+    # Each finished step record (a dict) is appended to records and passed to callback. Steps run
+    # by another step (step2 inside step3, ...) get their own record naming the parent; phase
+    # times, statements and rows always count towards the innermost step only. Statements are
+    # counted with a trace callback, so an executemany counts once per row. Only steps run by the
+    # thread that entered the profiler are recorded; a thread profiles its steps with its own.
+
+    def __init__(self, trace_memory=False, callback=None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.records = []
+        self._steps = []
+        self._phases = []
+        self._connections = []
+        self._token = None
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        self._token = _ACTIVE_PROFILER.set(self)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _ACTIVE_PROFILER.reset(self._token)
+        self._token = None
+        for conn in self._connections:
+            try:
+                conn.set_trace_callback(None)
+            except sqlite3.ProgrammingError:
+                pass  # already closed
+        self._connections = []
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def trace(self, conn):
+        # Count the statements conn executes from now until the profiler exits (SQLite connections only)
+        if isinstance(conn, sqlite3.Connection) and all(conn is not c for c in self._connections):
+            conn.set_trace_callback(self._count_statement)
+            self._connections.append(conn)
+
+    def _count_statement(self, statement):
+        if self._steps:
+            self._steps[-1]['statements'] += 1
+
+    def count(self, field, n):
+        if self._steps:
+            self._steps[-1][field] += n
+
+    def start_step(self, name):
+        record = {'step': name, 'parent': self._steps[-1]['step'] if self._steps else None,
+                  'rows_parsed': 0, 'distinct_keys': 0, 'rows_inserted': 0, 'statements': 0,
+                  'error': None}
+        for phase in PROFILE_PHASES:
+            record[phase + '_seconds'] = 0.0
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._steps:
+                self._steps[-1]['_peak'] = max(self._steps[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            record['_start_memory'] = current
+            record['_peak'] = current
+        record['_started'] = time.perf_counter()
+        self._steps.append(record)
+        return record
+
+    def end_step(self, record, error=None):
+        record['total_seconds'] = time.perf_counter() - record.pop('_started')
+        self._steps.pop()
+        if error is not None:
+            record['error'] = repr(error)
+        if self.trace_memory:
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_memory_mb'] = (peak - record.pop('_start_memory')) / 1024 ** 2
+            if self._steps:
+                self._steps[-1]['_peak'] = max(self._steps[-1]['_peak'], peak)
+        else:
+            record['peak_memory_mb'] = None
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def start_phase(self, phase):
+        # Phases are exclusive: the enclosing phase's clock stops while a nested one runs
+        now = time.perf_counter()
+        if self._phases:
+            self._add_phase_time(now)
+        self._phases.append([phase, now, self._steps[-1] if self._steps else None])
+
+    def end_phase(self):
+        now = time.perf_counter()
+        self._add_phase_time(now)
+        self._phases.pop()
+        if self._phases:
+            self._phases[-1][1] = now
+
+    def _add_phase_time(self, now):
+        phase, started, record = self._phases[-1]
+        if record is not None:
+            record[phase + '_seconds'] += now - started
+
+    def summary(self):
+        # Output: The step records as a fixed-width text table, one line per step
+        rows = [PROFILE_COLUMNS]
+        for record in self.records:
+            row = []
+            for column in PROFILE_COLUMNS:
+                value = record[column]
+                if value is None:
+                    row.append('-')
+                elif isinstance(value, float):
+                    row.append('%.3f' % value)
+                else:
+                    row.append(str(value))
+            if record['error']:
+                row[0] += ' (failed)'
+            rows.append(row)
+        widths = [max(len(row[i]) for row in rows) for i in range(len(PROFILE_COLUMNS))]
+        return '\n'.join('  '.join(cell.rjust(width) if i else cell.ljust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths)))
+                         for row in rows)
+
+
+@contextmanager
+def profile_step(name):
+    # Inputs: Step name
+    # Output: None; records the enclosed block as one step of the active profiler
+
+    profiler = _ACTIVE_PROFILER.get()
+    if profiler is None:
+        yield
+        return
+    record = profiler.start_step(name)
+    try:
+        yield
+    except BaseException as e:
+        profiler.end_step(record, e)
+        raise
+    profiler.end_step(record)
+
+
+@contextmanager
+def profile_phase(phase):
+    # Inputs: One of PROFILE_PHASES
+    # Output: None; charges the time spent in the enclosed block to that phase of the current step
+
+    profiler = _ACTIVE_PROFILER.get()
+    if profiler is None:
+        yield
+        return
+    profiler.start_phase(phase)
+    try:
+        yield
+    finally:
+        profiler.end_phase()
+
+
+def profile_count(field, n):
+    # Inputs: Step record field ('rows_parsed', 'distinct_keys' or 'rows_inserted'); amount to add
+    # Output: None
+
+    profiler = _ACTIVE_PROFILER.get()
+    if profiler is not None:
+        profiler.count(field, n)
+
+
+def profile_rows(rows, phase='parse'):
+    # Inputs: Iterable of parsed rows; phase charged for producing them
+    # Output: The rows, counted as rows_parsed when a profiler is active. Time spent producing each
+    #         row is charged to phase even when the rows are consumed lazily inside an insert.
+
+    profiler = _ACTIVE_PROFILER.get()
+    if profiler is None:
+        return rows
+    return _profiled_rows(profiler, rows, phase)
+
+
+def _profiled_rows(profiler, rows, phase):
+    rows = iter(rows)
+    while True:
+        profiler.start_phase(phase)
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        finally:
+            profiler.end_phase()
+        profiler.count('rows_parsed', 1)
+        yield row
+
+
+### ID Lookup Cache
+
+# Per dimension table: query loading every key -> ID pair, and query resolving a single key.
+# Rows are read in ID order so a repeated key maps to its last ID, as the step 2/4/6/8/10
+# dictionaries always have.
+DIMENSION_KEY_QUERIES = {
+    'Region': ("select Region, RegionID from Region order by RegionID;",
+               "select RegionID from Region where Region = ? order by RegionID desc limit 1;"),
+    'Country': ("select Country, CountryID from Country order by CountryID;",
+                "select CountryID from Country where Country = ? order by CountryID desc limit 1;"),
+    'Customer': ("select FirstName || ' ' || LastName, CustomerID from Customer order by CustomerID;",
+                 "select CustomerID from Customer where FirstName || ' ' || LastName = ? order by CustomerID desc limit 1;"),
+    'ProductCategory': ("select ProductCategory, ProductCategoryID from ProductCategory order by ProductCategoryID;",
+                        "select ProductCategoryID from ProductCategory where ProductCategory = ? order by ProductCategoryID desc limit 1;"),
+    'Product': ("select ProductName, ProductID from Product order by ProductID;",
+                "select ProductID from Product where ProductName = ? order by ProductID desc limit 1;"),
+}
+
+
+class DatabaseVersion:
+    # State of a SQLite database as seen through one connection. The file part is the identity,
+    # size and modification time of the database file and its WAL, which every commit by any
+    # connection changes, as does deleting and recreating the file. Two versions taken through the
+    # same connection must also agree on its total_changes (its own writes, committed or not) and
+    # PRAGMA data_version (commits by other connections). Versions taken through different
+    # connections compare by the file part alone, so a dictionary loaded by one step's connection
+    # is reused by the next step's.
+
+    def __init__(self, conn):
+        database = conn.execute("PRAGMA database_list").fetchone()[2]
+        self.files = tuple(_file_identity(f) for f in (database, database + '-wal')) if database else None
+        self.conn_id = id(conn)
+        self.changes = (conn.total_changes, conn.execute("PRAGMA data_version").fetchone()[0])
+
+    def __eq__(self, other):
+        if not isinstance(other, DatabaseVersion):
+            return NotImplemented
+        if self.files != other.files or (self.files is None and self.conn_id != other.conn_id):
+            return False
+        return self.conn_id != other.conn_id or self.changes == other.changes
+
+
+def _file_identity(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+
+
+def table_version(conn, table):
+    # Inputs: Connection; dimension table name
+    # Output: Token that changes when the table may have changed: any write to the database
+    #         (insert, update, delete, schema change) or a new file at the same path counts
+
+    return DatabaseVersion(conn)
+
+
+class KeyToIdLRU:
+    # Bounded key -> ID mapping for very large dimension tables. Holds at most maxsize keys and
+    # resolves a miss with a single keyed query on conn, which must stay open while it is used.
+
+    def __init__(self, conn, table, maxsize):
+        self.conn = conn
+        self.maxsize = maxsize
+        self._sql = DIMENSION_KEY_QUERIES[table][1]
+        self._ids = OrderedDict()
+
+    def __getitem__(self, key):
+        try:
+            self._ids.move_to_end(key)
+            return self._ids[key]
+        except KeyError:
+            pass
+
+        row = self.conn.execute(self._sql, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self._ids[key] = row[0]
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return row[0]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class KeyToIdCache:
+    # Caches the key -> ID lookups of the dimension tables per database file, so repeated calls
+    # to the step 2/4/6/8/10 dictionaries (and ex1/ex2) read a table once instead of on every
+    # call. An entry is reloaded when table_version() changes. Full tables are handed out as
+    # read-only mappings, since every caller shares them. With maxsize set, tables are not
+    # loaded in full; a KeyToIdLRU of that size is handed out instead.
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._entries = {}
+
+    def lookup(self, conn, table):
+        # Inputs: Connection to the normalized database; dimension table name
+        # Output: Read-only key -> ID mapping (or KeyToIdLRU bound to conn)
+
+        backend = backend_for(conn)
+        database = backend.database_name(conn)
+        version = backend.table_version(conn, table)
+        entry = self._entries.get((database, table))
+        if entry is not None and entry[0] == version and (self.maxsize is None or entry[1].conn is conn):
+            return entry[1]
+
+        if self.maxsize is None:
+            mapping = MappingProxyType(dict(execute_sql_statement(DIMENSION_KEY_QUERIES[table][0], conn)))
+        else:
+            mapping = KeyToIdLRU(conn, table, self.maxsize)
+        self._entries[(database, table)] = (version, mapping)
+        return mapping
+
+    def invalidate(self):
+        self._entries.clear()
+
+
+ID_CACHE = KeyToIdCache()
+
+
+### Parsing and Loading
+
+CREATE_REGION_TABLE_SQL = "create table if not exists Region (RegionID integer primary key not null, Region text not null);"
+
+CREATE_COUNTRY_TABLE_SQL = "create table if not exists Country (CountryID integer primary key not null, Country text not null, RegionID integer not null, foreign key(RegionID) references Region(RegionID));"
+
+CREATE_CUSTOMER_TABLE_SQL = "create table if not exists Customer (CustomerID integer primary key not null, FirstName text not null, LastName text not null, Address text not null, City text not null, CountryID integer not null, foreign key(CountryID) references Country(CountryID));"
+
+CREATE_PRODUCTCATEGORY_TABLE_SQL = "create table if not exists ProductCategory (ProductCategoryID integer primary key not null, ProductCategory text not null, ProductCategoryDescription text not null);"
+
+CREATE_PRODUCT_TABLE_SQL = "create table if not exists Product (ProductID integer primary key not null, ProductName text not null, ProductUnitPrice real not null, ProductCategoryID integer not null, foreign key(ProductCategoryID) references ProductCategory(ProductCategoryID));"
+
+CREATE_ORDERDETAIL_TABLE_SQL = '''create table if not exists OrderDetail (
+            OrderID integer primary key not null, 
+            CustomerID inetger not null, 
+            ProductID integer not null, 
+            OrderDate text not null, 
+            QuantityOrdered integer not null, 
+            foreign key(CustomerID) references Customer(CustomerID), 
+            foreign key(ProductID) references Product(ProductID));'''
+
+# Date dimension: one row per distinct OrderDate with its calendar keys precomputed. DateID is the
+# day number (datetime.date.toordinal()), so subtracting two DateIDs gives the days between them.
+# DayOfWeek counts from Sunday = 0, as strftime('%w') does.
+CREATE_DATE_TABLE_SQL = "create table if not exists Date (DateID integer primary key not null, Date text not null unique, Year integer not null, Quarter integer not null, Month integer not null, DayOfWeek integer not null);"
+
+# DateID of an OrderDetail row, the Date dimension key of its OrderDate (julianday() is the day
+# number plus 1721424.5). OrderDetail keeps the five columns checked against step11.csv, so the
+# foreign key is this expression rather than a stored column; idx_orderdetail_dateid_customer_product_quantity
+# indexes it, and queries that spell it exactly the same way group on the indexed integer.
+ORDERDETAIL_DATEID_SQL = "cast(julianday(OrderDate) - 1721424.5 as integer)"
+
+# Records every file appended with load_incremental() so the same delta is never loaded twice.
+CREATE_LOADHISTORY_TABLE_SQL = "create table if not exists LoadHistory (LoadID integer primary key not null, FileName text not null, Digest text not null unique, OrderDetailRows integer not null, LoadedAt text not null);"
+
+# Indexes on the foreign key and date columns used by the ex1-ex11 queries. They are created once
+# the tables are loaded, which is much cheaper than maintaining them row by row during the insert.
+INDEX_SQL = [
+    "create index if not exists idx_orderdetail_customerid on OrderDetail(CustomerID);",
+    "create index if not exists idx_orderdetail_productid on OrderDetail(ProductID);",
+    "create index if not exists idx_orderdetail_orderdate on OrderDetail(OrderDate);",
+    "create index if not exists idx_customer_countryid on Customer(CountryID);",
+    "create index if not exists idx_country_regionid on Country(RegionID);",
+]
+
+# Covering indexes holding every OrderDetail column the aggregate queries read, so ex3-ex5 scan
+# the index instead of the table and the date-bucketed reports group straight from it by DateID.
+# The DateID expression uses SQLite's julianday(), so these are SQLite only.
+COVERING_INDEX_SQL = [
+    "create index if not exists idx_orderdetail_customer_product_quantity on OrderDetail(CustomerID, ProductID, QuantityOrdered);",
+    "create index if not exists idx_orderdetail_dateid_customer_product_quantity on OrderDetail(%s, CustomerID, ProductID, QuantityOrdered, OrderDate);" % ORDERDETAIL_DATEID_SQL,
+]
+
+# Number of OrderDetail rows handed to each executemany call when streaming.
+ORDERDETAIL_BATCH_SIZE = 50000
+
+# OrderDetail columns written by the loaders; OrderID is assigned by the database
+ORDERDETAIL_COLUMNS = ['CustomerID', 'ProductID', 'OrderDate', 'QuantityOrdered']
+
+
+class OrderDateConverter:
+    # Converts YYYYMMDD OrderDate tokens to YYYY-MM-DD. Each distinct token is validated once and
+    # memoized (a data file holds a few thousand distinct dates against hundreds of thousands of
+    # order lines); conversion is plain string slicing. Malformed tokens convert to None and are
+    # counted in invalid so a load can report them all at the end instead of failing midway.
+
+    def __init__(self):
+        self._formatted = {}
+        self.invalid = Counter()
+
+    def __call__(self, token):
+        try:
+            formatted = self._formatted[token]
+        except KeyError:
+            formatted = self._formatted[token] = self._convert(token)
+
+        if formatted is None:
+            self.invalid[token] += 1
+        return formatted
+
+    @staticmethod
+    def _convert(token):
+        if len(token) != 8 or not token.isdigit():
+            return None
+        try:
+            datetime.date(int(token[:4]), int(token[4:6]), int(token[6:]))
+        except ValueError:
+            return None
+        return token[:4] + '-' + token[4:6] + '-' + token[6:]
+
+    def dates(self):
+        # Output: Set of the valid dates converted so far, as YYYY-MM-DD
+        return {formatted for formatted in self._formatted.values() if formatted is not None}
+
+    def report(self):
+        # Prints the malformed tokens skipped during the load, if any
+        if self.invalid:
+            print("Skipped %d order lines with malformed OrderDate: %s" % (
+                sum(self.invalid.values()), ', '.join(repr(t) for t in sorted(self.invalid))))
+
+
+# Semicolon-packed order line columns 5-10 of the data file, in file order
+ORDER_LINE_COLUMNS = ('ProductName', 'ProductCategory', 'ProductCategoryDescription', 'ProductUnitPrice',
+                      'QuantityOrdered', 'OrderDate')
+
+
+class OrderLineExploder:
+    # Explode stage shared by steps 7, 9 and 11. Called with columns 5-10 of a line, it checks that
+    # the six semicolon-packed lists have the same length and returns one record per order line
+    # holding the requested ORDER_LINE_COLUMNS (all of them by default), typed: ProductUnitPrice
+    # as a float, QuantityOrdered as an int and OrderDate converted by format_date (None when
+    # malformed). Only the requested lists are split and converted. A line whose lists differ
+    # in length is exploded up to the shortest one, as before, but counted in mismatched (by
+    # list lengths) so report() can list it at the end of the load.
+
+    def __init__(self, format_date=None):
+        self.format_date = format_date if format_date is not None else OrderDateConverter()
+        self.mismatched = Counter()
+        self._converters = {'ProductUnitPrice': float, 'QuantityOrdered': int, 'OrderDate': self.format_date}
+        self._plans = {}
+
+    def __call__(self, fields, columns=ORDER_LINE_COLUMNS):
+        # Inputs: Columns 5-10 of a tokenized line; names of the record fields wanted
+        # Output: Iterator of tuples with the requested fields of each order line
+        return zip(*self.lists(fields, columns))
+
+    def lists(self, fields, columns=ORDER_LINE_COLUMNS):
+        # Inputs: Columns 5-10 of a tokenized line; names of the record fields wanted
+        # Output: List holding the typed list of values of each requested field
+
+        try:
+            plan = self._plans[columns]
+        except KeyError:
+            plan = self._plans[columns] = [(ORDER_LINE_COLUMNS.index(c), self._converters.get(c)) for c in columns]
+
+        separators = [field.count(';') for field in fields]
+        if separators.count(separators[0]) != len(separators):
+            self.mismatched[tuple(n + 1 for n in separators)] += 1
+        return [fields[i].split(';') if convert is None else list(map(convert, fields[i].split(';')))
+                for i, convert in plan]
+
+    def report(self):
+        # Prints the lines whose semicolon-packed columns disagree in length, if any
+        if self.mismatched:
+            print("Truncated %d lines whose semicolon-packed columns have different lengths: %s" % (
+                sum(self.mismatched.values()), ', '.join(str(lengths) for lengths in sorted(self.mismatched))))
+
+
+def explode_order_details(line, exploder):
+    # Inputs: Tokenized line of the data file; OrderLineExploder
+    # Output: Iterator of (CustomerName, ProductName, OrderDate, QuantityOrdered) order lines,
+    #         skipping lines whose OrderDate is malformed
+
+    names, dates, quantities = exploder.lists(line[5:11], ('ProductName', 'OrderDate', 'QuantityOrdered'))
+    order_details = zip(repeat(line[0]), names, dates, quantities)
+    if None in dates:
+        return (i for i in order_details if i[2] is not None)
+    return order_details
+
+
+def iter_order_details(data_filename, format_date, exploder=None):
+    # Inputs: Name of the data file; OrderDateConverter; OrderLineExploder using format_date (a new
+    #         one if not given)
+    # Output: Generator of (CustomerName, ProductName, OrderDate, QuantityOrdered) order lines,
+    #         holding only one input line in memory at a time
+
+    if exploder is None:
+        exploder = OrderLineExploder(format_date)
     with open(data_filename) as f:
         next(f)
         for line in f:
             line = line.strip()
             if not line:
                 continue
-                
-            line = line.split('\t')
-            
-            region = line[4]
-            regions.add(region)
-            sorted_regions = sorted(list(regions))
-
-    create_region_query = "create table if not exists Region (RegionID integer primary key not null, Region text not null);"
-    create_table(conn_norm, create_region_query)
-
-    def insert_region(conn_norm, values):
-        sql_statement = "insert into Region(Region) values(?);"
-        cur = conn_norm.cursor()
-        cur.executemany(sql_statement, [(v,) for v in values])
-        return cur.lastrowid
-    
+
+            yield from explode_order_details(line.split('\t'), exploder)
+
+
+def iter_order_lines(data_filename, exploder, columns=ORDER_LINE_COLUMNS):
+    # Inputs: Name of the data file; OrderLineExploder; names of the record fields wanted
+    # Output: Generator of the exploded order line records of every line; profile_rows() counts the lines
+
+    for fields in profile_rows(iter_columns(data_filename, (5, 6, 7, 8, 9, 10))):
+        yield from exploder(fields, columns)
+
+
+def iter_columns(data_filename, columns):
+    # Inputs: Name of the data file; indexes of the tab-separated columns to extract
+    # Output: Generator of tuples holding the requested columns (in the order requested) of every
+    #         non-blank line after the header
+    # The file is memory-mapped and scanned as bytes: only the requested fields are sliced out and
+    # decoded, and the rest of each line (e.g. the long semicolon-packed product columns when only
+    # Region is needed) is skipped with a single newline search. As with line.strip(), leading
+    # whitespace of the first column and trailing whitespace of the last one are dropped.
+
+    columns = tuple(columns)
+    last = max(columns)
+    wanted = set(columns)
+    encoding = locale.getpreferredencoding(False)
+
+    with open(data_filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            find = mm.find
+            size = len(mm)
+            pos = find(b'\n') + 1 or size
+            while pos < size:
+                eol = find(b'\n', pos)
+                if eol < 0:
+                    eol = size
+                # Skip blank lines; probing a short prefix first avoids copying long lines
+                if not mm[pos:min(eol, pos + 64)].strip() and not mm[pos:eol].strip():
+                    pos = eol + 1
+                    continue
+
+                fields = [None] * (last + 1)
+                start = pos
+                for i in range(last + 1):
+                    tab = find(b'\t', start, eol)
+                    if tab < 0:
+                        if i < last:
+                            raise ValueError("line at byte %d has %d columns, expected at least %d" % (pos, i + 1, last + 1))
+                        tab = eol
+                    if i in wanted:
+                        field = mm[start:tab]
+                        if i == 0:
+                            field = field.lstrip()
+                        if tab == eol:
+                            field = field.rstrip()
+                        fields[i] = field.decode(encoding)
+                    start = tab + 1
+
+                yield tuple(fields[i] for i in columns)
+                pos = eol + 1
+
+
+class OrderDetailColumns:
+    # Order lines held as parallel array('i') columns instead of one tuple of four strings each:
+    # customer and product are codes into the customers / products dictionaries (name -> code, in
+    # first-seen order), OrderDate is a proleptic Gregorian day number and QuantityOrdered an int.
+    # That is 16 bytes per order line plus the distinct names and dates. Iterating yields the usual
+    # (CustomerName, ProductName, OrderDate, QuantityOrdered) tuples; rows() resolves the codes to
+    # CustomerID / ProductID once per distinct name and feeds executemany directly.
+
+    def __init__(self):
+        self.customer_codes = array('i')
+        self.product_codes = array('i')
+        self.order_days = array('i')
+        self.quantities = array('i')
+        self.customers = {}
+        self.products = {}
+        self.day_numbers = {}
+
+    def __len__(self):
+        return len(self.quantities)
+
+    def append_line(self, line, exploder):
+        # Inputs: Tokenized line of the data file; OrderLineExploder
+        # Output: None; appends the line's order lines, skipping those whose OrderDate is malformed
+
+        names, dates, quantities = exploder.lists(line[5:11], ('ProductName', 'OrderDate', 'QuantityOrdered'))
+        self.append_order_lines(line[0], names, dates, quantities)
+
+    def append_order_lines(self, customer_name, names, dates, quantities):
+        # Inputs: CustomerName; parallel ProductName, OrderDate and QuantityOrdered lists of one line,
+        #         as exploded by OrderLineExploder
+        # Output: None; appends the order lines, skipping those whose OrderDate is None
+
+        customer = self.customers.setdefault(customer_name, len(self.customers))
+        products = self.products
+        day_numbers = self.day_numbers
+        for product, order_date, quantity in zip(names, dates, quantities):
+            if order_date is None:
+                continue
+            try:
+                day = day_numbers[order_date]
+            except KeyError:
+                day = day_numbers[order_date] = datetime.date.fromisoformat(order_date).toordinal()
+            self.customer_codes.append(customer)
+            self.product_codes.append(products.setdefault(product, len(products)))
+            self.order_days.append(day)
+            self.quantities.append(quantity)
+
+    def extend(self, other):
+        # Inputs: Another OrderDetailColumns (e.g. from a parse shard), appended after this one's rows
+        # Output: None
+
+        customer_codes = [self.customers.setdefault(name, len(self.customers)) for name in other.customers]
+        product_codes = [self.products.setdefault(name, len(self.products)) for name in other.products]
+        self.customer_codes.extend(customer_codes[c] for c in other.customer_codes)
+        self.product_codes.extend(product_codes[p] for p in other.product_codes)
+        self.order_days.extend(other.order_days)
+        self.quantities.extend(other.quantities)
+        self.day_numbers.update(other.day_numbers)
+
+    def rows(self, customer_to_customerid_dict, product_to_productid_dict):
+        # Inputs: CustomerName -> CustomerID; ProductName -> ProductID
+        # Output: Generator of (CustomerID, ProductID, OrderDate, QuantityOrdered) OrderDetail rows
+
+        customer_ids = [customer_to_customerid_dict[name] for name in self.customers]
+        product_ids = [product_to_productid_dict[name] for name in self.products]
+        dates = {day: order_date for order_date, day in self.day_numbers.items()}
+        return ((customer_ids[c], product_ids[p], dates[d], q)
+                for c, p, d, q in zip(self.customer_codes, self.product_codes, self.order_days, self.quantities))
+
+    def __eq__(self, other):
+        if not isinstance(other, OrderDetailColumns):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __iter__(self):
+        customers = list(self.customers)
+        products = list(self.products)
+        dates = {day: order_date for order_date, day in self.day_numbers.items()}
+        return ((customers[c], products[p], dates[d], q)
+                for c, p, d, q in zip(self.customer_codes, self.product_codes, self.order_days, self.quantities))
+
+
+class CustomerBuilder:
+    # Collects the distinct Customer rows as (FirstName, LastName, Address, City, Country) tuples.
+    # Lines are deduplicated on their raw (Name, Address, City, Country) key before anything else,
+    # so a repeated customer costs one dict probe and the name is only split for new keys. The
+    # strings kept are interned, so a City or Country shared by many customers is stored once and
+    # memory grows with the distinct customers, not the input rows.
+
+    def __init__(self):
+        self._customers = {}
+
+    def __len__(self):
+        return len(self._customers)
+
+    def add(self, name, address, city, country):
+        key = (name, address, city, country)
+        if key not in self._customers:
+            key = tuple(map(sys.intern, key))
+            name_parts = name.strip().split(' ')
+            self._customers[key] = (sys.intern(name_parts[0]), sys.intern(' '.join(name_parts[1:])), key[1], key[2], key[3])
+
+    def update(self, keys):
+        # Inputs: Iterable of (Name, Address, City, Country) tuples
+        # The keys are deduplicated by a set first, which does the per-row work in C
+        add = self.add
+        for name, address, city, country in set(keys):
+            add(name, address, city, country)
+
+    def customers(self):
+        # Output: Set of the distinct (FirstName, LastName, Address, City, Country) tuples
+        return set(self._customers.values())
+
+
+def parse_lines(lines, include_order_details=True, format_date=None, exploder=None):
+    # Inputs: Iterable of raw data file lines (without the header); whether to collect the exploded
+    #         order lines for OrderDetail; OrderDateConverter for the order lines (a new one if not
+    #         given); OrderLineExploder (built on format_date if not given)
+    # Output: Dictionary with the distinct keys of every dimension table and the order lines (as
+    #         OrderDetailColumns), built by tokenizing each line exactly once. The product columns
+    #         go through the same explode stage as steps 7, 9 and 11, so the keys (e.g. prices as
+    #         floats) and the mismatch counts agree with theirs.
+
+    regions = set()
+    country_region = set()
+    customer_keys = set()
+    prodcat_data = set()
+    prod_data = set()
+    order_details = OrderDetailColumns()
+    if exploder is None:
+        exploder = OrderLineExploder(format_date)
+    format_date = exploder.format_date
+    if include_order_details:
+        columns = ORDER_LINE_COLUMNS
+    else:
+        columns = ('ProductName', 'ProductCategory', 'ProductCategoryDescription', 'ProductUnitPrice')
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        line = line.split('\t')
+
+        country = line[3]
+        region = line[4]
+        regions.add(region)
+        country_region.add((country, region))
+        customer_keys.add((line[0], line[1], line[2], country))
+
+        exploded = exploder.lists(line[5:11], columns)
+        prod_names, prod_categories, prod_descriptions, prod_unitprices = exploded[:4]
+        prodcat_data.update(zip(prod_categories, prod_descriptions))
+        prod_data.update(zip(prod_names, prod_unitprices, prod_categories))
+
+        if include_order_details:
+            order_details.append_order_lines(line[0], prod_names, exploded[5], exploded[4])
+
+    customers = CustomerBuilder()
+    customers.update(customer_keys)
+
+    return {
+        'regions': regions,
+        'country_region': country_region,
+        'customers': customers.customers(),
+        'product_categories': prodcat_data,
+        'products': prod_data,
+        'order_details': order_details,
+        'invalid_dates': format_date.invalid,
+        'mismatched_lines': exploder.mismatched,
+    }
+
+
+def shard_byte_ranges(data_filename, shards):
+    # Inputs: Name of the data file; number of shards
+    # Output: List of (start, end) byte offsets covering every line after the header, each range
+    #         starting and ending on a line boundary
+
+    size = os.path.getsize(data_filename)
+    with open(data_filename, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+        offsets = [data_start]
+        for i in range(1, shards):
+            f.seek(max(data_start + (size - data_start) * i // shards - 1, offsets[-1]))
+            f.readline()
+            offsets.append(min(f.tell(), size))
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def iter_byte_range(data_filename, start, end):
+    # Inputs: Name of the data file; byte range [start, end) starting and ending on line boundaries
+    # Output: Generator of the decoded lines in the range
+
+    encoding = locale.getpreferredencoding(False)
+    with open(data_filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        for line in f:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            yield line.decode(encoding)
+
+
+def _parse_shard(data_filename, start, end, include_order_details):
+    # Worker for parse_data_file(workers=N): parses the lines in bytes [start, end)
+    return parse_lines(iter_byte_range(data_filename, start, end), include_order_details)
+
+
+def parse_data_file(data_filename, include_order_details=True, format_date=None, workers=None, exploder=None):
+    # Inputs: Name of the data file; whether to collect the exploded order lines for OrderDetail;
+    #         OrderDateConverter for the order lines (a new one if not given); number of worker
+    #         processes (None or 1 parses in this process); OrderLineExploder collecting the
+    #         mismatched lines (built on format_date if not given)
+    # Output: Dictionary with the distinct keys of every dimension table and the order lines,
+    #         built by tokenizing each line of the file exactly once
+    # With workers > 1 the file is split into newline-aligned byte ranges parsed in a process pool.
+    # The partial key sets are merged by union and the order lines appended in shard order, so
+    # the result (and therefore every ID assigned from it) is identical to a serial parse.
+
+    if exploder is None:
+        exploder = OrderLineExploder(format_date)
+    format_date = exploder.format_date
+
+    if not workers or workers <= 1:
+        with open(data_filename) as f:
+            next(f)
+            return parse_lines(f, include_order_details, format_date, exploder)
+
+    ranges = shard_byte_ranges(data_filename, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shards = list(executor.map(_parse_shard, repeat(data_filename), [r[0] for r in ranges],
+                                   [r[1] for r in ranges], repeat(include_order_details)))
+
+    parsed = parse_lines([], include_order_details, format_date, exploder)
+    for shard in shards:
+        for key in ('regions', 'country_region', 'customers', 'product_categories', 'products'):
+            parsed[key].update(shard[key])
+        parsed['order_details'].extend(shard['order_details'])
+        format_date.invalid.update(shard['invalid_dates'])
+        exploder.mismatched.update(shard['mismatched_lines'])
+    return parsed
+
+
+def insert_region_table(conn_norm, regions):
+    # Inputs: Connection to the normalized database; distinct region names
+    # Output: None
+
+    create_table(conn_norm, CREATE_REGION_TABLE_SQL)
+
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'Region', ['Region'], [(v,) for v in sorted(regions)]))
+
+
+def insert_country_table(conn_norm, country_region, region_to_regionid_dict):
+    # Inputs: Connection to the normalized database; distinct (Country, Region) pairs; Region -> RegionID
+    # Output: None
+
+    country_regionid = []
+    for i in sorted(country_region):
+        if i[1] in region_to_regionid_dict:
+            country_regionid.append((i[0], region_to_regionid_dict[i[1]]))
+
+    create_table(conn_norm, CREATE_COUNTRY_TABLE_SQL)
+
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'Country', ['Country', 'RegionID'], country_regionid))
+
+
+def insert_customer_table(conn_norm, customers, country_to_countryid_dict):
+    # Inputs: Connection to the normalized database; distinct (FirstName, LastName, Address, City, Country)
+    #         tuples; Country -> CountryID
+    # Output: None
+
+    customer_table_output = []
+    for i in sorted(customers):
+        if i[4] in country_to_countryid_dict:
+            customer_table_output.append((i[0], i[1], i[2], i[3], country_to_countryid_dict[i[4]]))
+
+    create_table(conn_norm, CREATE_CUSTOMER_TABLE_SQL)
+
+    columns = ['FirstName', 'LastName', 'Address', 'City', 'CountryID']
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'Customer', columns, customer_table_output))
+
+
+def insert_productcategory_table(conn_norm, prodcat_data):
+    # Inputs: Connection to the normalized database; distinct (ProductCategory, ProductCategoryDescription) pairs
+    # Output: None
+
+    create_table(conn_norm, CREATE_PRODUCTCATEGORY_TABLE_SQL)
+
+    columns = ['ProductCategory', 'ProductCategoryDescription']
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'ProductCategory', columns, sorted(prodcat_data)))
+
+
+def insert_product_table(conn_norm, prod_data, prodcat_to_prodcatid_dict):
+    # Inputs: Connection to the normalized database; distinct (ProductName, ProductUnitPrice, ProductCategory)
+    #         tuples; ProductCategory -> ProductCategoryID
+    # Output: None
+
+    prod_table_output = []
+    for i in sorted(prod_data):
+        if i[2] in prodcat_to_prodcatid_dict:
+            prod_table_output.append((i[0], i[1], prodcat_to_prodcatid_dict[i[2]]))
+
+    create_table(conn_norm, CREATE_PRODUCT_TABLE_SQL)
+
+    columns = ['ProductName', 'ProductUnitPrice', 'ProductCategoryID']
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'Product', columns, prod_table_output))
+
+
+def insert_orderdetail_table(conn_norm, order_details, customer_to_customerid_dict, product_to_productid_dict,
+                             batch_size=None):
+    # Inputs: Connection to the normalized database; OrderDetailColumns or iterable of (CustomerName,
+    #         ProductName, OrderDate, QuantityOrdered) order lines; CustomerName -> CustomerID;
+    #         ProductName -> ProductID; optional number of rows per insert_rows call
+    # Output: None
+    # IDs are resolved lazily, so a generator of order lines is never materialized in full.
+
+    if isinstance(order_details, OrderDetailColumns):
+        orddet_rows = order_details.rows(customer_to_customerid_dict, product_to_productid_dict)
+    else:
+        orddet_rows = (
+            (customer_to_customerid_dict[i[0]], product_to_productid_dict[i[1]], i[2], int(i[3]))
+            for i in order_details
+        )
+
+    create_table(conn_norm, CREATE_ORDERDETAIL_TABLE_SQL)
+
+    with profile_phase('insert'), transaction(conn_norm):
+        if batch_size:
+            batch = list(islice(orddet_rows, batch_size))
+            while batch:
+                profile_count('rows_inserted', insert_rows(conn_norm, 'OrderDetail', ORDERDETAIL_COLUMNS, batch))
+                batch = list(islice(orddet_rows, batch_size))
+        else:
+            profile_count('rows_inserted', insert_rows(conn_norm, 'OrderDetail', ORDERDETAIL_COLUMNS, orddet_rows))
+
+
+def insert_date_table(conn_norm, dates):
+    # Inputs: Connection to the normalized database; distinct OrderDate values (YYYY-MM-DD)
+    # Output: None; adds the dates that are not in the Date table yet
+
+    create_table(conn_norm, CREATE_DATE_TABLE_SQL)
+
+    existing = {row[0] for row in execute_sql_statement("select Date from Date;", conn_norm)}
+    date_rows = []
+    for order_date in sorted(set(dates) - existing):
+        day = datetime.date.fromisoformat(order_date)
+        date_rows.append((day.toordinal(), order_date, day.year, (day.month + 2) // 3, day.month, day.isoweekday() % 7))
+
+    columns = ['DateID', 'Date', 'Year', 'Quarter', 'Month', 'DayOfWeek']
+    with profile_phase('insert'), transaction(conn_norm):
+        profile_count('rows_inserted', insert_rows(conn_norm, 'Date', columns, date_rows))
+
+
+def has_date_table(conn):
+    # Inputs: Connection to the normalized database
+    # Output: True if the Date dimension exists
+
+    sql_query = "select count(*) from sqlite_master where type = 'table' and name = 'Date';"
+    return execute_sql_statement(sql_query, conn)[0][0] == 1
+
+
+def create_indexes(conn_norm, covering_indexes=False):
+    # Inputs: Connection to the normalized database; whether to add COVERING_INDEX_SQL
+    # Output: None
+
+    with transaction(conn_norm):
+        for sql_statement in INDEX_SQL + (COVERING_INDEX_SQL if covering_indexes else []):
+            conn_norm.execute(sql_statement)
+
+
+### Partitioned OrderDetail Writers
+
+# SQLITE_LIMIT_ATTACHED when the sqlite3 module cannot report it
+DEFAULT_ATTACHED_LIMIT = 10
+
+
+def _write_partition(data_filename, start, end, partition_filename, customer_to_customerid_dict,
+                     product_to_productid_dict):
+    # Worker for insert_orderdetail_partitioned(): loads the order lines in bytes [start, end) into
+    # the OrderDetail table of a new SQLite file
+    # Output: (number of rows written, set of OrderDates, Counter of malformed OrderDate tokens,
+    #          Counter of lines whose semicolon-packed columns have different lengths)
+
+    exploder = OrderLineExploder()
+    order_details = OrderDetailColumns()
+    for line in iter_byte_range(data_filename, start, end):
+        line = line.strip()
+        if line:
+            order_details.append_line(line.split('\t'), exploder)
+
+    conn = create_connection(partition_filename, delete_db=True)
+    # A scratch file removed after the merge, so the previous PRAGMAs need not be kept for end_bulk_load
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+    try:
+        create_table(conn, CREATE_ORDERDETAIL_TABLE_SQL)
+        with conn:
+            insert_rows(conn, 'OrderDetail', ORDERDETAIL_COLUMNS,
+                        order_details.rows(customer_to_customerid_dict, product_to_productid_dict))
+    finally:
+        conn.close()
+    return len(order_details), set(order_details.day_numbers), exploder.format_date.invalid, exploder.mismatched
+
+
+def merge_partitions(conn_norm, partition_filenames):
+    # Inputs: Connection to the normalized database; SQLite files holding OrderDetail partitions, in
+    #         input order
+    # Output: Number of rows merged
+    # The partitions are attached and appended to OrderDetail in one transaction, each in its own
+    # OrderID order, so OrderIDs follow the input order. SQLite attaches at most
+    # SQLITE_LIMIT_ATTACHED databases at once.
+
+    names = ['partition%d' % i for i in range(len(partition_filenames))]
+    conn_norm.commit()
+    try:
+        for name, partition_filename in zip(names, partition_filenames):
+            conn_norm.execute("attach database ? as %s;" % name, (partition_filename,))
+
+        rows_merged = 0
+        with conn_norm:
+            for name in names:
+                rows_merged += conn_norm.execute(
+                    "insert into OrderDetail(CustomerID, ProductID, OrderDate, QuantityOrdered) select CustomerID, ProductID, OrderDate, QuantityOrdered from %s.OrderDetail order by OrderID;" % name).rowcount
+    finally:
+        for name in names:
+            if name in [row[1] for row in conn_norm.execute("PRAGMA database_list")]:
+                conn_norm.execute("detach database %s;" % name)
+    return rows_merged
+
+
+def attached_database_limit(conn):
+    # Inputs: Connection to a SQLite database
+    # Output: Maximum number of databases that can be attached to it
+    # Connection.getlimit() only exists from Python 3.11; older versions get SQLite's default of 10.
+
+    if hasattr(conn, 'getlimit'):
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    return DEFAULT_ATTACHED_LIMIT
+
+
+def insert_orderdetail_partitioned(conn_norm, data_filename, normalized_database_filename, customer_to_customerid_dict,
+                                   product_to_productid_dict, writers, exploder=None):
+    # Inputs: Connection to the normalized database; name of the data and normalized database filename;
+    #         CustomerName -> CustomerID; ProductName -> ProductID; number of writer processes;
+    #         OrderLineExploder collecting the malformed dates and mismatched lines found by the writers
+    # Output: Set of the OrderDates loaded
+    # The data file is split into newline-aligned byte ranges, one per writer. Each writer process
+    # parses its range and inserts it into a partition file of its own, so parsing, ID resolution
+    # and inserting run on all cores; merge_partitions() then appends the partitions to OrderDetail.
+    # Partition files are written next to the normalized database and removed afterwards.
+    # SQLite only.
+
+    writers = min(writers, attached_database_limit(conn_norm))
+    ranges = shard_byte_ranges(data_filename, writers)
+    partition_directory = tempfile.mkdtemp(prefix='orderdetail-', dir=os.path.dirname(os.path.abspath(normalized_database_filename)))
+    partition_filenames = [os.path.join(partition_directory, 'partition%d.db' % i) for i in range(len(ranges))]
+
+    create_table(conn_norm, CREATE_ORDERDETAIL_TABLE_SQL)
+    try:
+        with profile_phase('parse'), ProcessPoolExecutor(max_workers=writers) as executor:
+            results = list(executor.map(_write_partition, repeat(data_filename), [r[0] for r in ranges],
+                                        [r[1] for r in ranges], partition_filenames,
+                                        repeat(dict(customer_to_customerid_dict)), repeat(dict(product_to_productid_dict))))
+        profile_count('rows_parsed', sum(result[0] for result in results))
+
+        with profile_phase('insert'):
+            profile_count('rows_inserted', merge_partitions(conn_norm, partition_filenames))
+    finally:
+        shutil.rmtree(partition_directory, ignore_errors=True)
+
+    dates = set()
+    for _, partition_dates, invalid, mismatched in results:
+        dates.update(partition_dates)
+        if exploder is not None:
+            exploder.format_date.invalid.update(invalid)
+            exploder.mismatched.update(mismatched)
+    return dates
+
+
+### Sales Summary Tables
+
+# Running sales totals per customer, country and region behind ex3/ex4/ex5. They are built with one
+# aggregate per table after OrderDetail is loaded, then kept current by SALES_SUMMARY_TRIGGER_SQL
+# as OrderDetail rows are inserted, deleted or updated. Totals are stored unrounded; LineCount
+# counts the OrderDetail rows behind each total so a key whose last row is deleted drops out,
+# as it does from the join.
+SALES_SUMMARY_TABLES = ['CustomerSales', 'CountrySales', 'RegionSales']
+
+SALES_SUMMARY_TABLE_SQL = [
+    "create table if not exists CustomerSales (CustomerID integer primary key not null, Total real not null, LineCount integer not null, foreign key(CustomerID) references Customer(CustomerID));",
+    "create table if not exists CountrySales (CountryID integer primary key not null, Total real not null, LineCount integer not null, foreign key(CountryID) references Country(CountryID));",
+    "create table if not exists RegionSales (RegionID integer primary key not null, Total real not null, LineCount integer not null, foreign key(RegionID) references Region(RegionID));",
+]
+
+SALES_SUMMARY_REFRESH_SQL = [
+    "delete from CustomerSales;",
+    "delete from CountrySales;",
+    "delete from RegionSales;",
+    """insert into CustomerSales(CustomerID, Total, LineCount)
+    select OrderDetail.CustomerID, sum(ProductUnitPrice * QuantityOrdered), count(*) from OrderDetail
+    INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by OrderDetail.CustomerID;""",
+    """insert into CountrySales(CountryID, Total, LineCount)
+    select Customer.CountryID, sum(ProductUnitPrice * QuantityOrdered), count(*) from OrderDetail
+    INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID
+    INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Customer.CountryID;""",
+    """insert into RegionSales(RegionID, Total, LineCount)
+    select Country.RegionID, sum(ProductUnitPrice * QuantityOrdered), count(*) from OrderDetail
+    INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID
+    INNER JOIN Country ON Country.CountryID = Customer.CountryID
+    INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Country.RegionID;""",
+]
+
+# Body that adds one OrderDetail row ({row} is new or old) to the totals with the given sign (1 or -1)
+# and removes keys left without rows.
+SALES_SUMMARY_APPLY_SQL = """
+    insert into CustomerSales(CustomerID, Total, LineCount)
+    values ({row}.CustomerID, {sign} * (select ProductUnitPrice from Product where ProductID = {row}.ProductID) * {row}.QuantityOrdered, {sign})
+    on conflict(CustomerID) do update set Total = Total + excluded.Total, LineCount = LineCount + excluded.LineCount;
+
+    insert into CountrySales(CountryID, Total, LineCount)
+    values ((select CountryID from Customer where CustomerID = {row}.CustomerID),
+            {sign} * (select ProductUnitPrice from Product where ProductID = {row}.ProductID) * {row}.QuantityOrdered, {sign})
+    on conflict(CountryID) do update set Total = Total + excluded.Total, LineCount = LineCount + excluded.LineCount;
+
+    insert into RegionSales(RegionID, Total, LineCount)
+    values ((select Country.RegionID from Customer INNER JOIN Country ON Country.CountryID = Customer.CountryID where Customer.CustomerID = {row}.CustomerID),
+            {sign} * (select ProductUnitPrice from Product where ProductID = {row}.ProductID) * {row}.QuantityOrdered, {sign})
+    on conflict(RegionID) do update set Total = Total + excluded.Total, LineCount = LineCount + excluded.LineCount;
+
+    delete from CustomerSales where LineCount = 0;
+    delete from CountrySales where LineCount = 0;
+    delete from RegionSales where LineCount = 0;
+"""
+
+SALES_SUMMARY_TRIGGERS = ['trg_orderdetail_sales', 'trg_orderdetail_sales_delete', 'trg_orderdetail_sales_update']
+
+SALES_SUMMARY_TRIGGER_SQL = [
+    "create trigger if not exists trg_orderdetail_sales after insert on OrderDetail\nbegin" +
+    SALES_SUMMARY_APPLY_SQL.format(row='new', sign=1) + "end;",
+    "create trigger if not exists trg_orderdetail_sales_delete after delete on OrderDetail\nbegin" +
+    SALES_SUMMARY_APPLY_SQL.format(row='old', sign=-1) + "end;",
+    "create trigger if not exists trg_orderdetail_sales_update after update of CustomerID, ProductID, QuantityOrdered on OrderDetail\nbegin" +
+    SALES_SUMMARY_APPLY_SQL.format(row='old', sign=-1) + SALES_SUMMARY_APPLY_SQL.format(row='new', sign=1) + "end;",
+]
+
+# Summary-table equivalents of ex3, ex4 and ex5, with the same columns and ordering.
+SALES_SUMMARY_QUERIES = {
+    'ex3': """select FirstName || ' ' || LastName as Name, round(sum(Total), 2) as Total from CustomerSales INNER JOIN Customer ON Customer.CustomerID = CustomerSales.CustomerID group by Name order by Total desc;""",
+    'ex4': """select Region, round(Total, 2) as Total from RegionSales INNER JOIN Region ON Region.RegionID = RegionSales.RegionID order by Total desc;""",
+    'ex5': """select Country, round(Total) as CountryTotal from CountrySales INNER JOIN Country ON Country.CountryID = CountrySales.CountryID order by CountryTotal desc;""",
+}
+
+
+def create_sales_summary_tables(conn_norm):
+    # Inputs: Connection to the normalized database with OrderDetail loaded
+    # Output: None; (re)builds CustomerSales, CountrySales and RegionSales and installs the trigger
+    #         that keeps them current
+
     with conn_norm:
-        insert_region(conn_norm, sorted_regions)
+        for sql_statement in SALES_SUMMARY_TABLE_SQL + SALES_SUMMARY_REFRESH_SQL + SALES_SUMMARY_TRIGGER_SQL:
+            conn_norm.execute(sql_statement)
 
-    ### END SOLUTION
 
-def step2_create_region_to_regionid_dictionary(normalized_database_filename):
-    
+def drop_sales_summary_trigger(conn_norm):
+    # Inputs: Connection to the normalized database
+    # Output: None; stops per-row summary maintenance ahead of a bulk insert that is followed by
+    #         create_sales_summary_tables()
+
+    with conn_norm:
+        for trigger in SALES_SUMMARY_TRIGGERS:
+            conn_norm.execute("drop trigger if exists %s;" % trigger)
+
+
+def has_sales_summary_tables(conn):
+    # Inputs: Connection to the normalized database
+    # Output: True if the summary tables and their maintenance triggers exist
+
+    sql_query = "select count(*) from sqlite_master where (type = 'table' and name in (%s)) or (type = 'trigger' and name in (%s));" % (
+        ', '.join("'%s'" % table for table in SALES_SUMMARY_TABLES), ', '.join("'%s'" % trigger for trigger in SALES_SUMMARY_TRIGGERS))
+    return execute_sql_statement(sql_query, conn)[0][0] == len(SALES_SUMMARY_TABLES) + len(SALES_SUMMARY_TRIGGERS)
+
+
+def step1_create_region_table(data_filename, normalized_database_filename, session=None):
+    # Inputs: Name of the data and normalized database filename; optional NormalizationSession
+    # Output: None
     
     ### BEGIN SOLUTION
 
-    conn_norm = create_connection(normalized_database_filename)
+    with profile_step('step1'):
+        with profile_phase('parse'):
+            regions = {line[0] for line in profile_rows(iter_columns(data_filename, (4,)))}
+        profile_count('distinct_keys', len(regions))
+        with session_scope(normalized_database_filename, session) as session:
+            insert_region_table(session.connection, regions)
 
-    sql_query = "select RegionID, Region from Region;"
-    region_data = execute_sql_statement(sql_query, conn_norm)
+    ### END SOLUTION
+
+def step2_create_region_to_regionid_dictionary(normalized_database_filename, session=None):
+    
+    
+    ### BEGIN SOLUTION
 
-    region_to_regionid_dict = {}
-    keys = []
-    values = []
-    for each_ele in region_data:
-        keys = each_ele[1]
-        values = each_ele[0]
-        region_to_regionid_dict[keys] = values
+    with profile_step('step2'), session_scope(normalized_database_filename, session) as session:
+        with profile_phase('lookup'):
+            region_to_regionid_dict = session.id_cache.lookup(session.connection, 'Region')
+        profile_count('distinct_keys', len(region_to_regionid_dict))
 
-    return region_to_regionid_dict    
+    return region_to_regionid_dict
 
     ### END SOLUTION
 
 
-def step3_create_country_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+def step3_create_country_table(data_filename, normalized_database_filename, session=None):
+    # Inputs: Name of the data and normalized database filename; optional NormalizationSession
     # Output: None
     
     ### BEGIN SOLUTION
     
-    conn_norm = create_connection(normalized_database_filename)
-
-    countries = []
-    regions = []
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            country = line[3]
-            region = line[4]
-            countries.append(country)
-            regions.append(region)
-            
-            country_region = sorted(set(zip(countries, regions)))
-
-        region_data = step2_create_region_to_regionid_dictionary(normalized_database_filename)
-        
-        region_id = []
-        country_regionid = []
-        for i in country_region:
-            if i[1] in region_data.keys():
-                region_id = region_data[i[1]]
-                country_regionid.append((i[0], region_id))
-
-    create_country_query = "create table if not exists Country (CountryID integer primary key not null, Country text not null, RegionID integer not null, foreign key(RegionID) references Region(RegionID));"
-    create_table(conn_norm, create_country_query)
-
-    def insert_country(conn_norm, values):
-        sql_statement = "insert into Country(Country, RegionID) values(?, ?);"
-        cur = conn_norm.cursor()
-        cur.executemany(sql_statement, values)
-        return cur.lastrowid
-    
-    with conn_norm:
-        insert_country(conn_norm, country_regionid)
+    with profile_step('step3'):
+        with profile_phase('parse'):
+            country_region = set(profile_rows(iter_columns(data_filename, (3, 4))))
+        profile_count('distinct_keys', len(country_region))
+        with session_scope(normalized_database_filename, session) as session:
+            region_data = step2_create_region_to_regionid_dictionary(normalized_database_filename, session)
+            insert_country_table(session.connection, country_region, region_data)
          
     ### END SOLUTION
 
 
-def step4_create_country_to_countryid_dictionary(normalized_database_filename):
+def step4_create_country_to_countryid_dictionary(normalized_database_filename, session=None):
     
     
     ### BEGIN SOLUTION
-    
-    conn_norm = create_connection(normalized_database_filename)
-
-    sql_query = "select CountryID, Country from Country;"
-    region_data = execute_sql_statement(sql_query, conn_norm)
 
-    country_to_countryid_dict = {}
-    keys = []
-    values = []
-    for each_ele in region_data:
-        keys = each_ele[1]
-        values = each_ele[0]
-        country_to_countryid_dict[keys] = values
+    with profile_step('step4'), session_scope(normalized_database_filename, session) as session:
+        with profile_phase('lookup'):
+            country_to_countryid_dict = session.id_cache.lookup(session.connection, 'Country')
+        profile_count('distinct_keys', len(country_to_countryid_dict))
 
-    return country_to_countryid_dict  
+    return country_to_countryid_dict
 
     ### END SOLUTION
         
         
-def step5_create_customer_table(data_filename, normalized_database_filename):
+def step5_create_customer_table(data_filename, normalized_database_filename, session=None):
 
     ### BEGIN SOLUTION
     
-    conn_norm = create_connection(normalized_database_filename)
-
-    first_names = []
-    last_names = []
-    addresses = []
-    cities = []
-    countries = []
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            name = line[0]
-            first_name = name.strip().split(' ')[0]
-            last_name = ' '.join(name.strip().split(' ')[1:])
-            address = line[1]
-            city = line[2]
-            country = line[3]
-            first_names.append(first_name)
-            last_names.append(last_name)
-            addresses.append(address)
-            cities.append(city)
-            countries.append(country)
-            
-            table_data = sorted(set(zip(first_names, last_names, addresses, cities, countries)))
-
-        country_data = step4_create_country_to_countryid_dictionary(normalized_database_filename)
-        
-        country_id = []
-        customer_table_output = []
-        for i in table_data:
-            if i[4] in country_data.keys():
-                country_id = country_data[i[4]]
-                customer_table_output.append((i[0], i[1], i[2], i[3], country_id))
-
-    create_customer_query = "create table if not exists Customer (CustomerID integer primary key not null, FirstName text not null, LastName text not null, Address text not null, City text not null, CountryID integer not null, foreign key(CountryID) references Country(CountryID));"
-    create_table(conn_norm, create_customer_query)
-
-    def insert_customer(conn_norm, values):
-        sql_statement = "insert into Customer(FirstName, LastName, Address, City, CountryID) values(?, ?, ?, ?, ?);"
-        cur = conn_norm.cursor()
-        cur.executemany(sql_statement, values)
-        return cur.lastrowid
-    
-    with conn_norm:
-        insert_customer(conn_norm, customer_table_output)
+    with profile_step('step5'):
+        with profile_phase('parse'):
+            customers = CustomerBuilder()
+            customers.update(profile_rows(iter_columns(data_filename, (0, 1, 2, 3))))
+        profile_count('distinct_keys', len(customers))
+        with session_scope(normalized_database_filename, session) as session:
+            country_data = step4_create_country_to_countryid_dictionary(normalized_database_filename, session)
+            insert_customer_table(session.connection, customers.customers(), country_data)
 
     ### END SOLUTION
 
 
-def step6_create_customer_to_customerid_dictionary(normalized_database_filename):
+def step6_create_customer_to_customerid_dictionary(normalized_database_filename, session=None):
     
     
     ### BEGIN SOLUTION
-    
-    conn_norm = create_connection(normalized_database_filename)
-
-    sql_query = "select FirstName, LastName, CustomerID from Customer;"
-    customer_data = execute_sql_statement(sql_query, conn_norm)
 
-    customer_to_customerid_dict = {}
-    keys = []
-    values = []
-    for each_ele in customer_data:
-        keys = each_ele[0] + ' ' + each_ele[1]
-        values = each_ele[2]
-        customer_to_customerid_dict[keys] = values
+    with profile_step('step6'), session_scope(normalized_database_filename, session) as session:
+        with profile_phase('lookup'):
+            customer_to_customerid_dict = session.id_cache.lookup(session.connection, 'Customer')
+        profile_count('distinct_keys', len(customer_to_customerid_dict))
 
     return customer_to_customerid_dict
 
     ### END SOLUTION
         
-def step7_create_productcategory_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+def step7_create_productcategory_table(data_filename, normalized_database_filename, session=None):
+    # Inputs: Name of the data and normalized database filename; optional NormalizationSession
     # Output: None
 
     
     ### BEGIN SOLUTION
     
-    conn_norm = create_connection(normalized_database_filename)
-
-    prod_categories = []
-    prod_description = []
-    
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            prod_categories = line[6].split(';')
-            prod_description = line[7].split(';')
-            
-        prodcat_data = sorted(set(zip(prod_categories, prod_description)))
-
-    create_prodcust_query = "create table if not exists ProductCategory (ProductCategoryID integer primary key not null, ProductCategory text not null, ProductCategoryDescription text not null);"
-    create_table(conn_norm, create_prodcust_query)
-
-    def insert_productcategory(conn_norm, values):
-        sql_statement = "insert into ProductCategory(ProductCategory, ProductCategoryDescription) values(?, ?);"
-        cur = conn_norm.cursor()
-        cur.executemany(sql_statement, values)
-        return cur.lastrowid
-    
-    with conn_norm:
-        insert_productcategory(conn_norm, prodcat_data)
+    with profile_step('step7'):
+        with profile_phase('parse'):
+            exploder = OrderLineExploder()
+            prodcat_data = set(iter_order_lines(data_filename, exploder, ('ProductCategory', 'ProductCategoryDescription')))
+        exploder.report()
+        profile_count('distinct_keys', len(prodcat_data))
+        with session_scope(normalized_database_filename, session) as session:
+            insert_productcategory_table(session.connection, prodcat_data)
    
     ### END SOLUTION
 
-def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename):
+def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, session=None):
     
     
     ### BEGIN SOLUTION
-    conn_norm = create_connection(normalized_database_filename)
 
-    sql_query = "select ProductCategoryID, ProductCategory from ProductCategory;"
-    prodcat_data = execute_sql_statement(sql_query, conn_norm)
-
-    prodcat_to_prodcatid_dict = {}
-    keys = []
-    values = []
-    for each_ele in prodcat_data:
-        keys = each_ele[1]
-        values = each_ele[0]
-        prodcat_to_prodcatid_dict[keys] = values
+    with profile_step('step8'), session_scope(normalized_database_filename, session) as session:
+        with profile_phase('lookup'):
+            prodcat_to_prodcatid_dict = session.id_cache.lookup(session.connection, 'ProductCategory')
+        profile_count('distinct_keys', len(prodcat_to_prodcatid_dict))
 
     return prodcat_to_prodcatid_dict
 
-
     ### END SOLUTION
         
 
-def step9_create_product_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+def step9_create_product_table(data_filename, normalized_database_filename, session=None):
+    # Inputs: Name of the data and normalized database filename; optional NormalizationSession
     # Output: None
 
     
     ### BEGIN SOLUTION
     
-    conn_norm = create_connection(normalized_database_filename)
-
-    prod_cat = []
-    prod_names = []
-    prod_unitprices = []
-    
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            prod_names = line[5].split(';')
-            prod_unitprices = line[8].split(';')
-            prod_categories = line[6].split(';')
-            
-            prod_data = sorted(set(zip(prod_names, prod_unitprices, prod_categories)))
-        prodcat_data = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename)
-#         print(prod_data)
-        
-        prodcat_id = []
-        prod_table_output = []
-        for i in prod_data:
-            if i[2] in prodcat_data.keys():
-                prodcat_id = prodcat_data[i[2]]
-                prod_table_output.append((i[0], i[1], prodcat_id))
-
-    create_product_query = "create table if not exists Product (ProductID integer primary key not null, ProductName text not null, ProductUnitPrice real not null, ProductCategoryID integer not null, foreign key(ProductCategoryID) references ProductCategory(ProductCategoryID));"
-    create_table(conn_norm, create_product_query)
-
-    def insert_product(conn_norm, values):
-        sql_statement = "insert into Product(ProductName,ProductUnitPrice,ProductCategoryID) values(?, ?, ?);"
-        cur = conn_norm.cursor()
-        cur.executemany(sql_statement, values)
-        return cur.lastrowid
-    
-    with conn_norm:
-        insert_product(conn_norm, prod_table_output)
+    with profile_step('step9'):
+        with profile_phase('parse'):
+            exploder = OrderLineExploder()
+            prod_data = set(iter_order_lines(data_filename, exploder, ('ProductName', 'ProductUnitPrice', 'ProductCategory')))
+        exploder.report()
+        profile_count('distinct_keys', len(prod_data))
+        with session_scope(normalized_database_filename, session) as session:
+            prodcat_data = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, session)
+            insert_product_table(session.connection, prod_data, prodcat_data)
    
     ### END SOLUTION
 
 
-def step10_create_product_to_productid_dictionary(normalized_database_filename):
+def step10_create_product_to_productid_dictionary(normalized_database_filename, session=None):
     
     ### BEGIN SOLUTION
-    conn_norm = create_connection(normalized_database_filename)
 
-    sql_query = "select ProductID, ProductName from Product;"
-    prod_data = execute_sql_statement(sql_query, conn_norm)
-
-    product_to_productid_dict = {}
-    keys = []
-    values = []
-    for each_ele in prod_data:
-        keys = each_ele[1]
-        values = each_ele[0]
-        product_to_productid_dict[keys] = values
+    with profile_step('step10'), session_scope(normalized_database_filename, session) as session:
+        with profile_phase('lookup'):
+            product_to_productid_dict = session.id_cache.lookup(session.connection, 'Product')
+        profile_count('distinct_keys', len(product_to_productid_dict))
 
     return product_to_productid_dict
 
     ### END SOLUTION
         
 
-def step11_create_orderdetail_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+def step11_create_orderdetail_table(data_filename, normalized_database_filename, batch_size=ORDERDETAIL_BATCH_SIZE,
+                                    session=None, covering_indexes=False, sales_summary=False, writers=None):
+    # Inputs: Name of the data and normalized database filename; number of rows per executemany call;
+    #         optional NormalizationSession; whether to also build the covering indexes; whether to
+    #         materialize the sales summary tables; number of writer processes (None or 1 inserts
+    #         from this process, more writes partitions in parallel, see insert_orderdetail_partitioned)
     # Output: None
 
     
     ### BEGIN SOLUTION
-    conn_norm = create_connection(normalized_database_filename)   
-    data = []
+    with profile_step('step11'), session_scope(normalized_database_filename, session) as session:
+        prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename, session)
+        cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename, session)
+        format_date = OrderDateConverter()
+        exploder = OrderLineExploder(format_date)
+        if sales_summary:
+            drop_sales_summary_trigger(session.connection)
+        if writers and writers > 1:
+            dates = insert_orderdetail_partitioned(session.connection, data_filename, normalized_database_filename,
+                                                   cust_data, prod_data, writers, exploder)
+        else:
+            insert_orderdetail_table(session.connection,
+                                     profile_rows(iter_order_details(data_filename, format_date, exploder)),
+                                     cust_data, prod_data, batch_size)
+            dates = format_date.dates()
+        format_date.report()
+        exploder.report()
+        insert_date_table(session.connection, dates)
+        with profile_phase('insert'):
+            create_indexes(session.connection, covering_indexes)
+            if sales_summary:
+                create_sales_summary_tables(session.connection)
+    ### END SOLUTION
 
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            quantities_ordered = line[9].split(';')
-            order_date = line[10].split(';')
-            formatted_date = []
-            for i in order_date:
-                i = datetime.datetime.strptime(i, '%Y%m%d').strftime('%Y-%m-%d')
-                formatted_date.append(i)
-            product = line[5].split(';')
-            customer_name = [line[0]]*len(formatted_date)
-
-            orddet_data = list(zip(customer_name, product, formatted_date, quantities_ordered))
-            for i in orddet_data:
-                data.append(i)
-        orddet_data = data
-        prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename)
-        cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename)
-        
-        orddet_table_output = []
-        for i in orddet_data:
-            cust_id = cust_data[i[0]]
-            prod_id = prod_data[i[1]]
-            orddet_table_output.append((cust_id, prod_id, i[2], int(i[3])))
-        
-        create_orddet_query = '''create table if not exists OrderDetail (
-            OrderID integer primary key not null, 
-            CustomerID inetger not null, 
-            ProductID integer not null, 
-            OrderDate integer not null, 
-            QuantityOrdered integer not null, 
-            foreign key(CustomerID) references Customer(CustomerID), 
-            foreign key(ProductID) references Product(ProductID));'''
-        create_table(conn_norm, create_orddet_query)
 
-        def insert_product(conn_norm, values):
-            sql_statement = "insert into OrderDetail(CustomerID, ProductID, OrderDate, QuantityOrdered) values(?, ?, ?, ?);"
-            cur = conn_norm.cursor()
-            cur.executemany(sql_statement, values)
-            return cur.lastrowid
-        
-        with conn_norm:
-            insert_product(conn_norm, orddet_table_output)
-    ### END SOLUTION
+def normalize(data_filename, normalized_database_filename, session=None, bulk_load=False, workers=None,
+              covering_indexes=False, sales_summary=False, writers=None):
+    # Inputs: Name of the data and normalized database filename; optional NormalizationSession;
+    #         whether to load with BULK_LOAD_PRAGMAS (ignored when a session is passed); number of
+    #         parsing processes; whether to also build the covering indexes; whether to materialize
+    #         the sales summary tables; number of OrderDetail writer processes
+    # Output: None
+    # Builds all six tables (steps 1-11) from a single pass over the data file. With writers > 1
+    # the first pass only collects the dimension keys and OrderDetail is written by
+    # insert_orderdetail_partitioned(), which reads the file a second time in parallel.
+
+    partitioned = bool(writers and writers > 1)
+    with profile_step('normalize'):
+        format_date = OrderDateConverter()
+        exploder = OrderLineExploder(format_date)
+        with profile_phase('parse'):
+            parsed = parse_data_file(data_filename, not partitioned, format_date, workers, exploder)
+        if not partitioned:
+            format_date.report()
+        exploder.report()
+        profile_count('rows_parsed', len(parsed['order_details']))
+        profile_count('distinct_keys', sum(len(parsed[k]) for k in ['regions', 'country_region', 'customers',
+                                                                     'product_categories', 'products']))
+
+        with session_scope(normalized_database_filename, session, bulk_load) as session:
+            conn_norm = session.connection
+            insert_region_table(conn_norm, parsed['regions'])
+            insert_country_table(conn_norm, parsed['country_region'],
+                                 step2_create_region_to_regionid_dictionary(normalized_database_filename, session))
+            insert_customer_table(conn_norm, parsed['customers'],
+                                  step4_create_country_to_countryid_dictionary(normalized_database_filename, session))
+            insert_productcategory_table(conn_norm, parsed['product_categories'])
+            insert_product_table(conn_norm, parsed['products'],
+                                 step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, session))
+            cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename, session)
+            prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename, session)
+            if partitioned:
+                # The first pass already counted the mismatched lines; only the dates are collected here
+                dates = insert_orderdetail_partitioned(conn_norm, data_filename, normalized_database_filename,
+                                                       cust_data, prod_data, writers, OrderLineExploder(format_date))
+                format_date.report()
+            else:
+                insert_orderdetail_table(conn_norm, parsed['order_details'], cust_data, prod_data)
+                dates = parsed['order_details'].day_numbers
+            insert_date_table(conn_norm, dates)
+            with profile_phase('insert'):
+                create_indexes(conn_norm, covering_indexes)
+                if sales_summary:
+                    create_sales_summary_tables(conn_norm)
+
+
+### Incremental Loads
+
+def file_digest(data_filename):
+    # Inputs: Name of the data file
+    # Output: SHA-1 hex digest of the file contents
+
+    digest = hashlib.sha1()
+    with open(data_filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_incremental(data_filename, normalized_database_filename, session=None, parsed=None):
+    # Inputs: Name of a (delta) data file and the normalized database filename; optional NormalizationSession;
+    #         parse_data_file result for the file if the caller already parsed it
+    # Output: Number of OrderDetail rows appended; 0 if this file's contents were loaded before
+    # Appends a data file to an existing (or empty) normalized database. Dimension rows whose key
+    # (Region, Country, FirstName LastName, ProductCategory, ProductName) already exists keep their
+    # ID; only new keys are inserted, with IDs after the current maximum. The work done is
+    # proportional to the delta file plus the size of the dimension tables.
+
+    with profile_step('load_incremental'):
+        digest = file_digest(data_filename)
+
+        with session_scope(normalized_database_filename, session) as session:
+            conn_norm = session.connection
+            for sql_statement in [CREATE_REGION_TABLE_SQL, CREATE_COUNTRY_TABLE_SQL, CREATE_CUSTOMER_TABLE_SQL,
+                                  CREATE_PRODUCTCATEGORY_TABLE_SQL, CREATE_PRODUCT_TABLE_SQL,
+                                  CREATE_ORDERDETAIL_TABLE_SQL, CREATE_LOADHISTORY_TABLE_SQL]:
+                create_table(conn_norm, sql_statement)
+
+            if conn_norm.execute("select count(*) from LoadHistory where Digest = ?;", (digest,)).fetchone()[0]:
+                print("Skipped %s: already loaded" % data_filename)
+                return 0
+
+            if parsed is None:
+                exploder = OrderLineExploder()
+                with profile_phase('parse'):
+                    parsed = parse_data_file(data_filename, exploder=exploder)
+                exploder.format_date.report()
+                exploder.report()
+            profile_count('rows_parsed', len(parsed['order_details']))
+
+            region_ids = step2_create_region_to_regionid_dictionary(normalized_database_filename, session)
+            insert_region_table(conn_norm, {i for i in parsed['regions'] if i not in region_ids})
+
+            country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename, session)
+            insert_country_table(conn_norm, {i for i in parsed['country_region'] if i[0] not in country_ids},
+                                 step2_create_region_to_regionid_dictionary(normalized_database_filename, session))
+
+            customer_ids = step6_create_customer_to_customerid_dictionary(normalized_database_filename, session)
+            insert_customer_table(conn_norm, {i for i in parsed['customers'] if i[0] + ' ' + i[1] not in customer_ids},
+                                  step4_create_country_to_countryid_dictionary(normalized_database_filename, session))
+
+            prodcat_ids = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, session)
+            insert_productcategory_table(conn_norm, {i for i in parsed['product_categories'] if i[0] not in prodcat_ids})
+
+            product_ids = step10_create_product_to_productid_dictionary(normalized_database_filename, session)
+            insert_product_table(conn_norm, {i for i in parsed['products'] if i[0] not in product_ids},
+                                 step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, session))
+
+            insert_date_table(conn_norm, parsed['order_details'].day_numbers)
+
+            # Recorded in the same transaction as the OrderDetail rows, so a failed append can be retried
+            conn_norm.execute("insert into LoadHistory(FileName, Digest, OrderDetailRows, LoadedAt) values(?, ?, ?, datetime('now'));",
+                              (os.path.basename(data_filename), digest, len(parsed['order_details'])))
+            insert_orderdetail_table(conn_norm, parsed['order_details'],
+                                     step6_create_customer_to_customerid_dictionary(normalized_database_filename, session),
+                                     step10_create_product_to_productid_dictionary(normalized_database_filename, session))
+            with profile_phase('insert'):
+                create_indexes(conn_norm)
+
+    return len(parsed['order_details'])
+
+
+### Resumable Loads
+
+# Data file lines loaded into OrderDetail per committed chunk of load_resumable()
+CHECKPOINT_INTERVAL = 20000
+
+# One row per step of load_resumable(), plus a 'start' row written before any table is touched.
+# DataFile identifies the data file being loaded; for step11, ByteOffset is where the next unloaded
+# line starts and LastOrderID the last OrderID committed.
+CREATE_LOADCHECKPOINT_TABLE_SQL = "create table if not exists LoadCheckpoint (Step text primary key not null, DataFile text not null, ByteOffset integer not null, LastOrderID integer not null, Completed integer not null, UpdatedAt text not null);"
+
+
+def file_signature(data_filename):
+    # Inputs: Name of the data file
+    # Output: String that changes when the file is replaced or modified, without reading its contents
+
+    stat = os.stat(data_filename)
+    return '%s:%d:%d' % (os.path.abspath(data_filename), stat.st_size, stat.st_mtime_ns)
+
+
+def save_checkpoint(conn_norm, step, signature, byte_offset, last_order_id, completed):
+    # Inputs: Connection to the normalized database; step name; file_signature() of the data file;
+    #         next byte offset to load; last OrderID committed; whether the step is finished
+    # Output: None; runs in the caller's transaction so the checkpoint commits with the rows it describes
+
+    conn_norm.execute("insert or replace into LoadCheckpoint(Step, DataFile, ByteOffset, LastOrderID, Completed, UpdatedAt) values(?, ?, ?, ?, ?, datetime('now'));",
+                      (step, signature, byte_offset, last_order_id, int(completed)))
+
+
+def iter_line_chunks(data_filename, start, lines_per_chunk):
+    # Inputs: Name of the data file; byte offset of a line start (None for the first line after the
+    #         header); number of lines per chunk
+    # Output: Generator of (end, lines): up to lines_per_chunk decoded lines and the byte offset
+    #         right after the last of them
+
+    encoding = locale.getpreferredencoding(False)
+    with open(data_filename, 'rb') as f:
+        if start is None:
+            start = len(f.readline())
+        f.seek(start)
+        while True:
+            lines = list(islice(f, lines_per_chunk))
+            if not lines:
+                break
+            start += sum(len(line) for line in lines)
+            yield start, [line.decode(encoding) for line in lines]
+
+
+def load_resumable(data_filename, normalized_database_filename, checkpoint_interval=CHECKPOINT_INTERVAL,
+                   session=None, covering_indexes=False, restart=False):
+    # Inputs: Name of the data and normalized database filename; data file lines per committed
+    #         OrderDetail chunk; optional NormalizationSession; whether to also build the covering
+    #         indexes; whether to drop the tables of a database holding no checkpoint for this file
+    # Output: Number of OrderDetail rows inserted by this call
+    # Builds the same tables as steps 1-11, recording progress in LoadCheckpoint. Each dimension
+    # step is marked done once its table is committed, and OrderDetail is committed every
+    # checkpoint_interval lines together with the byte offset reached. Running it again after a
+    # crash skips the finished steps, redoes an unfinished dimension step from scratch and resumes
+    # OrderDetail at the last committed offset, so only the unfinished work is repeated. A database
+    # holding tables but no checkpoint for this data file (the file changed, or it was built some
+    # other way) is left untouched unless restart is True, in which case its normalized tables and
+    # any sales summary tables are dropped and the load starts over. SQLite only, like
+    # load_incremental().
+
+    steps = [('step1', step1_create_region_table, 'Region'),
+             ('step3', step3_create_country_table, 'Country'),
+             ('step5', step5_create_customer_table, 'Customer'),
+             ('step7', step7_create_productcategory_table, 'ProductCategory'),
+             ('step9', step9_create_product_table, 'Product')]
+    rows_inserted = 0
+
+    with profile_step('load_resumable'):
+        signature = file_signature(data_filename)
+
+        with session_scope(normalized_database_filename, session) as session:
+            conn_norm = session.connection
+            create_table(conn_norm, CREATE_LOADCHECKPOINT_TABLE_SQL)
+            checkpoints = {row[0]: row[1:] for row in conn_norm.execute(
+                "select Step, ByteOffset, LastOrderID, Completed from LoadCheckpoint where DataFile = ?;", (signature,))}
+
+            if not checkpoints:
+                # The summary tables reference Customer, Country and Region, so they go first
+                tables = SALES_SUMMARY_TABLES + NORMALIZED_TABLES
+                existing = [row[0] for row in conn_norm.execute(
+                    "select name from sqlite_master where type = 'table' and name in (%s);" % ', '.join('?' * len(tables)),
+                    tables)]
+                started = conn_norm.execute("select count(*) from LoadCheckpoint;").fetchone()[0]
+                if (existing or started) and not restart:
+                    print("Skipped %s: %s holds no checkpoint for this file; pass restart=True to drop its tables and load it again"
+                          % (data_filename, normalized_database_filename))
+                    return 0
+                drop_sales_summary_trigger(conn_norm)
+                with conn_norm:
+                    conn_norm.execute("delete from LoadCheckpoint;")
+                    for table in tables:
+                        conn_norm.execute("drop table if exists %s;" % table)
+                    # Marks the database as this file's load before any step can crash halfway
+                    save_checkpoint(conn_norm, 'start', signature, 0, 0, True)
+
+            for step, step_function, table in steps:
+                if step in checkpoints and checkpoints[step][2]:
+                    continue
+                # A crash after the step's insert committed but before its checkpoint leaves a full table
+                with conn_norm:
+                    conn_norm.execute("drop table if exists %s;" % table)
+                step_function(data_filename, normalized_database_filename, session=session)
+                with conn_norm:
+                    save_checkpoint(conn_norm, step, signature, 0, 0, True)
+
+            byte_offset, last_order_id, completed = checkpoints.get('step11', (None, 0, False))
+            if not completed:
+                create_table(conn_norm, CREATE_ORDERDETAIL_TABLE_SQL)
+                with conn_norm:
+                    conn_norm.execute("delete from OrderDetail where OrderID > ?;", (last_order_id,))
+                cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename, session)
+                prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename, session)
+                exploder = OrderLineExploder()
+
+                for byte_offset, lines in iter_line_chunks(data_filename, byte_offset, checkpoint_interval):
+                    order_details = OrderDetailColumns()
+                    with profile_phase('parse'):
+                        for line in lines:
+                            line = line.strip()
+                            if line:
+                                order_details.append_line(line.split('\t'), exploder)
+                    profile_count('rows_parsed', len(order_details))
+
+                    # Dates first: if the chunk below is rolled back they are simply found again on resume
+                    insert_date_table(conn_norm, order_details.day_numbers)
+                    with profile_phase('insert'), conn_norm:
+                        n = insert_rows(conn_norm, 'OrderDetail', ORDERDETAIL_COLUMNS, order_details.rows(cust_data, prod_data))
+                        profile_count('rows_inserted', n)
+                        last_order_id = conn_norm.execute("select coalesce(max(OrderID), 0) from OrderDetail;").fetchone()[0]
+                        save_checkpoint(conn_norm, 'step11', signature, byte_offset, last_order_id, False)
+                    rows_inserted += n
+                exploder.format_date.report()
+                exploder.report()
+
+                create_table(conn_norm, CREATE_DATE_TABLE_SQL)
+                with profile_phase('insert'):
+                    create_indexes(conn_norm, covering_indexes)
+                with conn_norm:
+                    save_checkpoint(conn_norm, 'step11', signature, byte_offset or 0, last_order_id, True)
+
+    return rows_inserted
+
+
+### Columnar Export
+
+# File layout of a .col file:
+#     COLUMNAR_MAGIC
+#     chunk buffers, each padded to 8 bytes
+#     footer: JSON with the table name, column names/types and, per chunk, where each column's
+#             buffers are
+#     footer length (8 bytes, little endian)
+#     COLUMNAR_MAGIC
+# Integer and real columns are stored as little-endian int64 / float64 arrays. Text columns are
+# dictionary encoded per chunk: int32 codes (-1 for NULL) plus a zlib-compressed JSON list of the
+# distinct values. BLOB columns are stored per chunk as int32 lengths (-1 for NULL) followed by
+# the concatenated bytes; a column mixing BLOBs with other values is rejected with ValueError.
+# With compression='zlib' (the default) the value and code buffers are compressed too, which
+# keeps exports small at the cost of a decompression per chunk. With compression=None they are
+# stored raw, so ColumnarReader hands out numpy views straight into the memory-mapped file
+# without copying.
+# The format is our own because pyarrow is not a dependency here, so pandas cannot write Parquet or
+# Feather, and because raw buffers allow these zero-copy mmap reads.
+COLUMNAR_MAGIC = b'NCOL1\n'
+
+# Codec for the value and code buffers of .col files: 'zlib' or None. Level 1 keeps most of the
+# size reduction of the default level 6 at a fraction of its export time.
+COLUMNAR_COMPRESSION = 'zlib'
+COLUMNAR_ZLIB_LEVEL = 1
+
+COLUMNAR_CHUNK_SIZE = 100000
+
+# The denormalized sales fact view exported with include_sales_fact=True
+SALES_FACT_SQL = """select OrderDetail.OrderID, OrderDetail.CustomerID, FirstName || ' ' || LastName as Name, Country.Country, Region.Region, OrderDetail.ProductID, ProductName, ProductCategory, OrderDate, ProductUnitPrice, QuantityOrdered, round(ProductUnitPrice * QuantityOrdered, 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Country ON Country.CountryID = Customer.CountryID INNER JOIN Region ON Region.RegionID = Country.RegionID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID INNER JOIN ProductCategory ON ProductCategory.ProductCategoryID = Product.ProductCategoryID order by OrderDetail.OrderID;"""
+
+COLUMNAR_TABLES = ['Region', 'Country', 'Customer', 'ProductCategory', 'Product', 'OrderDetail', 'Date']
+
+
+def _encode_column(values):
+    # Inputs: One column of a chunk, as a tuple of sqlite3 values
+    # Output: (type, value buffer, dictionary buffer or None)
+
+    kinds = {type(v) for v in values}
+    if bytes in kinds:
+        if not kinds <= {bytes, type(None)}:
+            raise ValueError("Cannot export a column mixing BLOB and %s values"
+                             % ', '.join(sorted(kind.__name__ for kind in kinds - {bytes, type(None)})))
+        lengths = np.fromiter((-1 if v is None else len(v) for v in values), dtype='<i4', count=len(values))
+        return 'binary', lengths.tobytes() + b''.join(v for v in values if v is not None), None
+    if kinds <= {int}:
+        try:
+            return 'int64', np.array(values, dtype='<i8').tobytes(), None
+        except OverflowError:
+            pass
+    elif kinds <= {int, float, type(None)}:
+        return 'float64', np.array([np.nan if v is None else v for v in values], dtype='<f8').tobytes(), None
+
+    dictionary = {}
+    codes = np.fromiter((-1 if v is None else dictionary.setdefault(str(v), len(dictionary)) for v in values),
+                        dtype='<i4', count=len(values))
+    return 'string', codes.tobytes(), zlib.compress(json.dumps(list(dictionary)).encode('utf-8'))
+
+
+def _column_type(types):
+    # Inputs: The types of one column's chunks
+    # Output: The type of the whole column
+    # write_columnar only lets a binary column's other chunks be all NULL (stored as float64)
+    types = set(types)
+    if 'binary' in types:
+        return 'binary'
+    if len(types) == 1:
+        return types.pop()
+    if types == {'int64', 'float64'}:
+        return 'float64'
+    return 'string'
+
+
+def write_columnar(cursor, columnar_filename, table, chunk_size=COLUMNAR_CHUNK_SIZE, compression=COLUMNAR_COMPRESSION):
+    # Inputs: Cursor with a pending query; output filename; table name recorded in the footer;
+    #         rows per chunk; 'zlib' or None
+    # Output: Number of rows written
+    # Rows are fetched and encoded one chunk at a time, so memory stays bounded by chunk_size.
+
+    names = [d[0] for d in cursor.description]
+    chunks = []
+    rows_written = 0
+    # Per column, the types of its chunks holding a non-NULL value
+    valued_types = [set() for _ in names]
+
+    with open(columnar_filename, 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+
+        def write_buffer(data, codec=None):
+            if codec == 'zlib':
+                data = zlib.compress(data, COLUMNAR_ZLIB_LEVEL)
+            offset = f.tell()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+            return {'offset': offset, 'length': len(data), 'codec': codec}
+
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            chunk = {'rows': len(rows), 'columns': []}
+            for i, values in enumerate(zip(*rows)):
+                column_type, data, dictionary = _encode_column(values)
+                if column_type == 'binary' or any(v is not None for v in values):
+                    valued_types[i].add(column_type)
+                    if 'binary' in valued_types[i] and len(valued_types[i]) > 1:
+                        raise ValueError("Cannot export column %s of %s: it mixes BLOB and other values"
+                                         % (names[i], table))
+                column = {'type': column_type, 'data': write_buffer(data, compression)}
+                if dictionary is not None:
+                    column['dictionary'] = write_buffer(dictionary)
+                chunk['columns'].append(column)
+            chunks.append(chunk)
+            rows_written += len(rows)
+            rows = cursor.fetchmany(chunk_size)
+
+        columns = [{'name': name, 'type': _column_type(c['columns'][i]['type'] for c in chunks) if chunks else 'string'}
+                   for i, name in enumerate(names)]
+        footer = json.dumps({'table': table, 'rows': rows_written, 'columns': columns,
+                             'chunks': chunks}).encode('utf-8')
+        f.write(footer)
+        f.write(len(footer).to_bytes(8, 'little'))
+        f.write(COLUMNAR_MAGIC)
+
+    return rows_written
+
+
+def export_columnar(normalized_database_filename, output_directory, tables=None, include_sales_fact=False,
+                    chunk_size=COLUMNAR_CHUNK_SIZE, compression=COLUMNAR_COMPRESSION):
+    # Inputs: Normalized database filename; directory for the .col files; tables to export (default
+    #         COLUMNAR_TABLES); whether to also export the SALES_FACT_SQL view as SalesFact; rows per
+    #         chunk; 'zlib' or None (uncompressed, read without copying)
+    # Output: Dictionary of exported name -> .col filename
+
+    os.makedirs(output_directory, exist_ok=True)
+    queries = [(table, "select * from %s order by rowid;" % table) for table in (tables or COLUMNAR_TABLES)]
+    if include_sales_fact:
+        queries.append(('SalesFact', SALES_FACT_SQL))
+
+    exported = {}
+    with session_scope(normalized_database_filename) as session:
+        for table, sql_statement in queries:
+            columnar_filename = os.path.join(output_directory, table + '.col')
+            write_columnar(session.connection.execute(sql_statement), columnar_filename, table, chunk_size,
+                           compression)
+            exported[table] = columnar_filename
+    return exported
+
+
+class ColumnarReader:
+    # Memory-maps a .col file written by write_columnar.
+    # Usage:
+    #     with ColumnarReader('export/SalesFact.col') as reader:
+    #         for chunk in reader.iter_chunks(['CustomerID', 'Total']):
+    #             ...
+    #         df = reader.read()
+    # iter_chunks yields numpy arrays that are views into the mapping for raw numeric columns; they
+    # stay valid after close(), which then leaves unmapping to the last array that goes away.
+
+    def __init__(self, columnar_filename):
+        self.columnar_filename = columnar_filename
+        with open(columnar_filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = len(COLUMNAR_MAGIC)
+        if self._map[:magic] != COLUMNAR_MAGIC or self._map[-magic:] != COLUMNAR_MAGIC:
+            self._map.close()
+            raise ValueError("%s is not a columnar export" % columnar_filename)
+        footer_end = len(self._map) - magic - 8
+        footer_length = int.from_bytes(self._map[footer_end:footer_end + 8], 'little')
+        footer = json.loads(self._map[footer_end - footer_length:footer_end].decode('utf-8'))
+        self.table = footer['table']
+        self.num_rows = footer['rows']
+        self.columns = [c['name'] for c in footer['columns']]
+        self.column_types = {c['name']: c['type'] for c in footer['columns']}
+        self._chunks = footer['chunks']
+
+    def _buffer(self, ref, dtype):
+        if ref['codec'] == 'zlib':
+            return np.frombuffer(zlib.decompress(self._map[ref['offset']:ref['offset'] + ref['length']]), dtype=dtype)
+        return np.frombuffer(self._map, dtype=dtype, count=ref['length'] // np.dtype(dtype).itemsize,
+                             offset=ref['offset'])
+
+    def _decode(self, column, column_type, rows):
+        # Chunks whose type is narrower than the column's are widened to it
+        if column['type'] == 'binary':
+            data = self._buffer(column['data'], 'u1')
+            lengths = np.frombuffer(data, dtype='<i4', count=rows)
+            ends = (rows * 4 + np.cumsum(np.maximum(lengths, 0))).tolist()
+            values = np.empty(rows, dtype=object)
+            start = rows * 4
+            for i, (length, end) in enumerate(zip(lengths.tolist(), ends)):
+                values[i] = None if length < 0 else data[start:end].tobytes()
+                start = end
+            return values
+        if column_type == 'binary':
+            return np.full(rows, None, dtype=object)  # an all-NULL chunk
+        if column['type'] != 'string':
+            values = self._buffer(column['data'], '<i8' if column['type'] == 'int64' else '<f8')
+            if column_type == 'string':
+                return np.array([str(v) for v in values.tolist()], dtype=object)
+            return values.astype('<f8') if column_type != column['type'] else values
+        ref = column['dictionary']
+        dictionary = json.loads(zlib.decompress(self._map[ref['offset']:ref['offset'] + ref['length']]))
+        # The trailing None is what code -1 (NULL) indexes
+        return np.array(dictionary + [None], dtype=object)[self._buffer(column['data'], '<i4')]
+
+    def iter_chunks(self, columns=None):
+        # Inputs: Column names to decode (default all)
+        # Output: Generator of {column name: numpy array}, one per chunk
+        positions = [(name, self.columns.index(name)) for name in (columns or self.columns)]
+        for chunk in self._chunks:
+            yield {name: self._decode(chunk['columns'][i], self.column_types[name], chunk['rows'])
+                   for name, i in positions}
+
+    def read(self, columns=None):
+        # Inputs: Column names to read (default all)
+        # Output: DataFrame of the whole file
+        names = columns or self.columns
+        parts = {name: [] for name in names}
+        for chunk in self.iter_chunks(names):
+            for name in names:
+                parts[name].append(chunk[name])
+        data = {}
+        for name in names:
+            data[name] = np.concatenate(parts[name]) if parts[name] else np.array([], dtype=object)
+        return pd.DataFrame(data, columns=names)
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # numpy views from iter_chunks still reference the mapping
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_columnar(columnar_filename, columns=None):
+    # Inputs: .col filename; column names to read (default all)
+    # Output: DataFrame of the file
+    with ColumnarReader(columnar_filename) as reader:
+        return reader.read(columns)
+
+
+### Query API
+
+# Bound-parameter versions of ex1/ex2. The statement text never changes, so sqlite3's statement
+# cache parses and plans each one once per connection however many customers are looked up.
+CUSTOMER_ORDERS_SQL = """select FirstName || ' ' || LastName as Name, ProductName, OrderDate, ProductUnitPrice, QuantityOrdered, round(ProductUnitPrice * QuantityOrdered, 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where OrderDetail.CustomerID = ? order by OrderDetail.OrderID;"""
+
+CUSTOMER_TOTAL_SQL = """select FirstName || ' ' || LastName as Name, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where OrderDetail.CustomerID = ?;"""
+
+# The customer IDs are bound as one JSON array, so every batch size shares a single statement.
+CUSTOMER_TOTALS_SQL = """select FirstName || ' ' || LastName as Name, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where OrderDetail.CustomerID in (select value from json_each(?)) group by OrderDetail.CustomerID order by OrderDetail.CustomerID;"""
+
+
+def _run_query(conn, sql_statement, params, as_frame):
+    if as_frame:
+        return pd.read_sql_query(sql_statement, conn, params=params)
+    return conn.execute(sql_statement, params).fetchall()
+
+
+def customer_orders(conn, CustomerName, as_frame=True):
+    # Inputs: Connection to the normalized database; customer name (FirstName LastName); whether to
+    #         return a DataFrame instead of a list of row tuples
+    # Output: Every order line of the customer, with the columns of ex1
+
+    cust_id = ID_CACHE.lookup(conn, 'Customer')[CustomerName]
+    return _run_query(conn, CUSTOMER_ORDERS_SQL, (cust_id,), as_frame)
+
+
+def customer_total(conn, CustomerName, as_frame=True):
+    # Inputs: Connection to the normalized database; customer name (FirstName LastName); whether to
+    #         return a DataFrame instead of a list of row tuples
+    # Output: Name and Total of the customer, as in ex2
+
+    cust_id = ID_CACHE.lookup(conn, 'Customer')[CustomerName]
+    return _run_query(conn, CUSTOMER_TOTAL_SQL, (cust_id,), as_frame)
+
+
+def customer_totals(conn, CustomerNames, as_frame=True):
+    # Inputs: Connection to the normalized database; customer names (FirstName LastName); whether to
+    #         return a DataFrame instead of a list of row tuples
+    # Output: Name and Total of every given customer, answered with a single query (ordered by CustomerID)
+
+    cust_dict = ID_CACHE.lookup(conn, 'Customer')
+    cust_ids = sorted({cust_dict[name] for name in CustomerNames})
+    return _run_query(conn, CUSTOMER_TOTALS_SQL, (json.dumps(cust_ids),), as_frame)
+
+
+### Report Cache
+
+# Default number of query results kept by QUERY_CACHE
+QUERY_CACHE_SIZE = 64
+
+
+def data_version(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Tuple that changes whenever data a query could read may have changed: PRAGMA
+    #         data_version covers commits by other connections, total_changes this connection's own
+    #         writes and PRAGMA schema_version any schema change
+    return (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes,
+            conn.execute("PRAGMA schema_version").fetchone()[0])
+
+
+class QueryResultCache:
+    # Keeps the DataFrames of recently run report queries, keyed on the connection and the SQL text
+    # and tagged with data_version(), so repeating a report after nothing was loaded is served from
+    # memory instead of rescanning OrderDetail. PRAGMA data_version only compares within one
+    # connection, hence one entry per connection; the entry holds the connection so its id() is
+    # not reused while the entry exists. Least recently used entries beyond maxsize are dropped.
+
+    def __init__(self, maxsize=QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def query(self, conn, sql_statement):
+        # Inputs: Connection to the normalized database; SQL statement
+        # Output: DataFrame of the statement's result
+
+        key = (id(conn), sql_statement)
+        version = data_version(conn)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is conn and entry[1] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2].copy()
+
+        self.misses += 1
+        df = pd.read_sql_query(sql_statement, conn)
+        self._entries[key] = (conn, version, df)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return df.copy()
+
+    def invalidate(self):
+        self._entries.clear()
+
+
+QUERY_CACHE = QueryResultCache()
+
+
+def report(conn, name, *args):
+    # Inputs: Connection to the normalized database; report name ('ex1' ... 'ex11'); the report's
+    #         other arguments (the customer name for ex1/ex2)
+    # Output: DataFrame of the report, from QUERY_CACHE when the database did not change since it last ran
+    # The ex functions only build their SQL statement; this is the way to get a report's rows cached.
+    if name not in REPORTS:
+        raise ValueError("No report named %r; expected one of %s" % (name, ', '.join(REPORTS)))
+    return QUERY_CACHE.query(conn, REPORTS[name](conn, *args))
 
 
 def ex1(conn, CustomerName):
@@ -467,13 +2397,12 @@ def ex1(conn, CustomerName):
     
     ### BEGIN SOLUTION
 
-    cust_dict = step6_create_customer_to_customerid_dictionary('normalized.db')
+    cust_dict = ID_CACHE.lookup(conn, 'Customer')
     cust_id = cust_dict[CustomerName]
-    sql_statement = f"""select FirstName || ' ' || LastName as Name, ProductName, OrderDate, ProductUnitPrice, QuantityOrdered, round(ProductUnitPrice * QuantityOrdered, 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where Customer.CustomerID = {cust_id};"""
+    sql_statement = f"""select FirstName || ' ' || LastName as Name, ProductName, OrderDate, ProductUnitPrice, QuantityOrdered, round(ProductUnitPrice * QuantityOrdered, 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where Customer.CustomerID = {cust_id} order by OrderDetail.OrderID;"""
     
     ### END SOLUTION
 
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
     
 
@@ -488,12 +2417,11 @@ def ex2(conn, CustomerName):
     
     ### BEGIN SOLUTION
 
-    cust_dict = step6_create_customer_to_customerid_dictionary('normalized.db')
+    cust_dict = ID_CACHE.lookup(conn, 'Customer')
     cust_id = cust_dict[CustomerName]
     sql_statement = f"""select FirstName || ' ' || LastName as Name, ROUND(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID where Customer.CustomerID = {cust_id};"""
     
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex3(conn):
@@ -506,10 +2434,12 @@ def ex3(conn):
     # ORDER BY Total Descending 
     ### BEGIN SOLUTION
 
-    sql_statement = """Select FirstName || ' ' || LastName as Name, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID  INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Name order by Total desc;"""
+    if has_sales_summary_tables(conn):
+        sql_statement = SALES_SUMMARY_QUERIES['ex3']
+    else:
+        sql_statement = """Select FirstName || ' ' || LastName as Name, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from OrderDetail INNER JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID  INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Name order by Total desc;"""
     
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex4(conn):
@@ -523,10 +2453,12 @@ def ex4(conn):
     # ORDER BY Total Descending 
     ### BEGIN SOLUTION
 
-    sql_statement = """select Region, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from Customer INNER JOIN OrderDetail ON OrderDetail.CustomerID = Customer.CustomerID  INNER JOIN Country ON Country.CountryID = Customer.CountryID INNER JOIN Region ON Region.RegionID = Country.RegionID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Region order by Total desc"""
+    if has_sales_summary_tables(conn):
+        sql_statement = SALES_SUMMARY_QUERIES['ex4']
+    else:
+        sql_statement = """select Region, round(sum(ProductUnitPrice * QuantityOrdered), 2) as Total from Customer INNER JOIN OrderDetail ON OrderDetail.CustomerID = Customer.CustomerID  INNER JOIN Country ON Country.CountryID = Customer.CountryID INNER JOIN Region ON Region.RegionID = Country.RegionID INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Region order by Total desc"""
     
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex5(conn):
@@ -539,16 +2471,57 @@ def ex5(conn):
     # ORDER BY Total Descending 
     ### BEGIN SOLUTION
 
-    sql_statement = """select Country, round(sum(Product.ProductUnitPrice * OrderDetail.QuantityOrdered), 2) as Total 
-    from OrderDetail INNER JOIN OrderDetail ON OrderDetail.CustomerID = Customer.CustomerID  
-    INNER JOIN Country ON Country.CountryID = Customer.CountryID 
-    INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Country order by Total desc"""
+    if has_sales_summary_tables(conn):
+        sql_statement = SALES_SUMMARY_QUERIES['ex5']
+    else:
+        sql_statement = """select Country, round(sum(Product.ProductUnitPrice * OrderDetail.QuantityOrdered)) as CountryTotal 
+        from OrderDetail INNER JOIN Customer ON OrderDetail.CustomerID = Customer.CustomerID  
+        INNER JOIN Country ON Country.CountryID = Customer.CountryID 
+        INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by Country order by CountryTotal desc"""
     
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 
+def _country_totals_sql(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Query for the rounded total of every country with its region, the input ranked by
+    #         ex6 and ex7; read from CountrySales when the sales summary tables exist
+    if has_sales_summary_tables(conn):
+        return """select Region, Country, round(Total) as CountryTotal from CountrySales INNER JOIN Country ON Country.CountryID = CountrySales.CountryID INNER JOIN Region ON Region.RegionID = Country.RegionID"""
+    return """select Region, Country, round(sum(CustomerTotal)) as CountryTotal from (select OrderDetail.CustomerID, sum(ProductUnitPrice * QuantityOrdered) as CustomerTotal from OrderDetail INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by OrderDetail.CustomerID) as CustomerTotals INNER JOIN Customer ON Customer.CustomerID = CustomerTotals.CustomerID INNER JOIN Country ON Country.CountryID = Customer.CountryID INNER JOIN Region ON Region.RegionID = Country.RegionID group by Country.CountryID"""
+
+
+def _daily_sales_sql(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Query for the sales per day and customer, the pre-joined input of ex8-ex10; keyed by
+    #         DateID when the Date dimension exists, otherwise by the OrderDate text
+    # Grouping in the column order of idx_orderdetail_dateid_customer_product_quantity lets SQLite
+    # aggregate in a single pass over that index, and the reports then roll up a few rows per day
+    # instead of every order line.
+    if has_date_table(conn):
+        return f"""select {ORDERDETAIL_DATEID_SQL} as DateID, OrderDetail.CustomerID, sum(ProductUnitPrice * QuantityOrdered) as Total from OrderDetail INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by {ORDERDETAIL_DATEID_SQL}, OrderDetail.CustomerID"""
+    return """select OrderDate, OrderDetail.CustomerID, sum(ProductUnitPrice * QuantityOrdered) as Total from OrderDetail INNER JOIN Product ON Product.ProductID = OrderDetail.ProductID group by OrderDate, OrderDetail.CustomerID"""
+
+
+def _quarterly_sales_sql(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Query for the rounded sales per customer and quarter over DailySales, the input of ex8
+    #         and ex9; Year and Quarter come from the Date dimension when it exists, otherwise they
+    #         are sliced out of the YYYY-MM-DD OrderDate text
+    if has_date_table(conn):
+        return """select 'Q' || Date.Quarter as Quarter, Date.Year as Year, CustomerID, round(sum(Total)) as Total from DailySales INNER JOIN Date ON Date.DateID = DailySales.DateID group by Date.Year, Date.Quarter, CustomerID"""
+    return """select 'Q' || ((cast(substr(OrderDate, 6, 2) as integer) + 2) / 3) as Quarter, cast(substr(OrderDate, 1, 4) as integer) as Year, CustomerID, round(sum(Total)) as Total from DailySales group by Year, Quarter, CustomerID"""
+
+
+def _monthly_sales_sql(conn):
+    # Inputs: Connection to the normalized database
+    # Output: Query for the rounded sales per calendar month over DailySales, the input of ex10
+    if has_date_table(conn):
+        return """select Date.Month as MonthNumber, round(sum(Total)) as Total from DailySales INNER JOIN Date ON Date.DateID = DailySales.DateID group by Date.Month"""
+    return """select cast(substr(OrderDate, 6, 2) as integer) as MonthNumber, round(sum(Total)) as Total from DailySales group by MonthNumber"""
+
+
 def ex6(conn):
     
     # Rank the countries within a region based on order total
@@ -557,11 +2530,11 @@ def ex6(conn):
     # Hint: Sort ASC by Region
     ### BEGIN SOLUTION
 
-    sql_statement = """
-     
-    """
+    sql_statement = f"""with CountryTotals as ({_country_totals_sql(conn)})
+    select Region, Country, CountryTotal, rank() over (partition by Region order by CountryTotal desc) as CountryRegionalRank
+    from CountryTotals order by Region, CountryRegionalRank;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 
@@ -575,11 +2548,11 @@ def ex7(conn):
     # HINT: Use "WITH"
     ### BEGIN SOLUTION
 
-    sql_statement = """
-      
-    """
+    sql_statement = f"""with CountryTotals as ({_country_totals_sql(conn)}),
+    CountryRanks as (select Region, Country, CountryTotal, rank() over (partition by Region order by CountryTotal desc) as CountryRegionalRank from CountryTotals)
+    select Region, Country, CountryTotal, CountryRegionalRank from CountryRanks where CountryRegionalRank = 1 order by Region;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex8(conn):
@@ -591,11 +2564,10 @@ def ex8(conn):
     # HINT: YOU MUST CAST YEAR TO TYPE INTEGER!!!!
     ### BEGIN SOLUTION
 
-    sql_statement = """
-       
-    """
+    sql_statement = f"""with DailySales as ({_daily_sales_sql(conn)}), QuarterlySales as ({_quarterly_sales_sql(conn)})
+    select Quarter, Year, CustomerID, Total from QuarterlySales order by Year, Quarter, CustomerID;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex9(conn):
@@ -609,11 +2581,11 @@ def ex9(conn):
     # WITH table1 AS (), table2 AS ()
     ### BEGIN SOLUTION
 
-    sql_statement = """
-    
-    """
+    sql_statement = f"""with DailySales as ({_daily_sales_sql(conn)}), QuarterlySales as ({_quarterly_sales_sql(conn)}),
+    QuarterlyRanks as (select Quarter, Year, CustomerID, Total, rank() over (partition by Year, Quarter order by Total desc) as CustomerRank from QuarterlySales)
+    select Quarter, Year, CustomerID, Total, CustomerRank from QuarterlyRanks where CustomerRank <= 5 order by Year, Quarter, CustomerRank;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex10(conn):
@@ -624,11 +2596,12 @@ def ex10(conn):
     # Hint: Round the the total
     ### BEGIN SOLUTION
 
-    sql_statement = """
-      
-    """
+    sql_statement = f"""with DailySales as ({_daily_sales_sql(conn)}),
+    Months(MonthNumber, Month) as (values (1, 'January'), (2, 'February'), (3, 'March'), (4, 'April'), (5, 'May'), (6, 'June'), (7, 'July'), (8, 'August'), (9, 'September'), (10, 'October'), (11, 'November'), (12, 'December')),
+    MonthlySales as ({_monthly_sales_sql(conn)})
+    select Month, Total, rank() over (order by Total desc) as TotalRank from MonthlySales INNER JOIN Months ON Months.MonthNumber = MonthlySales.MonthNumber order by TotalRank;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex11(conn):
@@ -648,9 +2621,29 @@ def ex11(conn):
 
     ### BEGIN SOLUTION
 
-    sql_statement = """
-     
-    """
+    if has_date_table(conn):
+        # Gaps are differences of DateIDs; the dates are looked up in the Date dimension afterwards
+        sql_statement = f"""with CustomerOrderDates as (select distinct CustomerID, {ORDERDETAIL_DATEID_SQL} as DateID from OrderDetail),
+    OrderGaps as (select CustomerID, DateID, PreviousDateID, DateID - PreviousDateID as DaysWithoutOrder,
+        row_number() over (partition by CustomerID order by DateID - PreviousDateID desc, DateID) as GapRank
+        from (select CustomerID, DateID, lag(DateID) over (partition by CustomerID order by DateID) as PreviousDateID from CustomerOrderDates))
+    select OrderGaps.CustomerID, FirstName, LastName, Country, OrderDates.Date as OrderDate, PreviousOrderDates.Date as PreviousOrderDate, cast(DaysWithoutOrder as real) as MaxDaysWithoutOrder
+    from OrderGaps INNER JOIN Customer ON Customer.CustomerID = OrderGaps.CustomerID INNER JOIN Country ON Country.CountryID = Customer.CountryID
+    INNER JOIN Date as OrderDates ON OrderDates.DateID = OrderGaps.DateID LEFT JOIN Date as PreviousOrderDates ON PreviousOrderDates.DateID = OrderGaps.PreviousDateID
+    where GapRank = 1 order by MaxDaysWithoutOrder desc, OrderGaps.CustomerID desc;"""
+    else:
+        sql_statement = """with CustomerOrderDates as (select distinct CustomerID, OrderDate from OrderDetail),
+    OrderGaps as (select CustomerID, OrderDate, PreviousOrderDate, julianday(OrderDate) - julianday(PreviousOrderDate) as DaysWithoutOrder,
+        row_number() over (partition by CustomerID order by julianday(OrderDate) - julianday(PreviousOrderDate) desc, OrderDate) as GapRank
+        from (select CustomerID, OrderDate, lag(OrderDate) over (partition by CustomerID order by OrderDate) as PreviousOrderDate from CustomerOrderDates))
+    select OrderGaps.CustomerID, FirstName, LastName, Country, OrderDate, PreviousOrderDate, DaysWithoutOrder as MaxDaysWithoutOrder
+    from OrderGaps INNER JOIN Customer ON Customer.CustomerID = OrderGaps.CustomerID INNER JOIN Country ON Country.CountryID = Customer.CountryID
+    where GapRank = 1 order by MaxDaysWithoutOrder desc, OrderGaps.CustomerID desc;"""
+
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
-    return sql_statement
\ No newline at end of file
+    return sql_statement
+
+
+# The reports report() can run, by name
+REPORTS = {'ex1': ex1, 'ex2': ex2, 'ex3': ex3, 'ex4': ex4, 'ex5': ex5, 'ex6': ex6, 'ex7': ex7, 'ex8': ex8,
+           'ex9': ex9, 'ex10': ex10, 'ex11': ex11}
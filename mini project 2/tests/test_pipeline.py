@@ -0,0 +1,1129 @@
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+import ingest
+import mini_project2
+
+
+HEADER = 'Name\tAddress\tCity\tCountry\tRegion\tProductName\tProductCategory\tProductCategoryDescription\tProductUnitPrice\tQuantityOrdered\tOrderDate\n'
+
+LINES = [
+    'Maria Anders\tObere Str. 57\tBerlin\tGermany\tWestern Europe\tChai;Ikura;Chai\tBeverages;Seafood;Beverages\tSoft drinks;Seaweed and fish;Soft drinks\t18.0;31.0;18.0\t3;1;12\t20130104;20130217;20140520\n',
+    'Ana Trujillo\tAvda. de la Constitucion 2222\tMexico D.F.\tMexico\tCentral America\tIkura;Tofu\tSeafood;Produce\tSeaweed and fish;Dried fruit and bean curd\t31.0;23.25\t5;2\t20121101;20121231\n',
+    'Jose Pedro Freyre\tC/ Romero, 33\tSevilla\tSpain\tSouthern Europe\tTofu\tProduce\tDried fruit and bean curd\t23.25\t7\t20150302\n',
+    'Maria Anders\tObere Str. 57\tBerlin\tGermany\tWestern Europe\tAniseed Syrup\tCondiments\tSweet and savory sauces\t10.0\t4\t20150303\n',
+]
+
+TABLES = ['Region', 'Country', 'Customer', 'ProductCategory', 'Product', 'OrderDetail']
+
+
+def write_data_file(path, lines=LINES):
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        f.writelines(lines)
+
+
+def write_synthetic_data_file(path, n_rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for _ in range(n_rows):
+            customer = rng.randrange(n_rows // 10 + 1)
+            product = rng.randrange(500)
+            f.write('First%d Last%d\tStreet %d\tCity%d\tCountry%d\tRegion%d\tProduct%d\tCategory%d\tDescription%d\t%d.5\t%d\t2014%02d%02d\n' % (
+                customer, customer, customer, customer % 50, customer % 40, customer % 8,
+                product, product % 10, product % 10, product, rng.randint(1, 20), rng.randint(1, 12), rng.randint(1, 28)))
+
+
+def dump_tables(db_filename, tables=TABLES):
+    conn = sqlite3.connect(db_filename)
+    try:
+        return {t: conn.execute("select * from %s order by 1" % t).fetchall() for t in tables}
+    finally:
+        conn.close()
+
+
+def run_steps(data_filename, db_filename, writers=None):
+    mini_project2.step1_create_region_table(data_filename, db_filename)
+    mini_project2.step3_create_country_table(data_filename, db_filename)
+    mini_project2.step5_create_customer_table(data_filename, db_filename)
+    mini_project2.step7_create_productcategory_table(data_filename, db_filename)
+    mini_project2.step9_create_product_table(data_filename, db_filename)
+    mini_project2.step11_create_orderdetail_table(data_filename, db_filename, writers=writers)
+
+
+class FakeCopy:
+
+    def __init__(self, conn, sql_statement):
+        self.conn = conn
+        self.sql_statement = sql_statement
+        self.chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.conn.copy_payloads.append((self.sql_statement, self.chunks))
+            self.conn.apply_copy(self.sql_statement, ''.join(self.chunks))
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def execute(self, sql_statement):
+        self.result = self.conn.execute(sql_statement)
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+    def copy(self, sql_statement):
+        return FakeCopy(self.conn, sql_statement)
+
+
+class FakePostgresConnection:
+    # Stands in for a psycopg 3 connection: records every statement and COPY payload it is sent and
+    # applies them to a SQLite database, so the loaded tables can be compared with the SQLite backend's.
+
+    def __init__(self, db_filename, autocommit=False):
+        self.autocommit = autocommit
+        self.info = types.SimpleNamespace(dsn=db_filename)
+        self.statements = []
+        self.copy_payloads = []
+        self.shadow = sqlite3.connect(db_filename, isolation_level=None)
+
+    def execute(self, sql_statement):
+        self.statements.append(sql_statement)
+        return self.shadow.execute(sql_statement.replace('generated by default as identity primary key', 'primary key not null'))
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.shadow.execute('begin')
+        try:
+            yield
+        except BaseException:
+            self.shadow.execute('rollback')
+            raise
+        self.shadow.execute('commit')
+
+    def apply_copy(self, sql_statement, payload):
+        table, columns = re.match(r'copy (\w+) \((.*)\) from stdin$', sql_statement).groups()
+        unescape = {'t': '\t', 'n': '\n', 'r': '\r'}
+        rows = [[None if field == '\\N' else re.sub(r'\\(.)', lambda m: unescape.get(m.group(1), m.group(1)), field)
+                 for field in line.split('\t')] for line in payload.split('\n')[:-1]]
+        if rows:
+            self.shadow.executemany('insert into %s(%s) values(%s)' % (table, columns, ', '.join(['?'] * len(rows[0]))), rows)
+
+    def close(self):
+        self.shadow.close()
+
+
+class PipelineTestCase(unittest.TestCase):
+    # Each test gets a scratch directory with data.csv written from LINES and the path of a
+    # normalized.db that does not exist yet; the directory is removed after the test.
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.data_filename = os.path.join(self.tmpdir, 'data.csv')
+        self.db_filename = os.path.join(self.tmpdir, 'normalized.db')
+        write_data_file(self.data_filename)
+
+
+class TestPipeline(PipelineTestCase):
+
+    def test_normalize_matches_step_chain(self):
+        steps_db = os.path.join(self.tmpdir, 'steps.db')
+        normalize_db = os.path.join(self.tmpdir, 'normalize.db')
+        run_steps(self.data_filename, steps_db)
+        mini_project2.normalize(self.data_filename, normalize_db)
+        self.assertEqual(dump_tables(steps_db), dump_tables(normalize_db))
+
+    def test_step11_batches_match_single_insert(self):
+        tables = {}
+        for batch_size, insert_calls in [(None, 1), (2, 4), (7, 1)]:
+            db_filename = os.path.join(self.tmpdir, 'batch_%s.db' % batch_size)
+            for step in [mini_project2.step1_create_region_table, mini_project2.step3_create_country_table,
+                         mini_project2.step5_create_customer_table, mini_project2.step7_create_productcategory_table,
+                         mini_project2.step9_create_product_table]:
+                step(self.data_filename, db_filename)
+            with mock.patch.object(mini_project2, 'insert_rows', wraps=mini_project2.insert_rows) as insert_rows:
+                mini_project2.step11_create_orderdetail_table(self.data_filename, db_filename, batch_size=batch_size)
+            self.assertEqual(sum(call.args[1] == 'OrderDetail' for call in insert_rows.call_args_list), insert_calls)
+            tables[batch_size] = dump_tables(db_filename)
+        self.assertEqual(tables[2], tables[None])
+        self.assertEqual(tables[7], tables[None])
+
+    def test_session_shares_one_connection(self):
+        with mini_project2.NormalizationSession(self.db_filename) as session:
+            mini_project2.step1_create_region_table(self.data_filename, self.db_filename, session=session)
+            mini_project2.step3_create_country_table(self.data_filename, self.db_filename, session=session)
+            mini_project2.step5_create_customer_table(self.data_filename, self.db_filename, session=session)
+            mini_project2.step7_create_productcategory_table(self.data_filename, self.db_filename, session=session)
+            mini_project2.step9_create_product_table(self.data_filename, self.db_filename, session=session)
+            mini_project2.step11_create_orderdetail_table(self.data_filename, self.db_filename, session=session)
+            self.assertEqual(session.connections_opened, 1)
+        self.assertIsNone(session._conn)
+        steps_db = os.path.join(self.tmpdir, 'steps.db')
+        run_steps(self.data_filename, steps_db)
+        self.assertEqual(dump_tables(steps_db), dump_tables(self.db_filename))
+
+    def test_bulk_load_matches_default(self):
+        default_db = os.path.join(self.tmpdir, 'default.db')
+        bulk_db = os.path.join(self.tmpdir, 'bulk.db')
+        mini_project2.normalize(self.data_filename, default_db)
+        with mini_project2.NormalizationSession(bulk_db, bulk_load=True) as session:
+            mini_project2.normalize(self.data_filename, bulk_db, session=session)
+            conn = session.connection
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 0)
+            self.assertEqual(conn.execute("PRAGMA foreign_keys").fetchone()[0], 0)
+        self.assertEqual(dump_tables(default_db), dump_tables(bulk_db))
+
+    def test_bulk_load_restores_previous_pragmas(self):
+        conn = sqlite3.connect(self.db_filename, factory=mini_project2.SQLiteConnection)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA cache_size = -5000")
+        mini_project2.start_bulk_load(conn)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'off')
+        mini_project2.end_bulk_load(conn)
+        self.assertEqual([conn.execute("PRAGMA %s" % name).fetchone()[0]
+                          for name in ['journal_mode', 'synchronous', 'cache_size', 'temp_store', 'foreign_keys']],
+                         ['wal', 1, -5000, 0, 0])
+        conn.close()
+
+        # A session restores the journal mode when the load succeeds and when it fails
+        for error in (None, KeyboardInterrupt):
+            with self.assertRaises(error) if error else contextlib.nullcontext():
+                with mini_project2.NormalizationSession(self.db_filename, bulk_load=True) as session:
+                    mini_project2.step1_create_region_table(self.data_filename, self.db_filename, session=session)
+                    if error:
+                        raise error
+            self.assertEqual(len(mini_project2._PRAGMAS_BEFORE_BULK_LOAD), 0)
+            conn = sqlite3.connect(self.db_filename)
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            conn.close()
+
+    def test_bulk_load_state_follows_the_connection(self):
+        conn = sqlite3.connect(self.db_filename)
+        with self.assertRaises(TypeError):
+            mini_project2.start_bulk_load(conn)
+        conn.close()
+
+        # A connection dropped without end_bulk_load takes its saved PRAGMAs with it
+        conn = mini_project2.create_connection(self.db_filename, bulk_load=True)
+        self.assertIn(conn, mini_project2._PRAGMAS_BEFORE_BULK_LOAD)
+        conn.close()
+        del conn
+        gc.collect()
+        self.assertEqual(len(mini_project2._PRAGMAS_BEFORE_BULK_LOAD), 0)
+
+    def test_bulk_load_reports_foreign_key_violations(self):
+        conn = mini_project2.create_connection(self.db_filename, bulk_load=True)
+        mini_project2.create_table(conn, mini_project2.CREATE_REGION_TABLE_SQL)
+        mini_project2.create_table(conn, mini_project2.CREATE_COUNTRY_TABLE_SQL)
+        with conn:
+            conn.execute("insert into Country(Country, RegionID) values('Nowhere', 42);")
+        with self.assertRaises(sqlite3.IntegrityError):
+            mini_project2.end_bulk_load(conn)
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 2)
+        self.assertEqual(conn.execute("PRAGMA foreign_keys").fetchone()[0], 1)
+        conn.close()
+
+    def test_order_date_converter(self):
+        format_date = mini_project2.OrderDateConverter()
+        self.assertEqual(format_date('20130104'), '2013-01-04')
+        self.assertEqual(format_date('20130104'), '2013-01-04')
+        self.assertIsNone(format_date('20130230'))
+        self.assertIsNone(format_date('2013014'))
+        self.assertIsNone(format_date('20130230'))
+        self.assertEqual(format_date.invalid, {'20130230': 2, '2013014': 1})
+
+    def test_malformed_dates_are_reported_not_raised(self):
+        write_data_file(self.data_filename, LINES[:2] + [LINES[2].replace('20150302', '20151302')] + LINES[3:])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mini_project2.normalize(self.data_filename, self.db_filename)
+        self.assertIn("Skipped 1 order lines with malformed OrderDate: '20151302'", output.getvalue())
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 6)
+
+    def test_order_line_exploder(self):
+        exploder = mini_project2.OrderLineExploder()
+        fields = LINES[0].rstrip('\n').split('\t')[5:11]
+        self.assertEqual(list(exploder(fields))[1], ('Ikura', 'Seafood', 'Seaweed and fish', 31.0, 1, '2013-02-17'))
+        self.assertEqual(list(exploder(fields, ('QuantityOrdered', 'ProductName'))), [(3, 'Chai'), (1, 'Ikura'), (12, 'Chai')])
+        self.assertFalse(exploder.mismatched)
+
+        fields[4] = '3;1'
+        self.assertEqual(len(list(exploder(fields))), 2)
+        self.assertEqual(exploder.mismatched, {(3, 3, 3, 3, 2, 3): 1})
+
+    def test_mismatched_lines_are_reported(self):
+        write_data_file(self.data_filename, [LINES[0].replace('\t3;1;12\t', '\t3;1\t')] + LINES[1:])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_steps(self.data_filename, self.db_filename)
+        self.assertEqual(output.getvalue().count(
+            'Truncated 1 lines whose semicolon-packed columns have different lengths: (3, 3, 3, 3, 2, 3)'), 3)
+        tables = dump_tables(self.db_filename)
+        self.assertEqual(len(tables['OrderDetail']), 6)
+        self.assertEqual(len(tables['Product']), 4)
+
+    def test_every_load_path_explodes_alike(self):
+        lines = [LINES[0].replace('\t3;1;12\t', '\t3;1\t'), LINES[1],
+                 LINES[2].replace('\t23.25\t', '\t23.250\t'), LINES[3]]
+        write_data_file(self.data_filename, lines)
+        db_filenames = [os.path.join(self.tmpdir, name) for name in
+                        ['steps.db', 'steps_partitioned.db', 'normalize.db', 'normalize_partitioned.db', 'incremental.db']]
+        message = 'Truncated 1 lines whose semicolon-packed columns have different lengths: (3, 3, 3, 3, 2, 3)'
+        # steps 7, 9 and 11 each read the file and report once; normalize() reports once per load
+        for load, db_filename, reports in zip(
+                [lambda db: run_steps(self.data_filename, db), lambda db: run_steps(self.data_filename, db, writers=2),
+                 lambda db: mini_project2.normalize(self.data_filename, db),
+                 lambda db: mini_project2.normalize(self.data_filename, db, writers=2),
+                 lambda db: mini_project2.load_incremental(self.data_filename, db)],
+                db_filenames, [3, 3, 1, 1, 1]):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                load(db_filename)
+            self.assertEqual(output.getvalue().count(message), reports, db_filename)
+        expected = dump_tables(db_filenames[0])
+        self.assertEqual(len(expected['Product']), 4)
+        for db_filename in db_filenames[1:]:
+            self.assertEqual(dump_tables(db_filename), expected, db_filename)
+
+    def test_attached_database_limit_without_getlimit(self):
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual(mini_project2.attached_database_limit(conn), conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED))
+        conn.close()
+        self.assertEqual(mini_project2.attached_database_limit(types.SimpleNamespace()),
+                         mini_project2.DEFAULT_ATTACHED_LIMIT)
+
+    def test_parallel_parse_matches_serial(self):
+        write_synthetic_data_file(self.data_filename, 3000)
+        serial = mini_project2.parse_data_file(self.data_filename)
+        for workers in (2, 3, 7):
+            self.assertEqual(mini_project2.parse_data_file(self.data_filename, workers=workers), serial)
+
+    def test_partitioned_writers_match_single_writer(self):
+        steps_db = os.path.join(self.tmpdir, 'steps.db')
+        run_steps(self.data_filename, steps_db)
+        expected = dump_tables(steps_db, TABLES + ['Date'])
+
+        partitioned_db = os.path.join(self.tmpdir, 'partitioned.db')
+        mini_project2.normalize(self.data_filename, partitioned_db, writers=3)
+        self.assertEqual(dump_tables(partitioned_db, TABLES + ['Date']), expected)
+
+        step11_db = os.path.join(self.tmpdir, 'step11.db')
+        with mini_project2.NormalizationSession(step11_db) as session:
+            for step in [mini_project2.step1_create_region_table, mini_project2.step3_create_country_table,
+                         mini_project2.step5_create_customer_table, mini_project2.step7_create_productcategory_table,
+                         mini_project2.step9_create_product_table]:
+                step(self.data_filename, step11_db, session=session)
+            mini_project2.step11_create_orderdetail_table(self.data_filename, step11_db, session=session, writers=4)
+            self.assertEqual([row[1] for row in session.connection.execute("PRAGMA database_list")], ['main'])
+        self.assertEqual(dump_tables(step11_db, TABLES + ['Date']), expected)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['data.csv', 'partitioned.db', 'step11.db', 'steps.db'])
+
+    def test_customer_builder(self):
+        builder = mini_project2.CustomerBuilder()
+        keys = [('Jose Pedro Freyre', 'C/ Romero, 33', 'Sevilla', 'Spain'),
+                ('Maria Anders', 'Obere Str. 57', 'Berlin', 'Germany'),
+                ('Jose Pedro Freyre', 'C/ Romero, 33', 'Sevilla', 'Spain'),
+                ('Hanna Moos', 'Forsterstr. 57', 'Mannheim', ''.join(['Ger', 'many']))]
+        for key in keys:
+            builder.add(*key)
+        self.assertEqual(len(builder), 3)
+        customers = builder.customers()
+        self.assertEqual(customers, {('Jose', 'Pedro Freyre', 'C/ Romero, 33', 'Sevilla', 'Spain'),
+                                     ('Maria', 'Anders', 'Obere Str. 57', 'Berlin', 'Germany'),
+                                     ('Hanna', 'Moos', 'Forsterstr. 57', 'Mannheim', 'Germany')})
+        countries = [c[4] for c in customers if c[4] == 'Germany']
+        self.assertIs(countries[0], countries[1])
+
+        updated = mini_project2.CustomerBuilder()
+        updated.update(keys)
+        self.assertEqual(updated.customers(), customers)
+        self.assertEqual(mini_project2.parse_data_file(self.data_filename)['customers'], {
+            ('Maria', 'Anders', 'Obere Str. 57', 'Berlin', 'Germany'),
+            ('Ana', 'Trujillo', 'Avda. de la Constitucion 2222', 'Mexico D.F.', 'Mexico'),
+            ('Jose', 'Pedro Freyre', 'C/ Romero, 33', 'Sevilla', 'Spain')})
+
+    def test_order_detail_columns_match_exploded_lines(self):
+        write_synthetic_data_file(self.data_filename, 3000)
+        format_date = mini_project2.OrderDateConverter()
+        expected = [(c, p, d, int(q)) for c, p, d, q in mini_project2.iter_order_details(self.data_filename, format_date)]
+        order_details = mini_project2.parse_data_file(self.data_filename)['order_details']
+        self.assertIsInstance(order_details, mini_project2.OrderDetailColumns)
+        self.assertEqual(list(order_details), expected)
+        for column in (order_details.customer_codes, order_details.product_codes, order_details.order_days,
+                       order_details.quantities):
+            self.assertEqual((column.typecode, len(column)), ('i', len(expected)))
+
+        merged = mini_project2.OrderDetailColumns()
+        with open(self.data_filename) as f:
+            lines = [line.strip().split('\t') for line in f.readlines()[1:]]
+        for part in (lines[:5], lines[5:]):
+            shard = mini_project2.OrderDetailColumns()
+            for line in part:
+                shard.append_line(line, mini_project2.OrderLineExploder(format_date))
+            merged.extend(shard)
+        self.assertEqual(merged, order_details)
+
+    def test_shard_byte_ranges_cover_file_on_line_boundaries(self):
+        with open(self.data_filename, 'rb') as f:
+            content = f.read()
+        for shards in (1, 2, 3, 10):
+            ranges = mini_project2.shard_byte_ranges(self.data_filename, shards)
+            self.assertEqual(ranges[0][0], len(HEADER))
+            self.assertEqual(ranges[-1][1], len(content))
+            for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+                self.assertEqual(content[end - 1:end], b'\n')
+
+    def test_iter_columns_matches_split(self):
+        write_data_file(self.data_filename, LINES[:2] + ['\n', '  ' + LINES[2].replace('\n', ' \r\n')] + LINES[3:])
+        with open(self.data_filename) as f:
+            next(f)
+            expected = [line.strip().split('\t') for line in f if line.strip()]
+        for columns in [(4,), (3, 4), (0, 1, 2, 3), (6, 7), (10, 0), tuple(range(11))]:
+            self.assertEqual(list(mini_project2.iter_columns(self.data_filename, columns)),
+                             [tuple(line[c] for c in columns) for line in expected])
+
+    def test_normalize_tables(self):
+        mini_project2.normalize(self.data_filename, self.db_filename)
+        tables = dump_tables(self.db_filename)
+        self.assertEqual(tables['Region'], [(1, 'Central America'), (2, 'Southern Europe'), (3, 'Western Europe')])
+        self.assertEqual(tables['Customer'][1], (2, 'Jose', 'Pedro Freyre', 'C/ Romero, 33', 'Sevilla', 3))
+        self.assertEqual([r[1] for r in tables['ProductCategory']], ['Beverages', 'Condiments', 'Produce', 'Seafood'])
+        self.assertEqual(len(tables['OrderDetail']), 7)
+        self.assertEqual(tables['OrderDetail'][0], (1, 3, 2, '2013-01-04', 3))
+
+
+class TestPostgresBackend(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sqlite_db = os.path.join(self.tmpdir, 'sqlite.db')
+        mini_project2.normalize(self.data_filename, self.sqlite_db)
+        self.backend = mini_project2.PostgresBackend(copy_buffer_size=64, connection_factory=FakePostgresConnection)
+
+    def test_normalize_streams_copy(self):
+        dsn = os.path.join(self.tmpdir, 'postgres.db')
+        with mini_project2.NormalizationSession(dsn, backend=self.backend) as session:
+            mini_project2.normalize(self.data_filename, dsn, session=session)
+            conn = session.connection
+        self.assertEqual(dump_tables(self.sqlite_db, TABLES + ['Date']), dump_tables(dsn, TABLES + ['Date']))
+
+        self.assertTrue(any('generated by default as identity primary key' in s for s in conn.statements))
+        self.assertFalse(any('inetger' in s or ' real ' in s for s in conn.statements))
+        self.assertFalse(any(s.lstrip().startswith('insert') for s in conn.statements))
+        copied = {sql_statement.split()[1]: chunks for sql_statement, chunks in conn.copy_payloads}
+        self.assertEqual(sorted(copied), sorted(TABLES + ['Date']))
+        self.assertEqual(conn.copy_payloads[0], ('copy Region (Region) from stdin',
+                                                 ['Central America\nSouthern Europe\nWestern Europe\n']))
+        self.assertGreater(len(copied['OrderDetail']), 1)
+        self.assertTrue(all(len(chunk) < 64 + 40 for chunk in copied['OrderDetail']))
+        self.assertEqual(''.join(copied['OrderDetail']).split('\n')[0], '3\t2\t2013-01-04\t3')
+
+    def test_step_chain_with_batches(self):
+        dsn = os.path.join(self.tmpdir, 'postgres.db')
+        with mini_project2.NormalizationSession(dsn, backend=self.backend) as session:
+            for step in [mini_project2.step1_create_region_table, mini_project2.step3_create_country_table,
+                         mini_project2.step5_create_customer_table, mini_project2.step7_create_productcategory_table,
+                         mini_project2.step9_create_product_table]:
+                step(self.data_filename, dsn, session=session)
+            mini_project2.step11_create_orderdetail_table(self.data_filename, dsn, batch_size=3, session=session)
+            order_detail_copies = [p for p in session.connection.copy_payloads if p[0].startswith('copy OrderDetail ')]
+        self.assertEqual(len(order_detail_copies), 3)
+        self.assertEqual(dump_tables(self.sqlite_db), dump_tables(dsn))
+
+    def test_copy_text(self):
+        self.assertEqual(mini_project2.copy_text('a\tb\\c\nd'), 'a\\tb\\\\c\\nd')
+        self.assertEqual(mini_project2.copy_text(None), '\\N')
+        self.assertEqual(mini_project2.copy_text(18.0), '18.0')
+        self.assertEqual(mini_project2.copy_text(7), '7')
+
+    def test_sessions_keep_their_own_backend(self):
+        other_backend = mini_project2.PostgresBackend(copy_buffer_size=1 << 16, connection_factory=FakePostgresConnection)
+        with mini_project2.NormalizationSession(os.path.join(self.tmpdir, 'a.db'), backend=self.backend) as session, \
+                mini_project2.NormalizationSession(os.path.join(self.tmpdir, 'b.db'), backend=other_backend) as other:
+            self.assertIs(mini_project2.backend_for(session.connection), self.backend)
+            self.assertIs(mini_project2.backend_for(other.connection), other_backend)
+            self.assertIs(mini_project2.backend_for(session.connection), self.backend)
+        self.assertNotIn(FakePostgresConnection, mini_project2._BACKENDS)
+
+    def test_unknown_connection_type(self):
+        with self.assertRaises(TypeError):
+            mini_project2.backend_for(object())
+
+
+class TestScaling(PipelineTestCase):
+    # The timing measurement lives in benchmark.py (python benchmark.py scaling); this checks the
+    # property behind it: the dimension steps sort their keys once, however long the file is.
+
+    def count_sorts(self, n_rows):
+        data_filename = os.path.join(self.tmpdir, 'data_%d.csv' % n_rows)
+        db_filename = os.path.join(self.tmpdir, 'normalized_%d.db' % n_rows)
+        write_synthetic_data_file(data_filename, n_rows)
+        with mock.patch.object(mini_project2, 'sorted', wraps=sorted, create=True) as sorts:
+            for step in [mini_project2.step1_create_region_table, mini_project2.step3_create_country_table,
+                         mini_project2.step5_create_customer_table, mini_project2.step7_create_productcategory_table,
+                         mini_project2.step9_create_product_table]:
+                step(data_filename, db_filename)
+        return sorts.call_count
+
+    def test_dimension_keys_sorted_once(self):
+        self.assertEqual(self.count_sorts(100), 5)
+        self.assertEqual(self.count_sorts(2000), 5)
+
+
+class TestIdCache(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mini_project2.normalize(self.data_filename, self.db_filename)
+
+    def test_dictionary_loaded_once_and_reloaded_after_change(self):
+        first = mini_project2.step10_create_product_to_productid_dictionary(self.db_filename)
+        self.assertIs(first, mini_project2.step10_create_product_to_productid_dictionary(self.db_filename))
+        self.assertEqual(first, {'Aniseed Syrup': 1, 'Chai': 2, 'Ikura': 3, 'Tofu': 4})
+
+        conn = mini_project2.create_connection(self.db_filename)
+        with conn:
+            conn.execute("insert into Product(ProductName, ProductUnitPrice, ProductCategoryID) values('Konbu', 6.0, 4);")
+        conn.close()
+        self.assertEqual(mini_project2.step10_create_product_to_productid_dictionary(self.db_filename)['Konbu'], 5)
+
+    def test_dictionary_reloaded_after_update_and_rebuild(self):
+        products = mini_project2.step10_create_product_to_productid_dictionary(self.db_filename)
+        with self.assertRaises(TypeError):
+            products['Konbu'] = 5
+
+        conn = mini_project2.create_connection(self.db_filename)
+        with conn:
+            conn.execute("update Product set ProductName = 'Renamed' where ProductID = 1;")
+        conn.close()
+        self.assertEqual(mini_project2.step10_create_product_to_productid_dictionary(self.db_filename).get('Renamed'), 1)
+
+        with mini_project2.NormalizationSession(self.db_filename) as session:
+            self.assertIn('Renamed', mini_project2.step10_create_product_to_productid_dictionary(self.db_filename, session))
+            with session.connection:
+                session.connection.execute("update Product set ProductName = 'Renamed again' where ProductID = 1;")
+            self.assertIn('Renamed again', mini_project2.step10_create_product_to_productid_dictionary(self.db_filename, session))
+
+        # Same row counts, different keys, same path
+        os.remove(self.db_filename)
+        write_data_file(self.data_filename, [line.replace('Maria Anders', 'Hanna Moos').replace('Germany', 'Austria')
+                                             .replace('Western Europe', 'Central Europe') for line in LINES])
+        mini_project2.normalize(self.data_filename, self.db_filename)
+        self.assertIn('Central Europe', mini_project2.step2_create_region_to_regionid_dictionary(self.db_filename))
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 7)
+
+    def test_lru_lookup_is_bounded(self):
+        cache = mini_project2.KeyToIdCache(maxsize=2)
+        with mini_project2.NormalizationSession(self.db_filename, id_cache=cache) as session:
+            lookup = mini_project2.step6_create_customer_to_customerid_dictionary(self.db_filename, session)
+            self.assertEqual(lookup['Jose Pedro Freyre'], 2)
+            self.assertEqual(lookup['Maria Anders'], 3)
+            self.assertEqual(lookup['Ana Trujillo'], 1)
+            self.assertEqual(len(lookup), 2)
+            self.assertNotIn('Nobody', lookup)
+            with self.assertRaises(KeyError):
+                lookup['Nobody']
+
+    def test_customer_query_api(self):
+        conn = mini_project2.create_connection(self.db_filename)
+        self.assertEqual(mini_project2.customer_orders(conn, 'Maria Anders', as_frame=False),
+                         conn.execute(mini_project2.ex1(conn, 'Maria Anders')).fetchall())
+        self.assertEqual(mini_project2.customer_total(conn, 'Ana Trujillo', as_frame=False),
+                         conn.execute(mini_project2.ex2(conn, 'Ana Trujillo')).fetchall())
+        totals = mini_project2.customer_totals(conn, ['Maria Anders', 'Ana Trujillo', 'Maria Anders'])
+        self.assertEqual(list(totals['Name']), ['Ana Trujillo', 'Maria Anders'])
+        self.assertEqual(list(totals['Total']), [201.5, 341.0])
+        with self.assertRaises(KeyError):
+            mini_project2.customer_totals(conn, ['Nobody'])
+        conn.close()
+
+    def test_ex1_uses_connection_lookup(self):
+        conn = mini_project2.create_connection(self.db_filename)
+        sql_statement = mini_project2.ex1(conn, 'Maria Anders')
+        self.assertEqual(len(conn.execute(sql_statement).fetchall()), 4)
+        conn.close()
+
+
+class TestIndexes(PipelineTestCase):
+
+    def query_plans(self, conn):
+        plans = {}
+        for name in ['ex1', 'ex2']:
+            sql_statement = getattr(mini_project2, name)(conn, 'Maria Anders')
+            plans[name] = [row[3] for row in conn.execute('explain query plan ' + sql_statement)]
+        for name in ['ex3', 'ex4', 'ex5', 'ex6', 'ex7', 'ex8', 'ex9', 'ex10', 'ex11']:
+            sql_statement = getattr(mini_project2, name)(conn)
+            plans[name] = [row[3] for row in conn.execute('explain query plan ' + sql_statement)]
+        return plans
+
+    def test_indexes_created(self):
+        mini_project2.normalize(self.data_filename, self.db_filename)
+        conn = mini_project2.create_connection(self.db_filename)
+        indexes = {row[0] for row in conn.execute("select name from sqlite_master where type = 'index'")}
+        conn.close()
+        self.assertTrue({'idx_orderdetail_customerid', 'idx_orderdetail_productid', 'idx_orderdetail_orderdate',
+                         'idx_customer_countryid', 'idx_country_regionid'} <= indexes)
+
+    def orderdetail_plans(self, covering_indexes):
+        mini_project2.normalize(self.data_filename, self.db_filename, covering_indexes=covering_indexes)
+        conn = mini_project2.create_connection(self.db_filename)
+        plans = {name: [detail for detail in plan if ' OrderDetail ' in detail + ' ']
+                 for name, plan in self.query_plans(conn).items()}
+        conn.close()
+        return plans
+
+    # ex1 and ex2 look up one customer's rows. ex3-ex11 aggregate every OrderDetail row, so they
+    # necessarily read the whole table: a full scan of the table (or of idx_orderdetail_customerid
+    # where rows are grouped by customer) with the default indexes, a full scan of the narrower
+    # covering index with covering_indexes=True.
+
+    def test_customer_reports_search_orderdetail_by_index(self):
+        by_customer = 'SEARCH OrderDetail USING INDEX idx_orderdetail_customerid (CustomerID=?)'
+        customer_order = 'SCAN OrderDetail USING INDEX idx_orderdetail_customerid'
+        expected = {
+            'ex1': [by_customer], 'ex2': [by_customer],
+            'ex3': ['SCAN OrderDetail'], 'ex4': ['SCAN OrderDetail'], 'ex5': ['SCAN OrderDetail'],
+            'ex6': [customer_order], 'ex7': [customer_order],
+            'ex8': ['SCAN OrderDetail'], 'ex9': ['SCAN OrderDetail'], 'ex10': ['SCAN OrderDetail'],
+            'ex11': [customer_order],
+        }
+        self.assertEqual(self.orderdetail_plans(covering_indexes=False), expected)
+
+    def test_orderdetail_read_through_covering_indexes(self):
+        by_customer = 'SCAN OrderDetail USING COVERING INDEX idx_orderdetail_customer_product_quantity'
+        by_date = 'SCAN OrderDetail USING COVERING INDEX idx_orderdetail_dateid_customer_product_quantity'
+        expected = {
+            'ex1': ['SEARCH OrderDetail USING INDEX idx_orderdetail_customerid (CustomerID=?)'],
+            'ex2': ['SEARCH OrderDetail USING COVERING INDEX idx_orderdetail_customer_product_quantity (CustomerID=?)'],
+            'ex3': [by_customer], 'ex4': [by_customer], 'ex5': [by_customer], 'ex6': [by_customer], 'ex7': [by_customer],
+            'ex8': [by_date], 'ex9': [by_date], 'ex10': [by_date], 'ex11': [by_date],
+        }
+        self.assertEqual(self.orderdetail_plans(covering_indexes=True), expected)
+
+
+class TestReports(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mini_project2.normalize(self.data_filename, self.db_filename)
+        self.conn = mini_project2.create_connection(self.db_filename)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def query(self, name):
+        sql_statement = getattr(mini_project2, name)(self.conn)
+        return [tuple(row) for row in self.conn.execute(sql_statement)]
+
+    def test_ranking_reports(self):
+        self.assertEqual(self.query('ex6'), [('Central America', 'Mexico', 202.0, 1), ('Southern Europe', 'Spain', 163.0, 1),
+                                             ('Western Europe', 'Germany', 341.0, 1)])
+        self.assertEqual(self.query('ex7'), self.query('ex6'))
+        self.assertEqual(self.query('ex8'), [('Q4', 2012, 1, 202.0), ('Q1', 2013, 3, 85.0), ('Q2', 2014, 3, 216.0),
+                                             ('Q1', 2015, 2, 163.0), ('Q1', 2015, 3, 40.0)])
+        self.assertEqual(self.query('ex9'), [('Q4', 2012, 1, 202.0, 1), ('Q1', 2013, 3, 85.0, 1), ('Q2', 2014, 3, 216.0, 1),
+                                             ('Q1', 2015, 2, 163.0, 1), ('Q1', 2015, 3, 40.0, 2)])
+        self.assertEqual(self.query('ex10'), [('May', 216.0, 1), ('March', 203.0, 2), ('November', 155.0, 3),
+                                              ('January', 54.0, 4), ('December', 47.0, 5), ('February', 31.0, 6)])
+        self.assertEqual(self.query('ex11'), [(3, 'Maria', 'Anders', 'Germany', '2014-05-20', '2013-02-17', 457.0),
+                                              (1, 'Ana', 'Trujillo', 'Mexico', '2012-12-31', '2012-11-01', 60.0),
+                                              (2, 'Jose', 'Pedro Freyre', 'Spain', '2015-03-02', None, None)])
+
+    def test_date_dimension(self):
+        dates = self.conn.execute("select * from Date order by DateID").fetchall()
+        self.assertEqual(len(dates), 7)
+        self.assertEqual(dates[0], (734808, '2012-11-01', 2012, 4, 11, 4))
+        self.assertEqual(dates[-1], (735660, '2015-03-03', 2015, 1, 3, 2))
+        self.assertEqual(self.conn.execute("select count(*) from Date where DayOfWeek != cast(strftime('%w', Date) as integer)").fetchone()[0], 0)
+
+        self.assertEqual(self.conn.execute("select count(*) from OrderDetail LEFT JOIN Date ON Date.DateID = %s where Date.Date is not OrderDate" % mini_project2.ORDERDETAIL_DATEID_SQL).fetchone()[0], 0)
+
+        reports = {name: self.query(name) for name in ['ex8', 'ex9', 'ex10', 'ex11']}
+        self.assertIn('Date.DateID = DailySales.DateID', mini_project2.ex8(self.conn))
+        self.assertIn(mini_project2.ORDERDETAIL_DATEID_SQL, mini_project2.ex11(self.conn))
+        with self.conn:
+            self.conn.execute("drop table Date;")
+        for name, rows in reports.items():
+            self.assertNotIn('Date.', getattr(mini_project2, name)(self.conn))
+            self.assertEqual(self.query(name), rows)
+
+    def test_country_ranks_from_summary_tables(self):
+        expected = self.query('ex6')
+        mini_project2.create_sales_summary_tables(self.conn)
+        self.assertIn('CountrySales', mini_project2.ex6(self.conn))
+        self.assertEqual(self.query('ex6'), expected)
+
+    def test_result_cache(self):
+        cache = mini_project2.QueryResultCache(maxsize=2)
+        sql_statement = mini_project2.ex8(self.conn)
+        first = cache.query(self.conn, sql_statement)
+        self.assertTrue(cache.query(self.conn, sql_statement).equals(first))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # A load through another connection bumps PRAGMA data_version
+        delta_filename = os.path.join(self.tmpdir, 'delta.csv')
+        write_data_file(delta_filename, ['Ana Trujillo\tAvda. de la Constitucion 2222\tMexico D.F.\tMexico\tCentral America\tTofu\tProduce\tDried fruit and bean curd\t23.25\t4\t20121102\n'])
+        mini_project2.load_incremental(delta_filename, self.db_filename)
+        second = cache.query(self.conn, sql_statement)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(second['Total'].tolist()[0], 295.0)
+
+        # ... and a write on the same connection changes total_changes
+        with self.conn:
+            self.conn.execute("delete from OrderDetail where OrderDate = '2012-11-02';")
+        self.assertTrue(cache.query(self.conn, sql_statement).equals(first))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        for name in ['ex9', 'ex10']:
+            cache.query(self.conn, getattr(mini_project2, name)(self.conn))
+        self.assertEqual(len(cache._entries), 2)
+
+    def test_report(self):
+        mini_project2.QUERY_CACHE.invalidate()
+        hits = mini_project2.QUERY_CACHE.hits
+        df = mini_project2.report(self.conn, 'ex2', 'Maria Anders')
+        self.assertEqual(df.values.tolist(), [['Maria Anders', 341.0]])
+        mini_project2.report(self.conn, 'ex2', 'Maria Anders')
+        self.assertEqual(mini_project2.QUERY_CACHE.hits, hits + 1)
+        self.assertEqual(sorted(mini_project2.REPORTS), sorted('ex%d' % i for i in range(1, 12)))
+
+        # Building a statement does not run it; only report() reads and caches the rows
+        misses = mini_project2.QUERY_CACHE.misses
+        with mock.patch.object(mini_project2.pd, 'read_sql_query') as read_sql_query:
+            for name in ['ex%d' % i for i in range(3, 12)]:
+                mini_project2.REPORTS[name](self.conn)
+        read_sql_query.assert_not_called()
+        self.assertEqual(mini_project2.QUERY_CACHE.misses, misses)
+        for name in ['create_connection', 'ex12', '__builtins__']:
+            with self.assertRaises(ValueError):
+                mini_project2.report(self.conn, name)
+
+
+class TestSalesSummary(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.join_db = os.path.join(self.tmpdir, 'join.db')
+        self.summary_db = os.path.join(self.tmpdir, 'summary.db')
+        mini_project2.normalize(self.data_filename, self.join_db)
+        mini_project2.normalize(self.data_filename, self.summary_db, sales_summary=True)
+
+    def assert_same_results(self):
+        join_conn = mini_project2.create_connection(self.join_db)
+        summary_conn = mini_project2.create_connection(self.summary_db)
+        self.assertTrue(mini_project2.has_sales_summary_tables(summary_conn))
+        self.assertFalse(mini_project2.has_sales_summary_tables(join_conn))
+        for name in ['ex3', 'ex4', 'ex5']:
+            self.assertEqual(getattr(mini_project2, name)(summary_conn), mini_project2.SALES_SUMMARY_QUERIES[name])
+        for name in ['ex3', 'ex4', 'ex5', 'ex6', 'ex7']:
+            summary_sql = getattr(mini_project2, name)(summary_conn)
+            self.assertEqual(summary_conn.execute(summary_sql).fetchall(),
+                             join_conn.execute(getattr(mini_project2, name)(join_conn)).fetchall())
+        join_conn.close()
+        summary_conn.close()
+
+    def test_summary_matches_joins(self):
+        self.assert_same_results()
+
+    def test_summary_follows_appended_rows(self):
+        for db_filename in (self.join_db, self.summary_db):
+            conn = mini_project2.create_connection(db_filename)
+            with conn:
+                conn.executemany("insert into OrderDetail(CustomerID, ProductID, OrderDate, QuantityOrdered) values(?, ?, ?, ?);",
+                                 [(1, 4, '2015-04-01', 10), (2, 1, '2015-04-02', 3)])
+            conn.close()
+        self.assert_same_results()
+
+    def run_on_both(self, sql_statement):
+        for db_filename in (self.join_db, self.summary_db):
+            conn = mini_project2.create_connection(db_filename)
+            with conn:
+                conn.execute(sql_statement)
+            conn.close()
+
+    def test_summary_follows_deleted_rows(self):
+        self.run_on_both("delete from OrderDetail where OrderID > 2;")
+        self.assert_same_results()
+        summary_conn = mini_project2.create_connection(self.summary_db)
+        self.assertEqual(summary_conn.execute(mini_project2.ex3(summary_conn)).fetchall(), [('Maria Anders', 85.0)])
+        summary_conn.close()
+
+    def test_summary_follows_updated_rows(self):
+        self.run_on_both("update OrderDetail set CustomerID = 1, ProductID = 2, QuantityOrdered = QuantityOrdered + 1 where OrderID = 1;")
+        self.assert_same_results()
+
+
+class TestIncrementalLoad(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.base_filename = os.path.join(self.tmpdir, 'base.csv')
+        self.delta_filename = os.path.join(self.tmpdir, 'delta.csv')
+        write_data_file(self.base_filename, LINES[:2])
+        write_data_file(self.delta_filename, LINES[2:] + [
+            'Ann Devon\t35 King George\tLondon\tUK\tBritish Isles\tChai;Konbu\tBeverages;Seafood\tSoft drinks;Seaweed and fish\t18.0;6.0\t2;9\t20150401;20150402\n'])
+
+    def test_append_keeps_existing_ids(self):
+        mini_project2.normalize(self.base_filename, self.db_filename)
+        before = dump_tables(self.db_filename)
+
+        self.assertEqual(mini_project2.load_incremental(self.delta_filename, self.db_filename), 4)
+        after = dump_tables(self.db_filename)
+        for table in TABLES:
+            self.assertEqual(after[table][:len(before[table])], before[table])
+        self.assertEqual([r[1] for r in after['Region']], ['Central America', 'Western Europe', 'British Isles', 'Southern Europe'])
+        self.assertEqual([r[1] for r in after['Customer']], ['Ana', 'Maria', 'Ann', 'Jose'])
+        self.assertEqual([r[1] for r in after['Product']], ['Chai', 'Ikura', 'Tofu', 'Aniseed Syrup', 'Konbu'])
+        self.assertEqual(after['OrderDetail'][len(before['OrderDetail']):], [
+            (6, 4, 3, '2015-03-02', 7), (7, 2, 4, '2015-03-03', 4), (8, 3, 1, '2015-04-01', 2), (9, 3, 5, '2015-04-02', 9)])
+
+    def test_reloading_a_file_is_a_no_op(self):
+        self.assertEqual(mini_project2.load_incremental(self.base_filename, self.db_filename), 5)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(mini_project2.load_incremental(self.base_filename, self.db_filename), 0)
+        self.assertIn('already loaded', output.getvalue())
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 5)
+
+
+class TestResumableLoad(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.expected_db = os.path.join(self.tmpdir, 'expected.db')
+        mini_project2.normalize(self.data_filename, self.expected_db)
+
+    def assertLoaded(self):
+        self.assertEqual(dump_tables(self.expected_db, TABLES + ['Date']), dump_tables(self.db_filename, TABLES + ['Date']))
+
+    def test_interrupted_load_resumes_at_last_chunk(self):
+        rows = mini_project2.OrderDetailColumns.rows
+        calls = []
+
+        def fail_third_chunk(order_details, *args):
+            calls.append(len(order_details))
+            if len(calls) == 3:
+                raise MemoryError
+            return rows(order_details, *args)
+
+        with mock.patch.object(mini_project2.OrderDetailColumns, 'rows', fail_third_chunk):
+            with self.assertRaises(MemoryError):
+                mini_project2.load_resumable(self.data_filename, self.db_filename, checkpoint_interval=1)
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 5)
+
+        with mock.patch.object(mini_project2, 'step1_create_region_table') as step1:
+            self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename, checkpoint_interval=1), 2)
+        step1.assert_not_called()
+        self.assertLoaded()
+
+        conn = sqlite3.connect(self.db_filename)
+        checkpoint = conn.execute("select ByteOffset, LastOrderID, Completed from LoadCheckpoint where Step = 'step11';").fetchone()
+        conn.close()
+        self.assertEqual(checkpoint, (os.path.getsize(self.data_filename), 7, 1))
+        self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename), 0)
+        self.assertLoaded()
+
+    def test_step_committed_without_checkpoint_is_redone(self):
+        insert_customer_table = mini_project2.insert_customer_table
+
+        def crash_after_commit(*args):
+            insert_customer_table(*args)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(mini_project2, 'insert_customer_table', crash_after_commit):
+            with self.assertRaises(KeyboardInterrupt):
+                mini_project2.load_resumable(self.data_filename, self.db_filename)
+        self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename), 7)
+        self.assertLoaded()
+
+    def test_changed_file_starts_over_only_on_restart(self):
+        mini_project2.load_resumable(self.data_filename, self.db_filename)
+        write_data_file(self.data_filename, LINES[:2])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename), 0)
+        self.assertIn('pass restart=True', output.getvalue())
+        self.assertLoaded()
+
+        os.remove(self.expected_db)
+        mini_project2.normalize(self.data_filename, self.expected_db)
+        self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename, restart=True), 5)
+        self.assertLoaded()
+
+    def test_restart_drops_sales_summary_tables(self):
+        mini_project2.normalize(self.data_filename, self.db_filename, sales_summary=True)
+        self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename, restart=True), 7)
+        self.assertLoaded()
+        conn = mini_project2.create_connection(self.db_filename)
+        self.assertEqual(conn.execute("select count(*) from sqlite_master where name like '%Sales%';").fetchone()[0], 0)
+        conn.close()
+
+    def test_database_without_checkpoints_is_not_dropped(self):
+        shutil.copy(self.expected_db, self.db_filename)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename), 0)
+        self.assertLoaded()
+
+    def test_crash_before_first_checkpoint_resumes(self):
+        with mock.patch.object(mini_project2, 'insert_region_table', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                mini_project2.load_resumable(self.data_filename, self.db_filename)
+        self.assertEqual(mini_project2.load_resumable(self.data_filename, self.db_filename), 7)
+        self.assertLoaded()
+
+
+class TestProfiler(PipelineTestCase):
+
+    def test_records_every_step(self):
+        logged = []
+        with mini_project2.PipelineProfiler(trace_memory=True, callback=logged.append) as profiler:
+            run_steps(self.data_filename, self.db_filename)
+        self.assertIsNone(mini_project2._ACTIVE_PROFILER.get())
+        self.assertEqual(logged, profiler.records)
+
+        records = {r['step']: r for r in profiler.records if r['parent'] is None}
+        self.assertEqual(sorted(records), ['step1', 'step11', 'step3', 'step5', 'step7', 'step9'])
+        tables = dump_tables(self.db_filename, TABLES + ['Date'])
+        for step, table in [('step1', 'Region'), ('step3', 'Country'), ('step5', 'Customer'),
+                            ('step7', 'ProductCategory'), ('step9', 'Product')]:
+            self.assertEqual(records[step]['rows_parsed'], len(LINES))
+            self.assertEqual(records[step]['distinct_keys'], len(tables[table]))
+            self.assertEqual(records[step]['rows_inserted'], len(tables[table]))
+        self.assertEqual(records['step11']['rows_parsed'], len(tables['OrderDetail']))
+        self.assertEqual(records['step11']['rows_inserted'], len(tables['OrderDetail']) + len(tables['Date']))
+        self.assertGreater(records['step11']['statements'], len(tables['OrderDetail']))
+        for record in profiler.records:
+            self.assertIsNone(record['error'])
+            self.assertGreaterEqual(record['peak_memory_mb'], 0)
+            phases = record['parse_seconds'] + record['lookup_seconds'] + record['insert_seconds']
+            self.assertLessEqual(phases, record['total_seconds'] + 1e-6)
+
+        nested = [r for r in profiler.records if r['parent'] == 'step11']
+        self.assertEqual(sorted(r['step'] for r in nested), ['step10', 'step6'])
+        self.assertEqual(len(profiler.summary().splitlines()), len(profiler.records) + 1)
+
+    def test_normalize_and_failures(self):
+        with mini_project2.PipelineProfiler() as profiler:
+            mini_project2.normalize(self.data_filename, self.db_filename)
+            with self.assertRaises(FileNotFoundError):
+                mini_project2.step1_create_region_table(os.path.join(self.tmpdir, 'missing.csv'), self.db_filename)
+        normalize, failed = profiler.records[-2:]
+        self.assertEqual(normalize['step'], 'normalize')
+        self.assertEqual(normalize['rows_inserted'], sum(len(rows) for rows in dump_tables(self.db_filename, TABLES + ['Date']).values()))
+        self.assertIsNone(normalize['peak_memory_mb'])
+        self.assertEqual(failed['step'], 'step1')
+        self.assertIn('FileNotFoundError', failed['error'])
+        self.assertIn('step1 (failed)', profiler.summary())
+
+    def test_profilers_are_per_thread(self):
+        # One thread profiles its own steps, another runs without a profiler; neither reaches this one
+        threaded = []
+
+        def run_profiled():
+            with mini_project2.PipelineProfiler() as thread_profiler:
+                run_steps(self.data_filename, os.path.join(self.tmpdir, 'profiled.db'))
+            threaded.append(thread_profiler)
+
+        with mini_project2.PipelineProfiler() as profiler:
+            threads = [threading.Thread(target=run_profiled),
+                       threading.Thread(target=run_steps, args=(self.data_filename, os.path.join(self.tmpdir, 'plain.db')))]
+            for thread in threads:
+                thread.start()
+            mini_project2.normalize(self.data_filename, self.db_filename)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([r['step'] for r in profiler.records if r['parent'] is None], ['normalize'])
+        self.assertEqual(profiler.records[-1]['rows_inserted'],
+                         sum(len(rows) for rows in dump_tables(self.db_filename, TABLES + ['Date']).values()))
+        self.assertEqual(sorted(r['step'] for r in threaded[0].records if r['parent'] is None),
+                         ['step1', 'step11', 'step3', 'step5', 'step7', 'step9'])
+
+
+class TestColumnarExport(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mini_project2.normalize(self.data_filename, self.db_filename)
+
+    def test_round_trip(self):
+        conn = sqlite3.connect(self.db_filename)
+        for compression in (None, 'zlib'):
+            output_directory = os.path.join(self.tmpdir, str(compression))
+            exported = mini_project2.export_columnar(self.db_filename, output_directory, include_sales_fact=True,
+                                                     chunk_size=3, compression=compression)
+            self.assertEqual(sorted(exported), sorted(TABLES + ['Date', 'SalesFact']))
+            for table, columnar_filename in exported.items():
+                sql_statement = mini_project2.SALES_FACT_SQL if table == 'SalesFact' else 'select * from %s order by rowid' % table
+                expected = mini_project2.pd.read_sql_query(sql_statement, conn)
+                mini_project2.pd.testing.assert_frame_equal(mini_project2.read_columnar(columnar_filename), expected,
+                                                            check_dtype=False)
+        conn.close()
+
+    def test_reader_maps_typed_chunks(self):
+        columnar_filename = mini_project2.export_columnar(self.db_filename, self.tmpdir, tables=['OrderDetail'],
+                                                          chunk_size=4, compression=None)['OrderDetail']
+        with mini_project2.ColumnarReader(columnar_filename) as reader:
+            self.assertEqual(reader.num_rows, 7)
+            self.assertEqual(reader.column_types, {'OrderID': 'int64', 'CustomerID': 'int64', 'ProductID': 'int64',
+                                                   'OrderDate': 'string', 'QuantityOrdered': 'int64'})
+            chunks = list(reader.iter_chunks(['OrderID', 'OrderDate']))
+            self.assertEqual([len(c['OrderID']) for c in chunks], [4, 3])
+            self.assertEqual(chunks[0]['OrderID'].dtype.str, '<i8')
+            self.assertFalse(chunks[0]['OrderID'].flags.owndata)
+            self.assertEqual(list(chunks[1]['OrderID']), [5, 6, 7])
+            self.assertTrue(all(isinstance(d, str) for c in chunks for d in c['OrderDate']))
+        self.assertEqual(list(chunks[1]['OrderID']), [5, 6, 7])
+
+    def test_nulls_and_mixed_types(self):
+        conn = sqlite3.connect(':memory:')
+        cursor = conn.execute("select 1, 'a', 1.5 union all select null, null, 2 union all select 3, 4, null;")
+        columnar_filename = os.path.join(self.tmpdir, 'mixed.col')
+        self.assertEqual(mini_project2.write_columnar(cursor, columnar_filename, 'Mixed', chunk_size=2), 3)
+        conn.close()
+        with mini_project2.ColumnarReader(columnar_filename) as reader:
+            self.assertEqual(list(reader.column_types.values()), ['float64', 'string', 'float64'])
+            rows = reader.read().values.tolist()
+        self.assertEqual(rows[0], [1.0, 'a', 1.5])
+        self.assertTrue(rows[1][0] != rows[1][0] and rows[2][2] != rows[2][2])
+        self.assertEqual(rows[2][:2], [3.0, '4'])
+
+    def test_blobs(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("create table Blobs (Data blob);")
+        blobs = [None, None, b'\x00\xff\n', b'', None, b'abc' * 100]
+        conn.executemany("insert into Blobs values(?);", [(blob,) for blob in blobs])
+        for compression in (None, 'zlib'):
+            columnar_filename = os.path.join(self.tmpdir, '%s.col' % compression)
+            mini_project2.write_columnar(conn.execute("select Data from Blobs order by rowid;"), columnar_filename,
+                                         'Blobs', chunk_size=2, compression=compression)
+            with mini_project2.ColumnarReader(columnar_filename) as reader:
+                self.assertEqual(reader.column_types, {'Data': 'binary'})
+                self.assertEqual(reader.read()['Data'].tolist(), blobs)
+
+        for sql_statement in ["select x'00' union all select 'a';", "select x'00' union all select null union all select 1;"]:
+            with self.assertRaises(ValueError):
+                mini_project2.write_columnar(conn.execute(sql_statement), os.path.join(self.tmpdir, 'mixed.col'),
+                                             'Mixed', chunk_size=2)
+        conn.close()
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            mini_project2.ColumnarReader(self.data_filename)
+
+
+class TestIngestionService(PipelineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.spool_directory = os.path.join(self.tmpdir, 'spool')
+        os.mkdir(self.spool_directory)
+
+    def run_service(self, files_expected, timeout=10):
+        service = ingest.IngestionService(self.spool_directory, self.db_filename, poll_interval=0.02)
+
+        async def run():
+            task = asyncio.ensure_future(service.run())
+            deadline = time.monotonic() + timeout
+            while service.files_loaded + service.files_failed < files_expected and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+            service.stop()
+            await task
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            asyncio.run(run())
+        return service, output.getvalue()
+
+    def test_loads_files_in_arrival_order(self):
+        expected_db = os.path.join(self.tmpdir, 'expected.db')
+        for i, lines in enumerate([LINES[:2], LINES[2:]]):
+            data_filename = os.path.join(self.tmpdir, 'extract%d.csv' % i)
+            write_data_file(data_filename, lines)
+            mini_project2.load_incremental(data_filename, expected_db)
+            spool_filename = os.path.join(self.spool_directory, 'extract%d.csv' % i)
+            shutil.copy(data_filename, spool_filename)
+            os.utime(spool_filename, (1000 + i, 1000 + i))
+        write_data_file(os.path.join(self.spool_directory, '.partial.csv'))
+
+        service, _ = self.run_service(2)
+        metrics = service.metrics()
+        self.assertEqual((metrics['files_loaded'], metrics['files_failed'], metrics['rows_loaded']), (2, 0, 7))
+        self.assertGreater(metrics['rows_per_second'], 0)
+        self.assertGreaterEqual(metrics['max_lag_seconds'], metrics['last_lag_seconds'])
+        self.assertEqual(dump_tables(self.db_filename), dump_tables(expected_db))
+        self.assertEqual(sorted(os.listdir(self.spool_directory)), ['.partial.csv', 'done'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.spool_directory, 'done'))), ['extract0.csv', 'extract1.csv'])
+
+    def test_bad_files_are_set_aside(self):
+        with open(os.path.join(self.spool_directory, 'bad.csv'), 'w') as f:
+            f.write(HEADER + 'not a data line\n')
+        write_data_file(os.path.join(self.spool_directory, 'good.csv'))
+
+        service, output = self.run_service(2)
+        self.assertEqual((service.files_loaded, service.files_failed), (1, 1))
+        self.assertIn('Failed to parse', output)
+        self.assertEqual(os.listdir(os.path.join(self.spool_directory, 'failed')), ['bad.csv'])
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 7)
+
+    def test_unmovable_file_does_not_stop_the_writer(self):
+        write_data_file(os.path.join(self.spool_directory, 'a.csv'), LINES[:2])
+        write_data_file(os.path.join(self.spool_directory, 'b.csv'), LINES[2:])
+        replace = os.replace
+
+        def fail_first_move(source, target):
+            if source.endswith('a.csv'):
+                raise PermissionError('read-only spool')
+            replace(source, target)
+
+        with mock.patch.object(ingest.os, 'replace', fail_first_move):
+            service, output = self.run_service(2)
+        self.assertEqual((service.files_loaded, service.files_failed), (2, 0))
+        self.assertIn('Failed to move', output)
+        self.assertEqual(sorted(os.listdir(self.spool_directory)), ['a.csv', 'done'])
+        self.assertEqual(len(dump_tables(self.db_filename)['OrderDetail']), 7)
+
+    def test_writer_failure_stops_the_reader(self):
+        for i in range(ingest.QUEUE_SIZE + 3):
+            write_data_file(os.path.join(self.spool_directory, 'extract%d.csv' % i), LINES[:1])
+        service = ingest.IngestionService(self.spool_directory, self.db_filename, poll_interval=0.02, queue_size=1)
+
+        with mock.patch.object(service, '_finish', side_effect=RuntimeError('writer died')):
+            with contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaisesRegex(RuntimeError, 'writer died'):
+                    asyncio.run(asyncio.wait_for(service.run(), 10))
+        self.assertEqual(service.files_loaded, 1)